@@ -0,0 +1,291 @@
+import asyncio
+import time
+from messages import encode_handshake, decode_handshake, decode_handshake_features
+from message_handler import read_message, write_message
+from peer_process import PeerProcess, CONNECT_TIMEOUT, HANDSHAKE_TIMEOUT, RECONNECT_BASE, RECONNECT_MAX, NEIGHBOR_TICK
+from backoff import Backoff
+from config import CONFIG_DIR
+import logger
+from logger import log
+
+# peer running on a single asyncio event loop instead of a thread per connection.
+# speaks the same wire protocol as PeerProcess, so both can share a swarm.
+class AsyncPeerProcess(PeerProcess):
+    def __init__(self, peer_id: int, config_dir: str = CONFIG_DIR):
+        super().__init__(peer_id, config_dir)
+        # remote_id -> StreamWriter (conn_map holds writers instead of sockets here)
+        self.download_tasks = {}
+        self.upload_tasks = {}
+        # connector tasks of the earlier peers
+        self.connect_tasks = set()
+        self.stopped = None
+        self.loop = None
+        # asyncio writes are buffered in the transport instead of a PeerWriter queue
+        self.metrics.registry.gauge("p2p_send_buffer_bytes", "Bytes waiting in a connection's transport, by neighbor.",
+                                    ("peer",)).set_function(
+            lambda: {(pid,): w.transport.get_write_buffer_size() for pid, w in list(self.conn_map.items())})
+
+    async def run(self):
+        self.stopped = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self._log_start()
+        self.started_at = time.monotonic()
+
+        my_info = self.peer_map[self.peer_id]
+        try:
+            self.server = await asyncio.start_server(self._handle_connection_incoming, '', my_info.listening_port)
+        except Exception as e:
+            print("Server error:", e)
+            self.shutdown()
+            return
+        self._connect_to_earlier_peers()
+
+        # choke and completion timers run on the wheel, advanced by a loop task
+        self.choke_manager.start(drive=False)
+        self._check_completion()
+        tasks = [asyncio.create_task(self._drive_timers(self.choke_manager.wheel))]
+        if self.config.have_batch_interval > 0:
+            tasks.append(asyncio.create_task(self._every(self.config.have_batch_interval / 1000, self._flush_all_haves)))
+        if self.neighbors is not None:
+            tasks.append(asyncio.create_task(self._every(NEIGHBOR_TICK, self._manage_neighbors)))
+        await self.stopped.wait()
+        for t in tasks:
+            t.cancel()
+
+    # calls fn every interval seconds until shutdown
+    async def _every(self, interval: float, fn):
+        while self.running:
+            await asyncio.sleep(interval)
+            try:
+                fn()
+            except Exception:
+                continue
+
+    # advances wheel on the loop: sleeps until its next timer, or until a timer is added
+    async def _drive_timers(self, wheel):
+        wake = asyncio.Event()
+        wheel.wakeup = lambda: self.running and self.loop.call_soon_threadsafe(wake.set)
+        while self.running:
+            wake.clear()
+            delay = wheel.advance()
+            try:
+                await asyncio.wait_for(wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    # one connector task per earlier peer, all running at once (with MaxConnections the neighbor manager picks them)
+    def _connect_to_earlier_peers(self):
+        if self.neighbors is not None:
+            self._manage_neighbors()
+            return
+        ids = [p.peer_ID for p in self.peers]
+        my_index = ids.index(self.peer_id)
+        for p in self.peers[:my_index]:
+            self.reconnect_wakeups[p.peer_ID] = asyncio.Event()
+            self.connect_tasks.add(asyncio.create_task(self._keep_connected(p)))
+
+    # keeps a connection to earlier peer p until shutdown (see PeerProcess._keep_connected)
+    async def _keep_connected(self, p):
+        backoff = Backoff(RECONNECT_BASE, RECONNECT_MAX)
+        wake = self.reconnect_wakeups[p.peer_ID]
+        while self.running:
+            wake.clear()
+            if p.peer_ID in self.conn_map:
+                await wake.wait()
+            elif await self._connect_to_peer(p):
+                backoff.reset()
+            else:
+                try:
+                    await asyncio.wait_for(wake.wait(), backoff.next())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _connect_to_peer(self, p) -> bool:
+        writer = None
+        try:
+            started = time.monotonic()
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(p.host_name, p.listening_port),
+                                                    CONNECT_TIMEOUT)
+            connected = time.monotonic()
+            # send handshake and wait reply
+            writer.write(encode_handshake(self.peer_id, self.FEATURES))
+            await writer.drain()
+            log(self.peer_id, f"sent a handshake to Peer {p.peer_ID}.")
+            resp = await asyncio.wait_for(reader.readexactly(32), HANDSHAKE_TIMEOUT)
+            remote_id = decode_handshake(resp)
+            log(self.peer_id, f"received a handshake from Peer {remote_id}.")
+            if remote_id != p.peer_ID:
+                raise ValueError(f"expected peer {p.peer_ID}, got {remote_id}")
+            if not self._admit(remote_id):
+                raise ValueError(f"no room for peer {remote_id}")
+        except Exception:
+            self.metrics.connect_attempts.labels(p.peer_ID, "failed").inc()
+            if writer is not None:
+                writer.close()
+            return False
+        self._on_connected(remote_id, connected - started, time.monotonic() - connected)
+
+        self._set_features(remote_id, resp)
+        self._add_connection(remote_id, writer)
+        log(self.peer_id, f"makes a connection to Peer {remote_id}.")
+        self._send_our_bitfield_if_any(writer, remote_id)
+        asyncio.create_task(self._message_listener(remote_id, reader, writer))
+        return True
+
+    async def _handle_connection_incoming(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        remote_id = None
+        try:
+            data = await reader.readexactly(32)
+            remote_id = decode_handshake(data)
+            log(self.peer_id, f"received a handshake from Peer {remote_id}.")
+            if not self._admit(remote_id):
+                writer.close()
+                return
+            self._set_features(remote_id, data)
+            # send handshake back, with our features only if remote_id offered some: a peer without extensions
+            # expects all 10 zero bytes
+            writer.write(encode_handshake(self.peer_id, self.FEATURES if decode_handshake_features(data) else 0))
+            await writer.drain()
+            log(self.peer_id, f"sent a handshake to Peer {remote_id}.")
+        except Exception:
+            writer.close()
+            if remote_id is not None:
+                self._handshake_failed(remote_id)
+            return
+        self._add_connection(remote_id, writer)
+        log(self.peer_id, f"is connected from Peer {remote_id}.")
+        self._send_our_bitfield_if_any(writer, remote_id)
+        await self._message_listener(remote_id, reader, writer)
+
+    # makes writer the connection to remote_id; a connection it replaces is closed (its listener then
+    # finds the peer's entry taken and leaves the state to the new connection)
+    def _add_connection(self, remote_id: int, writer: asyncio.StreamWriter):
+        old = self.conn_map.get(remote_id)
+        self.conn_map[remote_id] = writer
+        if old is not None:
+            old.close()
+
+    # everything runs on the loop thread, so writes go straight into the writer's buffer
+    def _send_to(self, remote_id: int, msg_type: int, payload: bytes = b"") -> bool:
+        writer = self.conn_map.get(remote_id)
+        if writer is None or writer.is_closing():
+            return False
+        write_message(writer, msg_type, payload)
+        return True
+
+    async def _message_listener(self, remote_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while self.running:
+            try:
+                msg_type, payload = await read_message(reader)
+                self._handle_message(remote_id, writer, msg_type, payload)
+                # backpressure: wait only if this peer's send buffer is over the high-water mark
+                await writer.drain()
+            except Exception:
+                break # if connection suddenly lost
+
+        writer.close()
+        if self.conn_map.get(remote_id) is writer:
+            del self.conn_map[remote_id]
+            self._on_disconnect(remote_id)
+            self._connection_closed(remote_id)
+
+    def _dial(self, p):
+        async def attempt():
+            if not await self._connect_to_peer(p):
+                self.neighbors.dial_failed(p.peer_ID)
+        task = asyncio.create_task(attempt())
+        self.connect_tasks.add(task)
+        task.add_done_callback(self.connect_tasks.discard)
+
+    # its listener sees the connection end and cleans up
+    def _close_connection(self, remote_id: int):
+        writer = self.conn_map.get(remote_id)
+        if writer is not None:
+            writer.close()
+
+    # connection state belongs to the loop thread, so work from other threads (hash pool) is handed to it
+    def _call_on_network_thread(self, fn, *args):
+        if self.running:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _start_download(self, remote_id: int):
+        task = self.download_tasks.get(remote_id)
+        if task is None or task.done():
+            self.download_tasks[remote_id] = asyncio.create_task(self._download_loop(remote_id))
+
+    def _start_upload(self, remote_id: int, conn):
+        task = self.upload_tasks.get(remote_id)
+        if task is None or task.done():
+            self.upload_tasks[remote_id] = asyncio.create_task(self._upload_loop(remote_id, conn))
+
+    # like the threaded PeerWriter: requests stay queued (and cancellable) until this task sends them, one at a time,
+    # and control messages written meanwhile go out ahead of the next one
+    async def _upload_loop(self, remote_id: int, writer: asyncio.StreamWriter):
+        wake = asyncio.Event()
+        self.transfer_mgr.upload_wakeups[remote_id] = wake
+        while self.running and self.conn_map.get(remote_id) is writer:
+            wake.clear()
+            item = self._next_upload(remote_id)
+            if item is None:
+                try:
+                    await asyncio.wait_for(wake.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            share, entry = item
+            if share.file_mgr.fd is None:
+                continue
+            # upload caps: hold this one back (control messages are written meanwhile by other tasks)
+            delay = share.transfer_mgr.upload_delay(remote_id, entry)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # header and piece (or block) share one buffer, the data is read straight into it
+            writer.write(share.transfer_mgr.build_piece_frame(*entry))
+            share.transfer_mgr.on_uploaded(remote_id, *entry)
+            # wait for this peer's socket if it is backed up, and let the listener run (and see CANCELs) in between
+            await writer.drain()
+            await asyncio.sleep(0)
+
+    # same policy as PeerProcess._download_loop, but waits on the loop instead of blocking a thread
+    async def _download_loop(self, remote_id: int):
+        wake = asyncio.Event()
+        self.transfer_mgr.wakeups[remote_id] = wake
+        while self.running and remote_id in self.conn_map:
+            wake.clear()
+            if not self._fill_windows(remote_id):
+                break
+            try:
+                await asyncio.wait_for(wake.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+    def shutdown(self):
+        if not self.running:
+            return
+        self.running = False
+        self.choke_manager.stop()
+        for wake in self.reconnect_wakeups.values():
+            wake.set()
+        for writer in list(self.conn_map.values()):
+            writer.close()
+        self.conn_map.clear()
+        if self.server is not None:
+            self.server.close()
+        for share in self.shares:
+            share._close_files()
+        if self.profiler is not None:
+            self.profiler.stop()
+        log(self.peer_id, "has shut down.")
+        logger.close(self.peer_id)
+        if self.stopped is not None:
+            self.stopped.set()
+
+# entry point for `peer_process.py <peerID> --async`
+def run_async_peer(pp: AsyncPeerProcess):
+    peer_id = pp.peer_id
+    try:
+        asyncio.run(pp.run())
+    except KeyboardInterrupt:
+        pp.running = False
+        log(peer_id, "has shut down.")
+        logger.flush()
@@ -0,0 +1,21 @@
+import random
+
+class Backoff:
+    """
+    Delays between retries of something that keeps failing: doubling from base up to cap, each one a random
+    point in the upper half of its step ("equal jitter"), so peers that failed together do not retry together.
+    """
+    def __init__(self, base: float, cap: float):
+        self.base = base
+        self.cap = cap
+        self.step = base
+
+    # seconds to wait before the next attempt
+    def next(self) -> float:
+        step = self.step
+        self.step = min(self.cap, self.step * 2)
+        return random.uniform(step / 2, step)
+
+    # the last attempt worked, the next failure starts over from base
+    def reset(self):
+        self.step = self.base
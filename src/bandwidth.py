@@ -0,0 +1,95 @@
+import math
+import threading
+import time
+
+class TokenBucket:
+    """
+    Allows rate bytes per second on average with bursts of up to one second's worth.
+    rate 0 means unlimited (no locking at all). The balance may go negative: a send bigger than the
+    burst still goes out, and later sends wait until the debt is paid back.
+    """
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(float(self.rate), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # takes nbytes now, returns the seconds to wait before sending them
+    def reserve(self, nbytes: int) -> float:
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= nbytes
+            return max(0.0, -self.tokens / self.rate)
+
+    # how many of count sends of unit bytes may start now (a unit bigger than the burst goes once the bucket is full)
+    def available(self, unit: int, count: int) -> int:
+        if not self.rate:
+            return count
+        with self.lock:
+            self._refill(time.monotonic())
+            fits = max(0, int(self.tokens // unit))
+            if fits == 0 and self.tokens >= min(unit, self.rate):
+                fits = 1
+            return min(count, fits)
+
+    def consume(self, nbytes: int):
+        if not self.rate:
+            return
+        with self.lock:
+            self.tokens -= nbytes
+
+    # gives back tokens taken for sends that did not happen (up to a full bucket)
+    def refund(self, nbytes: int):
+        if not self.rate:
+            return
+        with self.lock:
+            self.tokens = min(float(self.rate), self.tokens + nbytes)
+
+class BandwidthLimiter:
+    """
+    Global and per-neighbor upload/download caps from Common.cfg (bytes/sec, 0 = no cap).
+    Uploads reserve tokens before each piece or block goes out; downloads are capped where requests are sent,
+    since the bytes a request asks for arrive anyway once it is out.
+    """
+    def __init__(self, config):
+        self.upload = TokenBucket(config.max_upload_rate)
+        self.download = TokenBucket(config.max_download_rate)
+        self.peer_upload_rate = config.max_peer_upload_rate
+        self.peer_download_rate = config.max_peer_download_rate
+        # remote_id -> TokenBucket, created on first use
+        self.peer_upload = {}
+        self.peer_download = {}
+
+    def _peer_bucket(self, buckets: dict, rate: int, remote_id: int) -> TokenBucket:
+        bucket = buckets.get(remote_id)
+        if bucket is None:
+            bucket = buckets.setdefault(remote_id, TokenBucket(rate))
+        return bucket
+
+    # seconds to hold back nbytes of upload to remote_id (the tokens are taken now)
+    def upload_delay(self, remote_id: int, nbytes: int) -> float:
+        peer = self._peer_bucket(self.peer_upload, self.peer_upload_rate, remote_id)
+        return max(self.upload.reserve(nbytes), peer.reserve(nbytes))
+
+    # how many of count requests of unit bytes may go to remote_id now, sharers being the neighbors
+    # downloading at the same time: each takes at most an equal share of the global rate at once.
+    # The tokens for all of them are taken now, download_refund gives back those of requests that are not sent
+    def download_allowance(self, remote_id: int, unit: int, count: int, sharers: int = 1) -> int:
+        peer = self._peer_bucket(self.peer_download, self.peer_download_rate, remote_id)
+        granted = min(peer.available(unit, count), self.download.available(unit, count))
+        if self.download.rate and sharers > 1:
+            granted = min(granted, max(1, math.ceil(self.download.rate / unit / sharers)))
+        self.download.consume(granted * unit)
+        peer.consume(granted * unit)
+        return granted
+
+    # the requests nbytes were allowed for by download_allowance were not sent after all
+    def download_refund(self, remote_id: int, nbytes: int):
+        self.download.refund(nbytes)
+        self._peer_bucket(self.peer_download, self.peer_download_rate, remote_id).refund(nbytes)
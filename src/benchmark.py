@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from peer_process import PeerProcess
+from async_peer_process import AsyncPeerProcess
+import logger
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# runs a whole swarm inside this process on loopback and reports how long it took, as JSON:
+#   python src/benchmark.py --peers 6 --seeders 1 --file-size 16777216 --piece-size 65536 --output run.json
+# every peer gets its own PeerProcess (and threads) from a generated configuration in a temporary folder,
+# so runs of different versions with the same options can be compared.
+
+FIRST_PEER_ID = 1001
+FILE_NAME = "bench.dat"
+# how often the peers' bitfields are checked for completion
+POLL_INTERVAL = 0.01
+
+# a loopback port nothing listens on right now
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# writes Common.cfg and PeerInfo.cfg to config_dir, returns [(peer_id, has_file)]
+def write_config(config_dir: str, args) -> list:
+    os.makedirs(config_dir, exist_ok=True)
+    common = {
+        "NumberOfPreferredNeighbors": args.preferred,
+        "UnchokingInterval": args.unchoking_interval,
+        "OptimisticUnchokingInterval": args.optimistic_interval,
+        "FileName": FILE_NAME,
+        "FileSize": args.file_size,
+        "PieceSize": args.piece_size,
+    }
+    common.update(args.set)
+    with open(os.path.join(config_dir, "Common.cfg"), "w", encoding="utf-8") as f:
+        f.write("".join(f"{key} {value}\n" for key, value in common.items()))
+
+    peers = [(FIRST_PEER_ID + i, i < args.seeders) for i in range(args.peers)]
+    with open(os.path.join(config_dir, "PeerInfo.cfg"), "w", encoding="utf-8") as f:
+        f.write("".join(f"{pid} 127.0.0.1 {free_port()} {int(has)}\n" for pid, has in peers))
+    return peers
+
+# puts the same random file in every seeder's folder, returns its sha1
+def write_seed_files(work_dir: str, peers: list, file_size: int) -> str:
+    source = os.path.join(work_dir, FILE_NAME)
+    digest = hashlib.sha1()
+    with open(source, "wb") as f:
+        left = file_size
+        while left > 0:
+            chunk = os.urandom(min(left, 1 << 20))
+            digest.update(chunk)
+            f.write(chunk)
+            left -= len(chunk)
+    for pid, has_file in peers:
+        if has_file:
+            os.makedirs(os.path.join(work_dir, f"peer_{pid}"), exist_ok=True)
+            shutil.copyfile(source, os.path.join(work_dir, f"peer_{pid}", FILE_NAME))
+    os.remove(source)
+    return digest.hexdigest()
+
+def _file_sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# (user CPU seconds, system CPU seconds, peak resident set) of this process so far; without the resource
+# module (Windows) only the CPU time of the process is known, counted as user time
+def _usage():
+    if resource is None:
+        return time.process_time(), None, None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime, usage.ru_maxrss
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+# starts one peer on its own thread; the thread ends once the peer has shut down
+def _run_peer(pp: PeerProcess):
+    if isinstance(pp, AsyncPeerProcess):
+        asyncio.run(pp.run())
+        return
+    pp.start()
+    pp.shut_down.wait()
+
+# runs the swarm described by args in base_dir, returns the report
+def run_swarm(args, base_dir: str) -> dict:
+    config_dir = os.path.join(base_dir, "configuration")
+    # peers keep their files in peer_<id>/ under the working directory and log to its parent
+    work_dir = os.path.join(base_dir, "work")
+    os.makedirs(work_dir, exist_ok=True)
+    peers = write_config(config_dir, args)
+    expected = write_seed_files(work_dir, peers, args.file_size)
+
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        engine = AsyncPeerProcess if args.use_async else PeerProcess
+        processes = [engine(pid, config_dir) for pid, _ in peers]
+        threads = [threading.Thread(target=_run_peer, args=(pp,), daemon=True) for pp in processes]
+
+        user_before, system_before, _ = _usage()
+        started = time.monotonic()
+        for t in threads:
+            t.start()
+        # peer_id -> seconds from start until its bitfield was complete
+        completed = {pp.peer_id: 0.0 for pp in processes if pp.bitfield.is_complete()}
+        deadline = started + args.timeout
+        while len(completed) < len(processes) and time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            now = time.monotonic() - started
+            for pp in processes:
+                if pp.peer_id not in completed and pp.bitfield.is_complete():
+                    completed[pp.peer_id] = now
+        swarm_time = time.monotonic() - started if len(completed) == len(processes) else None
+
+        # let the peers notice the swarm is done and shut down on their own
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        shutdown_time = time.monotonic() - started
+        for pp in processes:
+            if pp.running:
+                pp.shutdown()
+        user_after, system_after, max_rss = _usage()
+        logger.flush()
+    finally:
+        os.chdir(old_cwd)
+
+    results = []
+    for pp, (pid, has_file) in zip(processes, peers):
+        path = os.path.join(work_dir, f"peer_{pid}", FILE_NAME)
+        results.append({
+            "peer_id": pid,
+            "seeder": has_file,
+            "completion_s": completed.get(pid),
+            # from the peer's own start(), which the threads above call at about the same time
+            "first_piece_s": pp.first_piece_at - pp.started_at if pp.first_piece_at is not None else None,
+            # earlier peer -> seconds of the TCP connect and of the handshake, latest connection
+            "connect_s": {str(remote): {"connect": c, "handshake": h} for remote, (c, h) in pp.connect_latency.items()},
+            "bytes_received": sum(ps.bytes_received_total for ps in pp.peers_state.values()),
+            "bytes_sent": sum(ps.bytes_sent_total for ps in pp.peers_state.values()),
+            "file_ok": os.path.exists(path) and _file_sha1(path) == expected,
+        })
+
+    downloaded = args.file_size * (args.peers - args.seeders)
+    leecher_times = [r["completion_s"] for r in results if not r["seeder"] and r["completion_s"] is not None]
+    return {
+        "params": {
+            "peers": args.peers,
+            "seeders": args.seeders,
+            "file_size": args.file_size,
+            "piece_size": args.piece_size,
+            "preferred": args.preferred,
+            "unchoking_interval": args.unchoking_interval,
+            "optimistic_interval": args.optimistic_interval,
+            "engine": "async" if args.use_async else "threaded",
+            "common": dict(args.set),
+        },
+        "version": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "timestamp": time.time(),
+        "complete": swarm_time is not None and all(r["file_ok"] for r in results),
+        "swarm_completion_s": swarm_time,
+        "shutdown_s": shutdown_time,
+        "mean_completion_s": sum(leecher_times) / len(leecher_times) if leecher_times else None,
+        # bytes every leecher downloaded over the time until the last one finished
+        "throughput_bytes_per_s": downloaded / swarm_time if swarm_time else None,
+        "cpu_user_s": user_after - user_before,
+        "cpu_system_s": system_after - system_before if system_after is not None else None,
+        # peak resident set of the whole benchmark process (kilobytes on Linux, bytes on macOS, None on Windows)
+        "max_rss": max_rss,
+        "peers_detail": results,
+    }
+
+# KEY=VALUE for --set, the value kept as int when it is one
+def _common_option(text: str):
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {text!r}")
+    return key, int(value) if value.lstrip("-").isdigit() else value
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a whole swarm on loopback in this process and report timings as JSON.")
+    parser.add_argument("--peers", type=int, default=4, help="number of peers")
+    parser.add_argument("--seeders", type=int, default=1, help="how many of them start with the file")
+    parser.add_argument("--file-size", type=int, default=4 << 20, help="bytes")
+    parser.add_argument("--piece-size", type=int, default=1 << 16, help="bytes")
+    parser.add_argument("--preferred", type=int, default=3, help="NumberOfPreferredNeighbors")
+    parser.add_argument("--unchoking-interval", type=int, default=1, help="seconds")
+    parser.add_argument("--optimistic-interval", type=int, default=2, help="seconds")
+    parser.add_argument("--set", type=_common_option, action="append", default=[], metavar="KEY=VALUE",
+                        help="any other Common.cfg key, e.g. --set BlockSize=4096 (repeatable)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run every peer on the asyncio engine")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds before the run is given up")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder (files, configuration, logs)")
+    args = parser.parse_args()
+    if not 1 <= args.seeders <= args.peers:
+        parser.error("--seeders must be between 1 and --peers")
+
+    base_dir = tempfile.mkdtemp(prefix="p2p-bench-")
+    try:
+        report = run_swarm(args, base_dir)
+    finally:
+        if args.keep:
+            print(f"kept {base_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    if args.keep:
+        report["base_dir"] = base_dir
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(0 if report["complete"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,57 @@
-from typing import List
+import contextlib
+import threading
+from typing import Iterator, List, Optional
+
+# bit offsets (0 = most significant) set in each byte value
+_BYTE_BITS = [tuple(b for b in range(8) if v & (0x80 >> b)) for v in range(256)]
+
+# yields the index of every set bit in data (bit 0 = high bit of byte 0), skipping zero words 64 bits at a time;
+# with first_word, the scan starts at that word and wraps around to the ones before it
+def _iter_set_bits(data: bytes, first_word: int = 0) -> Iterator[int]:
+    padded = bytes(data) + bytes(-len(data) % 8)
+    words = memoryview(padded).cast("Q")
+    for k in range(len(words)):
+        w = (first_word + k) % len(words)
+        if not words[w]:
+            continue
+        for byte_index in range(w * 8, w * 8 + 8):
+            byte = padded[byte_index]
+            if byte:
+                for b in _BYTE_BITS[byte]:
+                    yield byte_index * 8 + b
+
+# stands in for the lock of an unlocked Bitfield
+_NO_LOCK = contextlib.nullcontext()
 
 class Bitfield:
     # 1 if has piece, 0 if missing
-    def __init__(self, num_pieces: int):
+    # bits are kept in wire order; whole-field operations treat them as one big-endian integer
+    # only our own bitfield is locked (locked=True), it is set from several threads; a neighbor's remote bitfield
+    # is changed only through its share's PiecePicker, under the picker's lock
+    __slots__ = ("num_pieces", "bits", "count", "_lock")
+
+    def __init__(self, num_pieces: int, locked: bool = False):
         self.num_pieces = num_pieces
         # required bytes = (n + 7) // 8
         self.bits = bytearray((num_pieces + 7) // 8)
+        # number of pieces set, kept up to date so completion checks are O(1)
+        self.count = 0
+        self._lock = threading.Lock() if locked else _NO_LOCK
 
-    # set bit at index to 1 
+    # set bit at index to 1
     def set_piece(self, index: int):
-        self.bits[index // 8] |= 1 << (7 - (index % 8))
+        mask = 1 << (7 - (index % 8))
+        with self._lock:
+            if not self.bits[index // 8] & mask:
+                self.bits[index // 8] |= mask
+                self.count += 1
+
+    # sets every piece (peer starts with the whole file)
+    def set_all(self):
+        with self._lock:
+            self.bits = bytearray(b'\xff' * len(self.bits))
+            self._clear_spare_bits()
+            self.count = self.num_pieces
 
     # returns true if bit at index is 1
     def has_piece(self, index: int) -> bool:
@@ -22,19 +64,51 @@ class Bitfield:
     # converts incoming data to bytes
     def from_bytes(self, data: bytes):
         needed = (self.num_pieces + 7) // 8
-        self.bits = bytearray(data[:needed].ljust(needed, b'\x00'))
+        with self._lock:
+            self.bits = bytearray(bytes(data[:needed]).ljust(needed, b'\x00'))
+            self._clear_spare_bits()
+            self.count = self.to_int().bit_count()
+
+    # spare bits past num_pieces must stay 0 so counts and scans ignore them
+    def _clear_spare_bits(self):
+        spare = len(self.bits) * 8 - self.num_pieces
+        if spare:
+            self.bits[-1] &= (0xff << spare) & 0xff
+
+    # whole field as one integer, piece 0 is the most significant bit
+    def to_int(self) -> int:
+        return int.from_bytes(self.bits, "big")
+
+    # pieces we have that other does not (AND-NOT over whole words)
+    def difference(self, other: 'Bitfield') -> bytes:
+        diff = self.to_int() & ~other.to_int()
+        return diff.to_bytes(len(self.bits), "big")
+
+    # index of every piece we have
+    def iter_pieces(self) -> Iterator[int]:
+        return _iter_set_bits(self.bits)
 
     # returns arr of pieces that we dont have but other peer has
     def missing_pieces_from(self, other: 'Bitfield') -> List[int]:
-        missing = []
-        for i in range(self.num_pieces):
-            if not self.has_piece(i) and other.has_piece(i):
-                missing.append(i)
-        return missing
+        return list(_iter_set_bits(other.difference(self)))
+
+    # same pieces as missing_pieces_from, found a word at a time as they are consumed, starting at the 64-piece
+    # word first_word and wrapping around (so callers that stop early do not always favor the first pieces)
+    def iter_missing_from(self, other: 'Bitfield', first_word: int = 0) -> Iterator[int]:
+        return _iter_set_bits(other.difference(self), first_word)
+
+    # true if other has a piece we do not (one AND-NOT over the whole field, no list)
+    def missing_any_from(self, other: 'Bitfield') -> bool:
+        return other.to_int() & ~self.to_int() != 0
+
+    # returns the lowest piece index we do not have, None if complete
+    def first_missing(self) -> Optional[int]:
+        if self.count == self.num_pieces:
+            return None
+        width = len(self.bits) * 8
+        inverted = ~self.to_int() & ((1 << width) - 1)
+        return width - inverted.bit_length()
 
     # returns true if we have the full file
     def is_complete(self) -> bool:
-        for i in range(self.num_pieces):
-            if not self.has_piece(i):
-                return False
-        return True
\ No newline at end of file
+        return self.count == self.num_pieces
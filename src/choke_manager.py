@@ -1,124 +1,189 @@
 import random
 import threading
-import time
 from logger import log
-from message_handler import send_message, UNCHOKE, CHOKE
+from message_handler import UNCHOKE, CHOKE
+from timer_wheel import TimerWheel
+
+# resolution (seconds) of the choking timers
+CHOKE_TICK = 0.05
 
 class ChokeManager:
-    def __init__(self, peer_id, config, peers_state, conn_map, have_complete_fn):
+    """
+    Picks the neighbors we upload to: every unchoking interval the best preferred neighbors, every optimistic
+    interval one random choked and interested neighbor. Both rounds are timers on one TimerWheel, due at fixed
+    times whatever they take. Events between rounds (a preferred neighbor disconnecting or losing interest,
+    a neighbor becoming interested while a slot is free) reschedule a selection right away instead of waiting
+    for the next round. Selections decide under the lock and send after releasing it. The rounds run on the
+    wheel that also fires the completion timer, so send_fn must never wait: the threaded engine's PeerWriter.send
+    queues (closing a peer too far behind instead of waiting for it) and the asyncio engine writes into the
+    transport's buffer.
+    """
+    def __init__(self, peer_id, config, peers_state, conn_map, have_complete_fn, send_fn):
         """
         have_complete_fn: callable that returns True when this peer has full file.
+        send_fn: callable(peer_id, msg_type) that queues a message to a connected peer without blocking.
         """
         self.peer_id = peer_id
         self.config = config
         self.peers_state = peers_state
         self.conn_map = conn_map
         self.have_complete_fn = have_complete_fn
+        self.send_fn = send_fn
         self.running = True
         self.lock = threading.Lock()
         self.preferred_neighbors = set()
         self.optimistic_neighbor = None
+        # managers of the other shared files, their selections run on this manager's timers (see link)
+        self.linked = []
+        self.wheel = TimerWheel(CHOKE_TICK, on_error=self._on_error)
+        self.stopped = threading.Event()
+        # a selection scheduled by an event and not run yet, so bursts of events cause one selection
+        self.preferred_pending = False
+        self.optimistic_pending = False
 
-    # starts timers for normal unchoking and optimistic unchoking
-    def start(self):
-        threading.Thread(target=self._choke_unchoke_cycle, daemon=True).start()
-        threading.Thread(target=self._optimistic_unchoke_cycle, daemon=True).start()
+    # schedules both rounds; with drive the wheel runs on a thread of its own, otherwise the engine advances it
+    def start(self, drive: bool = True):
+        self.wheel.every(self.config.unchoking_interval, self.run_preferred_round)
+        self.wheel.every(self.config.opt_unchoking_interval, self.run_optimistic_round)
+        if drive:
+            threading.Thread(target=self.wheel.run, args=(self.stopped,), daemon=True).start()
 
     # stops
     def stop(self):
-        self.running = False
-
-    # for normal choke/unchoke
-    def _choke_unchoke_cycle(self):
-        # while program is running
-        while self.running:
-            time.sleep(self.config.unchoking_interval)
-            # attempt to select new preferred neighbors
+        for manager in [self] + self.linked:
+            manager.running = False
+        self.stopped.set()
+        self.wheel.wake()
+
+    # other (another file's manager) makes its selections on our timers
+    def link(self, other):
+        self.linked.append(other)
+        other.wheel = self.wheel
+
+    def _on_error(self, e):
+        log(self.peer_id, f"failed a choking round: {e!r}")
+
+    # remote_id disconnected: it is no longer unchoked by us, and its slot goes to someone else now
+    def forget(self, remote_id):
+        with self.lock:
+            was_preferred = remote_id in self.preferred_neighbors
+            was_optimistic = self.optimistic_neighbor == remote_id
+            self.preferred_neighbors.discard(remote_id)
+            if was_optimistic:
+                self.optimistic_neighbor = None
+        if was_preferred:
+            self._reselect_preferred()
+        if was_optimistic:
+            self._reselect_optimistic()
+
+    # remote_id sent INTERESTED or NOT_INTERESTED
+    def on_interest(self, remote_id, interested: bool):
+        with self.lock:
+            if interested:
+                # a free preferred slot is filled at once
+                changed = len(self.preferred_neighbors) < self.config.num_pref_neighbors \
+                    and remote_id not in self.preferred_neighbors
+                optimistic = False
+            else:
+                changed = remote_id in self.preferred_neighbors
+                optimistic = self.optimistic_neighbor == remote_id
+        if changed:
+            self._reselect_preferred()
+        if optimistic:
+            self._reselect_optimistic()
+
+    def _reselect_preferred(self):
+        with self.lock:
+            if self.preferred_pending or not self.running:
+                return
+            self.preferred_pending = True
+        self.wheel.call_later(0, self._select_preferred_neighbors)
+
+    def _reselect_optimistic(self):
+        with self.lock:
+            if self.optimistic_pending or not self.running:
+                return
+            self.optimistic_pending = True
+        self.wheel.call_later(0, self._select_optimistic_neighbor)
+
+    # one preferred-neighbor selection for this file and every linked one
+    def run_preferred_round(self):
+        for manager in [self] + self.linked:
             try:
-                self._select_preferred_neighbors()
-            except Exception:
-                continue
-
-    # optimistic unchoking
-    def _optimistic_unchoke_cycle(self):
-        while self.running:
-            time.sleep(self.config.opt_unchoking_interval)
-            # selects optimistic neighbor (randomly)
+                manager._select_preferred_neighbors()
+            except Exception as e:
+                self._on_error(e)
+
+    # one optimistic selection for this file and every linked one
+    def run_optimistic_round(self):
+        for manager in [self] + self.linked:
             try:
-                self._select_optimistic_neighbor()
-            except Exception:
-                continue
+                manager._select_optimistic_neighbor()
+            except Exception as e:
+                self._on_error(e)
 
     # selects preferred neighbors for choke/unchoke cycle
     def _select_preferred_neighbors(self):
+        # (peer, CHOKE or UNCHOKE) sent once the lock is released
+        sends = []
         with self.lock:
+            self.preferred_pending = False
             # consider only peers that are connected and interested
-            available = [(pid, ps.download_rate) for pid, ps in self.peers_state.items() if ps.is_interested and pid in self.conn_map]
+            available = [pid for pid, ps in list(self.peers_state.items()) if ps.is_interested and pid in self.conn_map]
             # if no one else is interested, preferences are reset
             if not available:
-                for pid in list(self.preferred_neighbors):
-                    if pid != self.optimistic_neighbor and pid in self.conn_map:
-                        try:
-                            send_message(self.conn_map[pid], CHOKE)
-                        except Exception:
-                            pass
-                self.preferred_neighbors.clear()
-                log(self.peer_id, "has the preferred neighbors .")
-                return
+                for pid in self.preferred_neighbors:
+                    if pid != self.optimistic_neighbor:
+                        sends.append((pid, CHOKE))
+                self.preferred_neighbors = set()
+                new_set = set()
+            else:
+                new_set = self._choose_preferred(available)
+                # unchoke newly preferred neighbors
+                for pid in new_set:
+                    if pid not in self.preferred_neighbors:
+                        sends.append((pid, UNCHOKE))
+                # choke those that were preferred before but not anymore (and not optimistic)
+                for pid in self.preferred_neighbors:
+                    if pid not in new_set and pid != self.optimistic_neighbor:
+                        sends.append((pid, CHOKE))
+                self.preferred_neighbors = new_set
+        for pid, msg_type in sends:
+            self.send_fn(pid, msg_type)
+        log(self.peer_id, f"has the preferred neighbors {', '.join(map(str, sorted(new_set)))}.")
 
-            k = self.config.num_pref_neighbors
+    # the num_pref_neighbors best of available, called under the lock
+    def _choose_preferred(self, available):
+        k = self.config.num_pref_neighbors
 
-            # if we have the complete file, choose randomly among interested, else: choose highest download rate
-            if self.have_complete_fn():
-                chosen = [pid for pid, _ in random.sample(available, min(k, len(available)))]
-            else:
-                available.sort(key=lambda x: x[1], reverse=True)
-                chosen = [pid for pid, _ in available[:k]]
-
-            new_set = set(chosen)
-
-            # unchoke newly preferred neighbors
-            for pid in new_set:
-                if pid not in self.preferred_neighbors:
-                    if pid in self.conn_map:
-                        try:
-                            send_message(self.conn_map[pid], UNCHOKE)
-                        except Exception:
-                            pass
-
-            # choke those that were preferred before but not anymore (and not optimistic)
-            for pid in list(self.preferred_neighbors):
-                if pid not in new_set and pid != self.optimistic_neighbor:
-                    if pid in self.conn_map:
-                        try:
-                            send_message(self.conn_map[pid], CHOKE)
-                        except Exception:
-                            pass
-
-            self.preferred_neighbors = new_set
-            log(self.peer_id, f"has the preferred neighbors {', '.join(map(str, sorted(list(new_set))))}.")
+        # while leeching prefer the peers we download from fastest, once we have the complete file
+        # the peers we upload to fastest (rates over the last unchoking interval, ties broken randomly)
+        if self.have_complete_fn():
+            rates = {pid: self.peers_state[pid].upload_rate for pid in available}
+        else:
+            rates = {pid: self.peers_state[pid].download_rate for pid in available}
+        random.shuffle(available)
+        available.sort(key=rates.get, reverse=True)
+        return set(available[:k])
 
     # randomly select peer new peer (MUST BE CHOKED, INTERETESTED)
     def _select_optimistic_neighbor(self):
+        sends = []
         with self.lock:
+            self.optimistic_pending = False
             if(self.optimistic_neighbor is not None 
                and self.optimistic_neighbor not in self.preferred_neighbors 
                and self.optimistic_neighbor in self.conn_map
             ):
-                try:
-                    send_message(self.conn_map[self.optimistic_neighbor], CHOKE)
-                except Exception:
-                    pass
+                sends.append((self.optimistic_neighbor, CHOKE))
                 
             # pick choked & interested peers
-            candidates = [pid for pid, ps in self.peers_state.items() if ps.is_interested and ps.is_choked and pid in self.conn_map]
-            if not candidates:
-                return
-            selected = random.choice(candidates)
-            if selected in self.conn_map:
-                try:
-                    send_message(self.conn_map[selected], UNCHOKE)
-                except Exception:
-                    pass
-            self.optimistic_neighbor = selected
+            candidates = [pid for pid, ps in list(self.peers_state.items()) if ps.is_interested and ps.is_choked and pid in self.conn_map]
+            selected = random.choice(candidates) if candidates else None
+            if selected is not None:
+                sends.append((selected, UNCHOKE))
+                self.optimistic_neighbor = selected
+        for pid, msg_type in sends:
+            self.send_fn(pid, msg_type)
+        if selected is not None:
             log(self.peer_id, f"has the optimistically unchoked neighbor {selected}.")
@@ -7,6 +7,10 @@ CONFIG_DIR = os.path.join(BASE_DIR, "..", "configuration")
 
 COMMON_PATH = os.path.abspath(os.path.join(CONFIG_DIR, "Common.cfg"))
 PEERINFO_PATH = os.path.abspath(os.path.join(CONFIG_DIR, "PeerInfo.cfg"))
+FILES_PATH = os.path.abspath(os.path.join(CONFIG_DIR, "Files.cfg"))
+
+# biggest block a neighbor may ask for (larger REQUEST_BLOCKs are refused), so the largest BlockSize Common.cfg may set
+MAX_BLOCK_SIZE = 128 * 1024
 
 # reads Common.cfg
 @dataclass
@@ -17,31 +21,79 @@ class Common:
     file_name: str
     file_size: int
     piece_size: int
+    # optional tuning keys, defaults are used when they are not in Common.cfg
+    min_request_window: int = 2
+    max_request_window: int = 32
+    # endgame starts once this many pieces or fewer are missing: they are requested from several neighbors at once
+    endgame_threshold: int = 4
+    # piece hash manifest in the configuration folder, pieces are verified when it is set
+    piece_hash_file: str = ""
+    # 1: re-hash the pieces a restarted leecher's journal claims before trusting them
+    resume_verify: int = 0
+    # pieces bigger than this move in blocks of this size with peers that support it
+    block_size: int = 16384
+    # milliseconds HAVE announcements are collected before they go out together, 0 sends each right away
+    have_batch_interval: int = 50
+    # bandwidth caps in bytes/sec, 0 = no cap (per-peer caps apply to each neighbor separately)
+    max_upload_rate: int = 0
+    max_download_rate: int = 0
+    max_peer_upload_rate: int = 0
+    max_peer_download_rate: int = 0
+    # most neighbors kept connected at once, 0 = every peer in PeerInfo.cfg
+    max_connections: int = 0
+    # seconds between drops of the least useful neighbor for a fresh one (with max_connections), 0 = never
+    neighbor_rotation_interval: int = 30
+
+# Common.cfg key -> (Common field, type)
+COMMON_KEYS = {
+    "NumberOfPreferredNeighbors": ("num_pref_neighbors", int),
+    "UnchokingInterval": ("unchoking_interval", int),
+    "OptimisticUnchokingInterval": ("opt_unchoking_interval", int),
+    "FileName": ("file_name", str),
+    "FileSize": ("file_size", int),
+    "PieceSize": ("piece_size", int),
+    "MinRequestWindow": ("min_request_window", int),
+    "MaxRequestWindow": ("max_request_window", int),
+    "EndgameThreshold": ("endgame_threshold", int),
+    "PieceHashFile": ("piece_hash_file", str),
+    "ResumeVerify": ("resume_verify", int),
+    "BlockSize": ("block_size", int),
+    "HaveBatchInterval": ("have_batch_interval", int),
+    "MaxUploadRate": ("max_upload_rate", int),
+    "MaxDownloadRate": ("max_download_rate", int),
+    "MaxPeerUploadRate": ("max_peer_upload_rate", int),
+    "MaxPeerDownloadRate": ("max_peer_download_rate", int),
+    "MaxConnections": ("max_connections", int),
+    "NeighborRotationInterval": ("neighbor_rotation_interval", int),
+}
+REQUIRED_COMMON_KEYS = ["NumberOfPreferredNeighbors", "UnchokingInterval", "OptimisticUnchokingInterval",
+                        "FileName", "FileSize", "PieceSize"]
 
-def parse_config() -> Common:
-    if not os.path.exists(COMMON_PATH):
-        raise FileNotFoundError(f"Common.cfg not found at {COMMON_PATH}")
+def parse_config(path: str = COMMON_PATH) -> Common:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Common.cfg not found at {path}")
 
-    values = []
-    with open(COMMON_PATH, "r", encoding="utf-8") as f:
+    values = {}
+    with open(path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
             key, value = line.split()
-            values.append(value)
+            values[key] = value
 
-    if len(values) < 6:
+    if any(key not in values for key in REQUIRED_COMMON_KEYS):
         raise ValueError("Common.cfg is missing required fields")
 
-    return Common(
-        num_pref_neighbors=int(values[0]),
-        unchoking_interval=int(values[1]),
-        opt_unchoking_interval=int(values[2]),
-        file_name=values[3],
-        file_size=int(values[4]),
-        piece_size=int(values[5])
-    )
+    fields = {}
+    for key, value in values.items():
+        if key in COMMON_KEYS:
+            name, cast = COMMON_KEYS[key]
+            fields[name] = cast(value)
+    common = Common(**fields)
+    if not 0 < common.block_size <= MAX_BLOCK_SIZE:
+        raise ValueError(f"BlockSize in Common.cfg must be between 1 and {MAX_BLOCK_SIZE}, got {common.block_size}")
+    return common
     
 # reads PeerInfo.cfg
 @dataclass
@@ -51,12 +103,12 @@ class Peer:
     listening_port: int
     has_file: bool
 
-def parse_peer_info():
-    if not os.path.exists(PEERINFO_PATH):
-        raise FileNotFoundError(f"PeerInfo.cfg not found at {PEERINFO_PATH}")
+def parse_peer_info(path: str = PEERINFO_PATH):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"PeerInfo.cfg not found at {path}")
 
     peers_list = []
-    with open(PEERINFO_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
@@ -73,6 +125,26 @@ def parse_peer_info():
 
     return peers_list
 
+# reads Files.cfg (optional): more files shared next to FileName, one "<FileName> <FileSize>" per line
+@dataclass
+class SharedFile:
+    file_name: str
+    file_size: int
+
+def parse_files(path: str = FILES_PATH):
+    if not os.path.exists(path):
+        return []
+
+    files = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            name, size = line.split()
+            files.append(SharedFile(file_name=name, file_size=int(size)))
+    return files
+
 def main():
     test = parse_config()
     test2 = parse_peer_info()
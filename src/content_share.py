@@ -0,0 +1,376 @@
+import os
+import struct
+import threading
+import time
+from messages import FEATURE_MULTI_HAVE, FEATURE_MULTI_CONTENT
+from config import MAX_BLOCK_SIZE
+from message_handler import BITFIELD, HAVE, INTERESTED, NOT_INTERESTED, CHOKE, UNCHOKE, REQUEST, PIECE, CANCEL, \
+    REQUEST_BLOCK, BLOCK, HAVE_MULTI, CONTENT
+from bitfield import Bitfield
+from peer_state import PeerState
+from transfer_manager import TransferManager
+from piece_picker import PiecePicker
+from choke_manager import ChokeManager
+from logger import log
+from file_manager import FileManager
+from piece_verifier import PieceVerifier
+from journal import PieceJournal, recover_pieces
+
+class ContentShare:
+    """
+    One file a PeerProcess (the host) shares over its connections: FileName from Common.cfg (content_id None),
+    or a file listed in Files.cfg. It has its own pieces, file, journal, per-peer state, picker, transfers and
+    choke state, and handles that file's messages. Messages about a Files.cfg file travel inside CONTENT messages
+    tagged with its content id, and only to peers whose handshake offers FEATURE_MULTI_CONTENT.
+    It starts no threads: the host's listeners, writers, download loops, choke timers and HAVE batches serve every file.
+    """
+    def __init__(self, host, config, has_file: bool, digests=None, limiter=None, content_id: int = None):
+        self.host = host
+        self.config = config
+        self.content_id = content_id
+        self.peer_id = host.peer_id
+        self.metrics = host.metrics
+        total_pieces = (config.file_size + config.piece_size - 1) // config.piece_size
+
+        # bitfield and file manager
+        self.bitfield = Bitfield(total_pieces, locked=True)
+        file_path = f"peer_{self.peer_id}/{config.file_name}"
+        resuming = not has_file and os.path.exists(file_path)
+        # file is opened once and kept open; ensure file exists if we have it (user should place it), but leave as-is if missing
+        self.file_mgr = FileManager(file_path, config.piece_size, config.file_size, create=not has_file,
+                                    metrics=self.metrics)
+        if has_file:
+            self.bitfield.set_all()
+
+        # leechers journal every piece they write, so a restart keeps what is already on disk
+        self.journal = None
+        if not has_file:
+            self.journal = PieceJournal(file_path + ".journal", total_pieces, config.piece_size, config.file_size,
+                                        store_hashes=bool(config.resume_verify) and digests is None)
+            if resuming:
+                for i in recover_pieces(self.journal, self.file_mgr, digests, verify=bool(config.resume_verify)):
+                    self.bitfield.set_piece(i)
+            else:
+                self.journal.rewrite({})
+
+        # per-peer state, created by _peer_state when a peer first connects
+        self.peers_state = {}
+        # remote_id -> piece indices to announce with the next HAVE batch
+        self.pending_haves = {}
+        # remote_id -> piece indices not announced to it yet because it had them already (only peers that take
+        # HAVE_MULTI are spared, they get them all in one message once we are complete)
+        self.spared_haves = {}
+        self.have_lock = threading.Lock()
+
+        # other peers not known to hold the whole file yet, the swarm is complete once it is empty (and we are done);
+        # FileName waits for every listed peer, a Files.cfg file only for the peers that can talk about it
+        # (filled by _track_peer as they connect)
+        self.incomplete_peers = set()
+        if content_id is None:
+            self.incomplete_peers = {p.peer_ID for p in host.peers if p.peer_ID != self.peer_id}
+        # monotonic time the first piece of this file was completed
+        self.first_piece_at = None
+
+        # Pass a callback so choke manager can check whether local copy is complete
+        self.choke_manager = ChokeManager(self.peer_id, config, self.peers_state, host.conn_map,
+                                          lambda: self.bitfield.is_complete(), self._send_choke)
+        self.verifier = None
+        if digests is not None:
+            self.verifier = PieceVerifier(digests, self._store_piece, self._on_piece_verified, self._on_piece_corrupt,
+                                          read_fn=self.file_mgr.get_piece)
+
+        self.picker = PiecePicker(self.bitfield, config.endgame_threshold, config.piece_size, config.file_size,
+                                  config.block_size)
+        self.transfer_mgr = TransferManager(self.peer_id, config, self.bitfield, self.file_mgr, self.peers_state,
+                                            host.conn_map, self, self.picker, limiter, self.metrics)
+        # the PIECE/BLOCK messages we send for a Files.cfg file go inside CONTENT messages
+        self.transfer_mgr.content_id = content_id
+
+    # queues a message about this file to a connected peer, returns False if it could not be queued
+    def _send_to(self, remote_id: int, msg_type: int, payload: bytes = b"") -> bool:
+        if self.content_id is None:
+            return self.host._send_to(remote_id, msg_type, payload)
+        ps = self.peers_state.get(remote_id)
+        if ps is None or not ps.features & FEATURE_MULTI_CONTENT:
+            return False
+        return self.host._send_to(remote_id, CONTENT, struct.pack("!IB", self.content_id, msg_type) + bytes(payload))
+
+    # CHOKE/UNCHOKE from the choke manager, counted so choking churn shows in the metrics
+    def _send_choke(self, remote_id: int, msg_type: int) -> bool:
+        self.metrics.choke_sent.labels("choke" if msg_type == CHOKE else "unchoke").inc()
+        return self._send_to(remote_id, msg_type)
+
+    # state of remote_id for this file, created the first time it connects (KeyError for peers not in PeerInfo.cfg)
+    def _peer_state(self, remote_id: int) -> PeerState:
+        ps = self.peers_state.get(remote_id)
+        if ps is None:
+            if remote_id not in self.host.peer_map or remote_id == self.peer_id:
+                raise KeyError(remote_id)
+            ps = self.peers_state.setdefault(remote_id, PeerState(remote_id, self.bitfield.num_pieces,
+                                                                  self.config.unchoking_interval))
+        return ps
+
+    # remote_id finished its handshake: it is a neighbor for this file, unless this is a Files.cfg file and it cannot
+    # talk about it (such peers do not hold up the swarm's completion, the host's own file still waits for them)
+    def _track_peer(self, remote_id: int, ps: PeerState):
+        if self.content_id is not None and not ps.features & FEATURE_MULTI_CONTENT:
+            return
+        self.picker.add_neighbor(remote_id)
+        if self.content_id is not None and not ps.remote_complete:
+            self.incomplete_peers.add(remote_id)
+
+    # sends bitfield if we have any of the file pieces
+    def _send_our_bitfield_if_any(self, remote_id: int):
+        # if any bit isnt 0
+        if self.bitfield.count > 0:
+            if self._send_to(remote_id, BITFIELD, self.bitfield.to_bytes()):
+                log(self.peer_id, f"sent the 'bitfield' message to {remote_id}.")
+
+    # drops what the connection to remote_id was holding
+    def _on_disconnect(self, remote_id: int):
+        self.transfer_mgr.release(remote_id)
+        self.transfer_mgr.clear_uploads(remote_id)
+        ps = self.peers_state[remote_id]
+        # the next connection starts from its own BITFIELD and HAVEs: a HAVE landing on the old bits would be
+        # counted in availability once but subtracted with all of them on the next disconnect
+        self.picker.remove_peer(remote_id, ps.remote_bitfield, clear=True)
+        # a new connection starts out choked and not interested both ways
+        ps.is_choked = True
+        ps.is_interested = False
+        ps.our_interest = False
+        self.choke_manager.forget(remote_id)
+        # the next connection starts with our BITFIELD, which covers them
+        with self.have_lock:
+            self.spared_haves.pop(remote_id, None)
+
+    # handles one message about this file from remote_id, conn is whatever the engine reads/writes that peer with
+    def _handle_message(self, remote_id: int, conn, msg_type: int, payload: bytes):
+        ps = self.peers_state[remote_id]
+        if msg_type == BITFIELD:
+            self.picker.add_peer(remote_id, ps.remote_bitfield, payload)
+            log(self.peer_id, f"received the 'bitfield' message from {remote_id}.")
+            self._on_remote_progress(remote_id, ps)
+            self._evaluate_interest(remote_id)
+
+        elif msg_type == HAVE:
+            index = int.from_bytes(payload[:4], "big")
+            self._on_have(remote_id, [index])
+            log(self.peer_id, f"received the 'have' message from {remote_id} for the piece {index}.")
+            self._evaluate_interest(remote_id)
+
+        elif msg_type == HAVE_MULTI:
+            indices = struct.unpack(f"!{len(payload) // 4}I", payload[:len(payload) // 4 * 4])
+            self._on_have(remote_id, indices)
+            log(self.peer_id, f"received the 'have' message from {remote_id} for the pieces {', '.join(map(str, indices))}.")
+            self._evaluate_interest(remote_id)
+
+        elif msg_type == INTERESTED:
+            ps.is_interested = True
+            log(self.peer_id, f"received the 'interested' message from {remote_id}.")
+            self.choke_manager.on_interest(remote_id, True)
+
+        elif msg_type == NOT_INTERESTED:
+            ps.is_interested = False
+            log(self.peer_id, f"received the 'not interested' message from {remote_id}.")
+            self.choke_manager.on_interest(remote_id, False)
+
+        elif msg_type == CHOKE:
+            ps.is_choked = True
+            self.metrics.choke_received.labels("choke").inc()
+            log(self.peer_id, f"is choked by {remote_id}.")
+            self.transfer_mgr.release(remote_id)
+
+        elif msg_type == UNCHOKE:
+            ps.is_choked = False
+            self.metrics.choke_received.labels("unchoke").inc()
+            log(self.peer_id, f"is unchoked by {remote_id}.")
+            self.host._start_download(remote_id)
+            self.transfer_mgr.wake(remote_id)
+
+        elif msg_type == REQUEST:
+            index = int.from_bytes(payload[:4], "big")
+            if self.bitfield.has_piece(index):
+                self.transfer_mgr.queue_request(remote_id, index)
+                self.host._start_upload(remote_id, conn)
+
+        elif msg_type == REQUEST_BLOCK:
+            index, offset, length = struct.unpack_from("!III", payload)
+            if not 0 < length <= MAX_BLOCK_SIZE:
+                log(self.peer_id, f"refused the request from {remote_id} for {length} bytes of piece {index}, "
+                                  f"blocks are at most {MAX_BLOCK_SIZE} bytes.")
+            elif self.bitfield.has_piece(index):
+                self.transfer_mgr.queue_request(remote_id, index, offset, length)
+                self.host._start_upload(remote_id, conn)
+
+        elif msg_type == CANCEL:
+            index = int.from_bytes(payload[:4], "big")
+            if len(payload) >= 12:
+                offset, length = struct.unpack_from("!II", payload, 4)
+                self.transfer_mgr.cancel_request(remote_id, index, offset, length)
+                log(self.peer_id, f"received the 'cancel' message from {remote_id} for block {offset} of piece {index}.")
+            else:
+                self.transfer_mgr.cancel_request(remote_id, index)
+                log(self.peer_id, f"received the 'cancel' message from {remote_id} for the piece {index}.")
+
+        elif msg_type == PIECE:
+            piece_index = int.from_bytes(payload[:4], "big")
+            piece_data = payload[4:]
+            ps.update_download(len(piece_data))
+            self.metrics.bytes_received.labels(remote_id).inc(len(piece_data))
+            # late endgame duplicates, pieces we have and requests we stopped waiting for are dropped
+            if not self.transfer_mgr.accept_piece(remote_id, piece_index):
+                return
+            if self.verifier is None:
+                self._store_piece(piece_index, piece_data)
+                self._on_piece_done(remote_id, piece_index)
+            else:
+                # copy: payload is a view into the receive buffer and the hash pool checks it later
+                self.verifier.submit(remote_id, piece_index, bytes(piece_data))
+
+        elif msg_type == BLOCK:
+            piece_index, offset = struct.unpack_from("!II", payload)
+            block = payload[8:]
+            ps.update_download(len(block))
+            self.metrics.bytes_received.labels(remote_id).inc(len(block))
+            self.metrics.blocks_received.labels(remote_id).inc()
+            # blocks go straight to disk, the piece counts once all of them are there
+            if self.picker.wants_block(piece_index, offset, len(block)):
+                self.file_mgr.write_piece(piece_index, block, offset)
+                if self.transfer_mgr.on_block_received(remote_id, piece_index, offset, len(block)):
+                    self._on_blocks_complete(remote_id, piece_index)
+            else:
+                # late endgame duplicate or a block we never asked for
+                self.transfer_mgr.drop_block(remote_id, piece_index, offset)
+
+        else:
+            pass
+
+    # remote_id announced it now has these pieces
+    def _on_have(self, remote_id: int, indices):
+        ps = self.peers_state[remote_id]
+        for index in indices:
+            if index < ps.remote_bitfield.num_pieces:
+                self.picker.add_have(remote_id, index, ps.remote_bitfield)
+        self._on_remote_progress(remote_id, ps)
+
+    # remote_id told us about new pieces: it may have just completed (its bitfield counts its pieces as they come)
+    def _on_remote_progress(self, remote_id: int, ps: PeerState):
+        if ps.remote_bitfield.is_complete():
+            ps.remote_complete = True
+            self.incomplete_peers.discard(remote_id)
+        self.host._check_completion()
+
+    # writes an accepted piece and journals it once the data is written (on_disk: assembled from blocks already)
+    def _store_piece(self, piece_index: int, data, on_disk: bool = False):
+        if not on_disk:
+            self.file_mgr.write_piece(piece_index, data)
+        if self.journal is not None:
+            self.journal.record(piece_index, data)
+
+    # every block of piece_index is on disk, verify it (reading it back) if we have a manifest
+    def _on_blocks_complete(self, remote_id: int, piece_index: int):
+        if self.verifier is not None:
+            self.verifier.submit(remote_id, piece_index)
+            return
+        if self.journal is not None:
+            # the journal only needs the data when it records hashes
+            self.journal.record(piece_index, self.file_mgr.get_piece(piece_index) if self.journal.store_hashes else b"")
+        self._on_piece_done(remote_id, piece_index)
+
+    # piece is on disk (and verified if we have a manifest): mark it and announce it
+    def _on_piece_done(self, remote_id: int, piece_index: int):
+        if self.first_piece_at is None:
+            self.first_piece_at = time.monotonic()
+        self.bitfield.set_piece(piece_index)
+        self.transfer_mgr.on_piece_received(remote_id, piece_index)
+        self.metrics.pieces_received.labels(remote_id).inc()
+        num_pieces = self.bitfield.count
+        log(self.peer_id, f"has downloaded the piece {piece_index} from {remote_id}. Now the number of pieces it has is {num_pieces}.")
+        self._announce_piece(piece_index)
+        self._evaluate_interest(remote_id)
+        if self.bitfield.is_complete():
+            self.host._check_completion()
+
+    # queues a HAVE for piece_index to every connected peer, the next _flush_haves sends them (right away if
+    # batching is off). Peers taking HAVE_MULTI that have the piece already are told later, see spared_haves
+    def _announce_piece(self, piece_index: int):
+        with self.host.conn_lock:
+            pids = list(self.host.conn_map)
+        complete = self.bitfield.is_complete()
+        with self.have_lock:
+            for pid in pids:
+                ps = self.peers_state.get(pid)
+                if ps is None:
+                    continue
+                if ps.features & FEATURE_MULTI_HAVE and ps.remote_bitfield.has_piece(piece_index):
+                    self.spared_haves.setdefault(pid, []).append(piece_index)
+                else:
+                    self.pending_haves.setdefault(pid, []).append(piece_index)
+            if complete:
+                # spared peers still have to learn we are done (they wait for everyone before shutting down);
+                # BITFIELD is only ever the first message, so they get the pieces they were spared
+                for pid, indices in self.spared_haves.items():
+                    self.pending_haves.setdefault(pid, []).extend(indices)
+                self.spared_haves = {}
+        if complete or self.config.have_batch_interval <= 0:
+            self._flush_haves()
+
+    # sends the queued announcements, one HAVE_MULTI per peer that supports it, HAVEs otherwise
+    def _flush_haves(self):
+        with self.have_lock:
+            pending, self.pending_haves = self.pending_haves, {}
+        for pid, indices in pending.items():
+            if len(indices) > 1 and self.peers_state[pid].features & FEATURE_MULTI_HAVE:
+                sent = self._send_to(pid, HAVE_MULTI, struct.pack(f"!{len(indices)}I", *indices))
+            else:
+                # queued back to back, so the writer still sends them in one go
+                sent = all([self._send_to(pid, HAVE, i.to_bytes(4, "big")) for i in indices])
+            if sent:
+                log(self.peer_id, f"sent the 'have' message to peer {pid} for the pieces {', '.join(map(str, indices))}.")
+
+    # called from the hash pool
+    def _on_piece_verified(self, remote_id: int, piece_index: int):
+        self.host._call_on_network_thread(self._on_piece_done, remote_id, piece_index)
+
+    # called from the hash pool, the piece is dropped and can be requested again
+    def _on_piece_corrupt(self, remote_id: int, piece_index: int):
+        log(self.peer_id, f"received a corrupt piece {piece_index} from {remote_id}, discarding it.")
+        self.host._call_on_network_thread(self.transfer_mgr.on_piece_rejected, remote_id, piece_index)
+
+    def _evaluate_interest(self, remote_id: int):
+        # check if any peers have pieces that we desire
+        ps = self.peers_state[remote_id]
+        with self.host.conn_lock:
+            if remote_id not in self.host.conn_map:
+                return
+        if self.bitfield.missing_any_from(ps.remote_bitfield):
+            self._send_to(remote_id, INTERESTED)
+            ps.our_interest = True
+            log(self.peer_id, f"sent the 'interested' message to {remote_id}.")
+            # remote may have pieces we can request now
+            self.transfer_mgr.wake(remote_id)
+        else:
+            self._send_to(remote_id, NOT_INTERESTED)
+            ps.our_interest = False
+            log(self.peer_id, f"sent the 'not interested' message to {remote_id}.")
+
+    # true once we and every other peer hold the whole file; with MaxConnections we cannot hear from every peer,
+    # so instead once we and every current neighbor (one at least so far) hold it
+    # (the host's _check_completion waits for that to last)
+    def _content_complete(self) -> bool:
+        if not self.bitfield.is_complete():
+            return False
+        if self.content_id is None and self.host.neighbors is not None:
+            # remote_complete stays set once a peer told us it holds every piece, so a neighbor rotated back in
+            # counts as done right away; one we never heard from does not until its BITFIELD says so
+            return bool(self.peers_state) and all(self.peers_state[pid].remote_complete
+                                                  for pid in list(self.host.conn_map) if pid in self.peers_state)
+        return not self.incomplete_peers
+
+    # stops hashing and closes the file and journal of this share
+    def _close_files(self):
+        if self.verifier is not None:
+            self.verifier.shutdown()
+        self.file_mgr.close()
+        if self.journal is not None:
+            self.journal.close()
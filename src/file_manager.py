@@ -1,9 +1,44 @@
 import os
+import threading
+import time
+
+# pread/pwrite take their own offset, so threads can share one descriptor without seeking
+_HAS_PREAD = hasattr(os, "pread") and hasattr(os, "pwrite")
 
 class FileManager:
-    def __init__(self, file_path: str, piece_size: int):
+    def __init__(self, file_path: str, piece_size: int, file_size: int, create: bool = True, metrics=None):
+        """
+        Opens file_path once and keeps it open for every piece read and write.
+        create: make the file (preallocated to file_size) if it does not exist yet.
+        A peer that should already have the file passes False, so a missing file is not replaced by zeros.
+        metrics: PeerMetrics that times piece reads and writes, None to not time them.
+        """
         self.file_path = file_path
         self.piece_size = piece_size
+        self.file_size = file_size
+        self.metrics = metrics
+        self.fd = None
+        # only needed where pread/pwrite are missing (seek + read/write must not interleave)
+        self._seek_lock = threading.Lock()
+
+        exists = os.path.exists(file_path)
+        if not exists and not create:
+            return
+        # creates dir if doesnt exist
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        self.fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        if not exists:
+            self._preallocate()
+
+    # reserves file_size bytes up front so writes never have to grow the file
+    def _preallocate(self):
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, self.file_size)
+                return
+            except OSError:
+                pass # filesystem without fallocate support
+        os.ftruncate(self.fd, self.file_size)
 
     # breaks file down into chunks, returns list filed w/ chunks
     def split_file(self) -> list:
@@ -18,29 +53,71 @@ class FileManager:
                 pieces.append(chunk)
         return pieces
 
-    def write_piece(self, index: int, data: bytes):
-        # creates dir if doesnt exist
-        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
-        # creates file if doesnt exist
-        if not os.path.exists(self.file_path):
-            with open(self.file_path, 'wb') as f:
-                pass
-        with open(self.file_path, 'r+b') as f:
-            f.seek(index * self.piece_size)
-            f.write(data)
+    # writes data at offset within the piece at index (a whole piece, or one block of it)
+    def write_piece(self, index: int, data: bytes, offset: int = 0):
+        if self.fd is None:
+            return
+        started = time.perf_counter()
+        offset += index * self.piece_size
+        view = memoryview(data)
+        while view:
+            written = self._pwrite(view, offset)
+            view = view[written:]
+            offset += written
+        if self.metrics is not None:
+            self.metrics.disk_write.observe(time.perf_counter() - started)
+
+    # byte offset and length of the piece at index (the last piece may be short)
+    def piece_range(self, index: int):
+        offset = index * self.piece_size
+        return offset, max(0, min(self.piece_size, self.file_size - offset))
 
     # retrieves piece from file at given index
     def get_piece(self, index: int) -> bytes:
-        if not os.path.exists(self.file_path):
+        if self.fd is None:
             return b""
-        with open(self.file_path, 'rb') as f:
-            # update pointer
-            f.seek(index * self.piece_size)
-            return f.read(self.piece_size)
+        started = time.perf_counter()
+        offset, length = self.piece_range(index)
+        data = self._pread(length, offset)
+        if self.metrics is not None:
+            self.metrics.disk_read.observe(time.perf_counter() - started)
+        return data
 
-    # checks if file is finished by comparing sizes
-    def is_complete(self, total_pieces: int) -> bool:
-        if not os.path.exists(self.file_path):
-            return False
-        size = os.path.getsize(self.file_path)
-        return size >= (total_pieces - 1) * self.piece_size
\ No newline at end of file
+    # reads the piece at index (from offset within it) straight into view (no intermediate bytes), returns bytes read
+    def read_into(self, index: int, view: memoryview, offset: int = 0) -> int:
+        if self.fd is None:
+            return 0
+        started = time.perf_counter()
+        start, length = self.piece_range(index)
+        view = view[:max(0, length - offset)]
+        offset += start
+        length = len(view)
+        if hasattr(os, "preadv"):
+            n = os.preadv(self.fd, [view], offset)
+        else:
+            data = self._pread(length, offset)
+            view[:len(data)] = data
+            n = len(data)
+        if self.metrics is not None:
+            self.metrics.disk_read.observe(time.perf_counter() - started)
+        return n
+
+    def _pwrite(self, data, offset: int) -> int:
+        if _HAS_PREAD:
+            return os.pwrite(self.fd, data, offset)
+        with self._seek_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.write(self.fd, data)
+
+    def _pread(self, length: int, offset: int) -> bytes:
+        if _HAS_PREAD:
+            return os.pread(self.fd, length, offset)
+        with self._seek_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    # closes the file (on shutdown)
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
@@ -0,0 +1,104 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from manifest import hash_piece
+
+# on-disk record of which pieces of a partial download are already written, so a restarted leecher resumes
+#
+# layout: header, then one fixed-size record per piece appended as it lands
+#   header: magic, version, flags, num_pieces, piece_size, file_size
+#   record: 4-byte piece index (+ 32-byte SHA-256 of the piece when FLAG_HASHES is set)
+# records are appended after the piece data is written, and a torn last record is ignored,
+# so a crash can lose at most the newest piece but never claim one that was not written
+JOURNAL_MAGIC = b"P2PJ"
+JOURNAL_VERSION = 1
+FLAG_HASHES = 1
+_HEADER = struct.Struct("!4sBBIIQ")
+_INDEX = struct.Struct("!I")
+_DIGEST_SIZE = 32
+
+class PieceJournal:
+    def __init__(self, path: str, num_pieces: int, piece_size: int, file_size: int, store_hashes: bool = False):
+        self.path = path
+        self.num_pieces = num_pieces
+        self.piece_size = piece_size
+        self.file_size = file_size
+        self.store_hashes = store_hashes
+        self.fd = None
+
+    def _header(self) -> bytes:
+        flags = FLAG_HASHES if self.store_hashes else 0
+        return _HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, flags, self.num_pieces, self.piece_size, self.file_size)
+
+    # reads the journal, returns {piece index: digest or None} for the pieces it claims
+    # (empty if there is no journal or it belongs to a different file), then opens it for appending
+    def load(self) -> dict:
+        claimed = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        if len(data) >= _HEADER.size:
+            magic, version, flags, num_pieces, piece_size, file_size = _HEADER.unpack_from(data)
+            if (magic, version, num_pieces, piece_size, file_size) == \
+                    (JOURNAL_MAGIC, JOURNAL_VERSION, self.num_pieces, self.piece_size, self.file_size):
+                has_hashes = bool(flags & FLAG_HASHES)
+                size = _INDEX.size + (_DIGEST_SIZE if has_hashes else 0)
+                # a torn last record (crash mid-append) is left out by the range
+                for pos in range(_HEADER.size, len(data) - size + 1, size):
+                    (index,) = _INDEX.unpack_from(data, pos)
+                    if index < self.num_pieces:
+                        claimed[index] = data[pos + _INDEX.size:pos + size] if has_hashes else None
+        self.rewrite(claimed)
+        return claimed
+
+    # replaces the journal with exactly the given pieces (atomic, via a temp file)
+    def rewrite(self, claimed: dict):
+        self.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self._header())
+            for index, digest in claimed.items():
+                f.write(self._record(index, digest))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | getattr(os, "O_BINARY", 0))
+
+    def _record(self, index: int, digest) -> bytes:
+        if not self.store_hashes:
+            return _INDEX.pack(index)
+        return _INDEX.pack(index) + (digest or bytes(_DIGEST_SIZE))
+
+    # appends a piece that has just been written (one small append, no fsync)
+    def record(self, index: int, data):
+        if self.fd is None:
+            return
+        os.write(self.fd, self._record(index, hash_piece(data) if self.store_hashes else None))
+
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.fsync(fd)
+            os.close(fd)
+
+# pieces a restarted leecher can keep: everything the journal claims, or with verify only the pieces whose data
+# still hashes to the manifest digest (or the digest recorded in the journal). Hashing runs on all cores.
+def recover_pieces(journal: PieceJournal, file_mgr, digests=None, verify: bool = False, workers: int = None) -> list:
+    claimed = journal.load()
+    if not verify:
+        return sorted(claimed)
+
+    def still_good(item):
+        index, recorded = item
+        expected = digests[index] if digests else recorded
+        # nothing to compare against: trust the journal
+        return expected is None or hash_piece(file_mgr.get_piece(index)) == expected
+
+    items = sorted(claimed.items())
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        good = [item for item, ok in zip(items, pool.map(still_good, items)) if ok]
+    if len(good) != len(items):
+        journal.rewrite(dict(good))
+    return [index for index, _ in good]
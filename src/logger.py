@@ -1,19 +1,123 @@
-from datetime import datetime
+import atexit
 import os
+import queue
+import threading
+import time
+
+# lines are written by one background thread in batches, log() only queues them
+# writer flushes once this many lines are waiting ...
+FLUSH_LINES = 256
+# ... or once the oldest waiting line is this many seconds old
+FLUSH_INTERVAL = 0.2
+
+_queue = queue.SimpleQueue()
+_writer = None
+_writer_lock = threading.Lock()
 
 # ensures parent directory exists (for log)
-def _ensure_log_dir():
-    parent = os.path.abspath("..")
+def _ensure_log_dir(path: str):
+    parent = os.path.dirname(path)
     if not os.path.exists(parent):
         try:
             os.makedirs(parent, exist_ok=True)
         except Exception:
             pass
 
-# logs to file for each peer 
+# logs to file for each peer
 def log(peer_id: int, message: str):
-    _ensure_log_dir()
-    time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_msg = f"[{time_str}]: Peer {peer_id} {message}\n"
-    with open(f"../log_peer_{peer_id}.log", "a") as log_file:
-        log_file.write(log_msg)
\ No newline at end of file
+    _start_writer()
+    # timestamp and file (../log_peer_<id>.log from the working directory) are taken now,
+    # formatting happens on the writer thread
+    _queue.put((time.time(), os.path.abspath(f"../log_peer_{peer_id}.log"), peer_id, message))
+
+# blocks until every line logged so far is written and flushed (call on shutdown)
+def flush(timeout: float = 5.0):
+    if _writer is None:
+        return
+    done = threading.Event()
+    _queue.put(done)
+    done.wait(timeout)
+
+# flushes and closes peer_id's log file (every peer's when None), the next line logged for it reopens it
+def close(peer_id: int = None, timeout: float = 5.0):
+    if _writer is None:
+        return
+    request = _Close(peer_id)
+    _queue.put(request)
+    request.done.wait(timeout)
+
+# queued by close(), handled by the writer thread since it owns the open files
+class _Close:
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.done = threading.Event()
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+            _writer.start()
+
+def _writer_loop():
+    # path -> (peer_id, open log file), kept open between batches
+    files = {}
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        # keep collecting until the batch is full, the interval runs out or someone asks for a flush or close
+        while len(batch) < FLUSH_LINES and not isinstance(batch[-1], (threading.Event, _Close)):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_batch(batch, files)
+
+def _write_batch(batch, files):
+    lines = {}
+    waiters = []
+    closes = []
+    for item in batch:
+        if isinstance(item, threading.Event):
+            waiters.append(item)
+            continue
+        if isinstance(item, _Close):
+            closes.append(item)
+            continue
+        when, path, peer_id, message = item
+        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when))
+        lines.setdefault((path, peer_id), []).append(f"[{time_str}]: Peer {peer_id} {message}\n")
+
+    for (path, peer_id), peer_lines in lines.items():
+        try:
+            entry = files.get(path)
+            if entry is None:
+                _ensure_log_dir(path)
+                entry = files[path] = (peer_id, open(path, "a"))
+            log_file = entry[1]
+            log_file.write("".join(peer_lines))
+            log_file.flush()
+        except Exception:
+            pass # logging must never take down the writer
+
+    # a close ends its batch, so every line logged before it is written by now
+    for request in closes:
+        for path, (peer_id, log_file) in list(files.items()):
+            if request.peer_id is None or peer_id == request.peer_id:
+                del files[path]
+                try:
+                    log_file.close()
+                except Exception:
+                    pass
+        waiters.append(request.done)
+
+    for done in waiters:
+        done.set()
+
+# lines still queued when the interpreter exits are written first
+atexit.register(flush)
@@ -0,0 +1,85 @@
+# piece hash manifest: one SHA-256 digest per piece, made by a seeder from the file and shared with the configuration
+#
+# format (text):
+#   PieceSize <bytes>
+#   FileSize <bytes>
+#   <hex digest of piece 0>
+#   <hex digest of piece 1>
+#   ...
+import argparse
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+def hash_piece(data) -> bytes:
+    return hashlib.sha256(data).digest()
+
+# hashes every piece of file_path on a pool of threads (hashlib and file reads release the GIL, so this uses all cores)
+def build_manifest(file_path: str, piece_size: int, workers: int = None) -> list:
+    file_size = os.path.getsize(file_path)
+    num_pieces = (file_size + piece_size - 1) // piece_size
+    workers = workers or os.cpu_count() or 1
+    # each task hashes a contiguous run of pieces, a few runs per worker keeps them all busy
+    per_task = max(1, -(-num_pieces // (workers * 4)))
+
+    def hash_range(first):
+        last = min(first + per_task, num_pieces)
+        digests = []
+        with open(file_path, "rb", buffering=0) as f:
+            f.seek(first * piece_size)
+            for _ in range(first, last):
+                digests.append(hash_piece(f.read(piece_size)))
+        return digests
+
+    digests = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for run in pool.map(hash_range, range(0, num_pieces, per_task)):
+            digests.extend(run)
+    return digests
+
+def write_manifest(path: str, digests: list, piece_size: int, file_size: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"PieceSize {piece_size}\n")
+        f.write(f"FileSize {file_size}\n")
+        for d in digests:
+            f.write(d.hex() + "\n")
+
+# returns (piece_size, file_size, digests)
+def load_manifest(path: str):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"piece hash manifest not found at {path}")
+    piece_size = file_size = None
+    digests = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("PieceSize "):
+                piece_size = int(line.split()[1])
+            elif line.startswith("FileSize "):
+                file_size = int(line.split()[1])
+            else:
+                digests.append(bytes.fromhex(line))
+    if piece_size is None or file_size is None:
+        raise ValueError(f"piece hash manifest {path} is missing PieceSize/FileSize")
+    return piece_size, file_size, digests
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the piece hash manifest for a file a seeder shares.")
+    parser.add_argument("file", help="the complete file, e.g. peer_1001/TheFile.dat")
+    parser.add_argument("--piece-size", type=int, help="defaults to PieceSize in Common.cfg")
+    parser.add_argument("--out", help="defaults to configuration/<file name>.sha256")
+    parser.add_argument("--workers", type=int, help="hashing threads, defaults to the number of cores")
+    args = parser.parse_args()
+
+    from config import parse_config, CONFIG_DIR
+    piece_size = args.piece_size or parse_config().piece_size
+    out = args.out or os.path.join(CONFIG_DIR, os.path.basename(args.file) + ".sha256")
+    digests = build_manifest(args.file, piece_size, args.workers)
+    write_manifest(out, digests, piece_size, os.path.getsize(args.file))
+    print(f"Wrote {len(digests)} piece hashes to {os.path.abspath(out)}")
+    print(f"Add 'PieceHashFile {os.path.basename(out)}' to Common.cfg so peers verify pieces.")
+
+if __name__ == "__main__":
+    main()
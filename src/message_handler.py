@@ -1,5 +1,7 @@
+import asyncio
 import struct
 import socket
+from messages import decode_frame
 
 CHOKE = 0
 UNCHOKE = 1
@@ -9,6 +11,11 @@ HAVE = 4
 BITFIELD = 5
 REQUEST = 6
 PIECE = 7
+CANCEL = 8
+REQUEST_BLOCK = 9
+BLOCK = 10
+HAVE_MULTI = 11
+CONTENT = 12
 
 # only n bytes are read (mostly for less)
 def _recv_all(sock: socket.socket, n: int) -> bytes:
@@ -20,11 +27,28 @@ def _recv_all(sock: socket.socket, n: int) -> bytes:
         data.extend(chunk)
     return bytes(data)
 
-# sends payload
+# sends payload in one sendall; for sockets without a PeerWriter (peers write through their PeerWriter, which
+# serializes a connection's messages)
 def send_message(sock: socket.socket, msg_type: int, payload: bytes = b""):
     length = 1 + len(payload)
     sock.sendall(struct.pack("!I", length) + bytes([msg_type]) + payload)
 
+# length and types that put a msg_type message with payload_length bytes inside a CONTENT message (10 bytes)
+def content_header(content_id: int, msg_type: int, payload_length: int) -> bytes:
+    return struct.pack("!IBIB", 1 + 5 + payload_length, CONTENT, content_id, msg_type)
+
+# length, type and piece index of a PIECE message carrying data_length bytes (9 bytes, 15 wrapped for content_id)
+def piece_header(piece_index: int, data_length: int, content_id: int = None) -> bytes:
+    if content_id is not None:
+        return content_header(content_id, PIECE, 4 + data_length) + struct.pack("!I", piece_index)
+    return struct.pack("!IBI", 1 + 4 + data_length, PIECE, piece_index)
+
+# length, type, piece index and offset of a BLOCK message carrying data_length bytes (13 bytes, 19 wrapped)
+def block_header(piece_index: int, offset: int, data_length: int, content_id: int = None) -> bytes:
+    if content_id is not None:
+        return content_header(content_id, BLOCK, 8 + data_length) + struct.pack("!II", piece_index, offset)
+    return struct.pack("!IBII", 1 + 8 + data_length, BLOCK, piece_index, offset)
+
 # receives payload from socket sock 
 def recv_message(sock: socket.socket):
     # first four bytes = header
@@ -34,4 +58,70 @@ def recv_message(sock: socket.socket):
     body = _recv_all(sock, length)
     msg_type = body[0]
     payload = body[1:]
-    return msg_type, payload
\ No newline at end of file
+    return msg_type, payload
+
+# starting size of each connection's receive buffer, grows to fit the largest frame seen
+READ_BUFFER_SIZE = 256 * 1024
+
+class FrameReader:
+    """
+    Reads framed messages from one socket with large recv_into calls into a reusable buffer.
+    Every frame already buffered is parsed before the socket is read again.
+    Payloads are memoryviews into the buffer: they are only valid until the next read_message call,
+    so copy them (bytes(payload)) if they have to outlive it.
+    """
+    def __init__(self, sock: socket.socket, buffer_size: int = READ_BUFFER_SIZE):
+        self.sock = sock
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        # buffer[start:end] is received but not yet parsed
+        self.start = 0
+        self.end = 0
+
+    # returns the next (msg_type, payload view), blocking until a whole frame is buffered
+    def read_message(self):
+        while True:
+            decoded = decode_frame(self.view, self.start, self.end)
+            if decoded is not None:
+                msg_type, payload, self.start = decoded
+                return msg_type, payload
+            self._fill()
+
+    def _fill(self):
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+        else:
+            # bytes the partial frame needs in total (just the header if its length is not in yet)
+            needed = 4
+            if pending >= 4:
+                (length,) = struct.unpack_from("!I", self.view, self.start)
+                needed = 4 + length
+            if needed > len(self.buf):
+                # frame bigger than the buffer: grow it, payloads already handed out keep the old one
+                buf = bytearray(max(needed, 2 * len(self.buf)))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+                self.start, self.end = 0, pending
+            elif self.start + needed > len(self.buf):
+                # frame does not fit behind start: move the partial frame to the front
+                self.view[:pending] = self.view[self.start:self.end]
+                self.start, self.end = 0, pending
+        n = self.sock.recv_into(self.view[self.end:])
+        if n == 0:
+            raise ConnectionError("Socket closed while receiving")
+        self.end += n
+
+# asyncio variants of the same framing, used by the asyncio engine
+
+# receives payload from an asyncio StreamReader
+async def read_message(reader: asyncio.StreamReader):
+    header = await reader.readexactly(4)
+    (length,) = struct.unpack("!I", header)
+    body = await reader.readexactly(length)
+    return body[0], body[1:]
+
+# queues payload on an asyncio StreamWriter, never blocks (drain the writer for backpressure)
+def write_message(writer: asyncio.StreamWriter, msg_type: int, payload: bytes = b""):
+    writer.write(struct.pack("!I", 1 + len(payload)) + bytes([msg_type]) + payload)
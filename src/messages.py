@@ -1,3 +1,4 @@
+import hashlib
 import struct
 # Handshake Section
 
@@ -36,6 +37,12 @@ ZERO_BYTES = b"\x00" * 10 # 10 bytes
 HANDSHAKE_FIRST = HANDSHAKE_HEADER + ZERO_BYTES # 28 bytes
 # 4 bit peer ID left
 
+# the last 4 of the zero bytes carry feature bits, a peer only uses a feature if both handshakes set it
+# (peers without extensions send all zeros, so they keep talking the base protocol)
+FEATURE_BLOCKS = 1 << 0 # REQUEST_BLOCK / BLOCK messages
+FEATURE_MULTI_HAVE = 1 << 1 # HAVE_MULTI messages
+FEATURE_MULTI_CONTENT = 1 << 2 # CONTENT messages (files besides FileName)
+
 # After handshakes, message
 # msg length (4), msg type (1), msg payload (variable size)
 
@@ -51,6 +58,11 @@ HAVE = 4
 BITFIELD = 5
 REQUEST = 6
 PIECE = 7
+CANCEL = 8
+REQUEST_BLOCK = 9
+BLOCK = 10
+HAVE_MULTI = 11
+CONTENT = 12
 
 BITFIELD = 5
 # N bytes of bitfield, bit i == 1 means that sender has piece i
@@ -64,6 +76,20 @@ REQUEST = 6 # 4-byte piece index field in payload, sent only when unchoked
 PIECE = 7 # first 4-byte piece index field in payload, then raw piece bytes (full)
 # sent only if peer is INTERESTED + UNCHOKED
 
+CANCEL = 8 # 4-byte piece index field in payload, withdraws an earlier REQUEST (endgame duplicates)
+# the receiver drops the request if the piece has not been sent yet; peers that do not know it ignore it
+# with FEATURE_BLOCKS the payload may instead be piece index, block offset, block length (4 bytes each)
+
+# only with FEATURE_BLOCKS: pieces move in blocks so big pieces do not block the connection
+REQUEST_BLOCK = 9 # piece index, block offset, block length (4 bytes each)
+BLOCK = 10 # piece index, block offset (4 bytes each), then the block bytes
+
+# only with FEATURE_MULTI_HAVE: several HAVEs in one message
+HAVE_MULTI = 11 # 4-byte piece index fields, one per piece
+
+# only with FEATURE_MULTI_CONTENT: a message about another shared file than FileName
+CONTENT = 12 # 4-byte content id, 1-byte message type, then that message's payload
+
 # Explanation for struct.pack:
 # https://docs.python.org/3/library/struct.html
 # ! = Network byte order (Big-Endian)
@@ -71,20 +97,24 @@ PIECE = 7 # first 4-byte piece index field in payload, then raw piece bytes (ful
 # Encode: Packs the peer_id as a 4-byte object
 # Decode: Unpacks the 4-byte object as a Python Integer
 
-def encode_handshake(peer_id: int) -> bytes:
-    """Return a valid 32-byte handshake message for this peer_id."""
-    return HANDSHAKE_FIRST + struct.pack("!I", peer_id)
+def encode_handshake(peer_id: int, features: int = 0) -> bytes:
+    """Return a valid 32-byte handshake message for this peer_id, advertising feature bits."""
+    return HANDSHAKE_HEADER + ZERO_BYTES[:6] + struct.pack("!II", features, peer_id)
 
 def decode_handshake(data: bytes) -> int:
     """Extract peer ID from a 32-byte handshake. Raises ValueError if invalid."""
     if len(data) != 32:
         raise ValueError("Invalid handshake length")
 
-    if data[:28] != HANDSHAKE_FIRST:
+    if data[:24] != HANDSHAKE_FIRST[:24]:
         raise ValueError("Invalid handshake header")
 
     return struct.unpack("!I", data[28:32])[0]
 
+def decode_handshake_features(data: bytes) -> int:
+    """Feature bits a (valid) handshake advertises, 0 for peers without extensions."""
+    return struct.unpack("!I", data[24:28])[0]
+
 # msg length (4), msg type (1), msg payload (variable size)
 
 def encode_message(type: int, payload: bytes=b"") -> bytes:
@@ -101,3 +131,19 @@ def decode_message(buffer: bytearray):
     payload = bytes(buffer[5:4 + length])
     del buffer[:4 + length]
     return type, payload
+
+# decodes the frame starting at view[start] without copying, view holds received bytes up to end
+# returns (type, payload memoryview, end of frame), or None if the frame is not complete yet
+def decode_frame(view: memoryview, start: int, end: int):
+    if end - start < 4:
+        return None
+    (length,) = struct.unpack_from("!I", view, start)
+    if length == 0:
+        raise ValueError("Invalid message length")
+    if end - start < 4 + length:
+        return None
+    return view[start + 4], view[start + 5:start + 4 + length], start + 4 + length
+
+def content_id(file_name: str, file_size: int) -> int:
+    """4-byte identifier of a shared file, the same on every peer that lists it."""
+    return int.from_bytes(hashlib.sha1(f"{file_name}\n{file_size}".encode()).digest()[:4], "big")
@@ -0,0 +1,280 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # observations per bucket, the last one past every bound (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    # (cumulative count per bound including +Inf, sum, count), read under the lock so they agree
+    def read(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative, running = [], 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, total, running
+
+class Metric:
+    """
+    One named metric with a series per combination of label values, labels(*values) returns that series
+    (created on first use). Hot paths keep the series they update instead of looking it up every time.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        # tuple of label values -> series
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        series = self.series.get(key)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(key, self._new_series())
+        return series
+
+    def _new_series(self):
+        return _Value()
+
+    # [(label values, series or plain value)]
+    def samples(self):
+        return list(self.series.items())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    """A value that goes up and down; with set_function its series are computed each time it is read."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, label_names=()):
+        super().__init__(name, help, label_names)
+        self.fn = None
+
+    def set(self, value):
+        self.labels().set(value)
+
+    # fn() returns {tuple of label values: value}
+    def set_function(self, fn):
+        self.fn = fn
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        try:
+            return [(tuple(str(v) for v in key), value) for key, value in self.fn().items()]
+        except Exception:
+            return [] # state changed under us, the next read gets it
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+def _label_text(names, values, extra=""):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    def __init__(self):
+        # name -> Metric, in registration order
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, label_names=()) -> Counter:
+        return self._register(Counter(name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names=()) -> Gauge:
+        return self._register(Gauge(name, help, label_names))
+
+    def histogram(self, name: str, help: str, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    # every metric in the Prometheus text exposition format
+    def render_prometheus(self) -> str:
+        lines = []
+        for m in list(self.metrics.values()):
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for values, series in sorted(m.samples()):
+                if m.kind == "histogram":
+                    cumulative, total, count = series.read()
+                    bounds = [repr(b) for b in m.buckets] + ["+Inf"]
+                    for bound, c in zip(bounds, cumulative):
+                        le = f'le="{bound}"'
+                        lines.append(f"{m.name}_bucket{_label_text(m.label_names, values, le)} {c}")
+                    lines.append(f"{m.name}_sum{_label_text(m.label_names, values)} {_number(total)}")
+                    lines.append(f"{m.name}_count{_label_text(m.label_names, values)} {count}")
+                else:
+                    value = series.value if isinstance(series, _Value) else series
+                    lines.append(f"{m.name}{_label_text(m.label_names, values)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    # every metric as plain data for JSON: name -> {type, help, samples: [{labels, value}]}
+    def snapshot(self) -> dict:
+        out = {}
+        for m in list(self.metrics.values()):
+            samples = []
+            for values, series in sorted(m.samples()):
+                labels = dict(zip(m.label_names, values))
+                if m.kind == "histogram":
+                    cumulative, total, count = series.read()
+                    bounds = [repr(b) for b in m.buckets] + ["+Inf"]
+                    value = {"count": count, "sum": total, "buckets": dict(zip(bounds, cumulative))}
+                else:
+                    value = series.value if isinstance(series, _Value) else series
+                samples.append({"labels": labels, "value": value})
+            out[m.name] = {"type": m.kind, "help": m.help, "samples": samples}
+        return out
+
+class PeerMetrics:
+    """What one peer process measures, for every file it shares."""
+    def __init__(self):
+        r = self.registry = MetricsRegistry()
+        self.bytes_received = r.counter("p2p_bytes_received_total", "Piece data received, by neighbor.", ("peer",))
+        self.bytes_sent = r.counter("p2p_bytes_sent_total", "Piece data sent, by neighbor.", ("peer",))
+        self.pieces_received = r.counter("p2p_pieces_received_total",
+                                         "Pieces completed, by the neighbor that sent the piece or its last block.", ("peer",))
+        self.pieces_sent = r.counter("p2p_pieces_sent_total", "Whole pieces sent, by neighbor.", ("peer",))
+        self.blocks_received = r.counter("p2p_blocks_received_total", "Blocks received, by neighbor.", ("peer",))
+        self.blocks_sent = r.counter("p2p_blocks_sent_total", "Blocks sent, by neighbor.", ("peer",))
+        self.request_latency = r.histogram("p2p_request_latency_seconds",
+                                           "Time from sending a request until its block arrives or its piece is accepted.", ("message",))
+        self.choke_sent = r.counter("p2p_choke_messages_sent_total", "CHOKE and UNCHOKE messages sent.", ("message",))
+        self.choke_received = r.counter("p2p_choke_messages_received_total",
+                                        "CHOKE and UNCHOKE messages received.", ("message",))
+        self.disk_seconds = r.histogram("p2p_disk_seconds",
+                                        "Time spent in piece reads and writes (sendfile uploads are not included).", ("op",))
+        self.send_queue = r.gauge("p2p_send_queue_depth", "Messages waiting in a connection's writer, by neighbor.", ("peer",))
+        self.pieces = r.gauge("p2p_pieces", "Pieces we have, by file.", ("file",))
+        self.file_pieces = r.gauge("p2p_file_pieces", "Pieces in the file, by file.", ("file",))
+        self.peers_connected = r.gauge("p2p_peers_connected", "Neighbors connected.")
+        self.connect_attempts = r.counter("p2p_connect_attempts_total",
+                                          "Connection attempts to earlier peers, by peer and result.", ("peer", "result"))
+        self.connect_seconds = r.gauge("p2p_connect_seconds",
+                                       "TCP connect time of the latest connection to an earlier peer.", ("peer",))
+        self.handshake_seconds = r.gauge("p2p_handshake_seconds",
+                                         "Time from sending our handshake to the reply, latest connection to an earlier peer.",
+                                         ("peer",))
+        self.first_piece_seconds = r.gauge("p2p_first_piece_seconds", "Time from start to the first piece, by file.",
+                                           ("file",))
+
+        # series updated on every piece, block or disk access
+        self.piece_latency = self.request_latency.labels("piece")
+        self.block_latency = self.request_latency.labels("block")
+        self.disk_read = self.disk_seconds.labels("read")
+        self.disk_write = self.disk_seconds.labels("write")
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /metrics: Prometheus text format, GET /metrics.json: the same as JSON
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == "/metrics":
+            body, content_type = registry.render_prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(registry.snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes are not worth a line each
+
+# serves registry over HTTP on a background thread until server.shutdown(); port 0 picks a free one
+def serve_metrics(registry: MetricsRegistry, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+class SnapshotWriter:
+    """Writes registry.snapshot() as JSON to path every interval seconds, and once more on stop()."""
+    def __init__(self, registry: MetricsRegistry, path: str, interval: float):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(5)
+        self.write()
+
+    # replaces the file in one step, so readers never see half a snapshot
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"time": time.time(), "metrics": self.registry.snapshot()}, f)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                continue
@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+from backoff import Backoff
+
+# an earlier peer we failed to reach is dialed again after a backoff growing from this many seconds ...
+DIAL_BACKOFF_BASE = 1.0
+# ... up to this many
+DIAL_BACKOFF_MAX = 60.0
+
+class NeighborManager:
+    """
+    Keeps at most max_connections neighbors when Common.cfg sets MaxConnections.
+    Like without a limit, we dial earlier peers in PeerInfo.cfg and later ones dial us.
+    - Free slots go to earlier peers picked at random. Peers avoid_fn(pid) marks (nothing to exchange) come last,
+      and ones we failed to reach wait out a backoff first.
+    - At the limit, a newcomer only gets in by replacing a neighbor that is useless to both sides: one older than
+      rotation_interval, or any with nothing left to exchange (avoid_fn), so peers that are done make room at once.
+    - Every rotation_interval, neighbors useless to both sides are dropped. If none is and we are full, the least
+      useful one is dropped instead, so fresh neighbors keep rotating in. Neighbors younger than rotation_interval
+      are kept, so their rate has time to show.
+    score_fn(pid) rates a neighbor, higher is more useful. It returns None when the connection is useless to both sides.
+    """
+    def __init__(self, candidates, max_connections: int, rotation_interval: float, score_fn, avoid_fn=None):
+        # earlier peers we may dial
+        self.candidates = list(candidates)
+        self.max_connections = max_connections
+        self.rotation_interval = rotation_interval
+        self.score_fn = score_fn
+        self.avoid_fn = avoid_fn or (lambda pid: False)
+        # pid -> monotonic time its connection was admitted
+        self.connected_at = {}
+        # peers being dialed, their slots are taken
+        self.dialing = set()
+        # pid -> (Backoff, monotonic time it may be dialed again)
+        self.retry = {}
+        self.last_rotation = time.monotonic()
+        self.lock = threading.Lock()
+
+    # neighbors old enough to be dropped
+    def _settled(self, now: float):
+        return [pid for pid, at in self.connected_at.items() if now - at >= self.rotation_interval]
+
+    # remote_id finished its handshake; returns (admitted, neighbor to disconnect to make room or None)
+    def admit(self, remote_id: int, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.dialing.discard(remote_id)
+            if remote_id in self.connected_at or len(self.connected_at) + len(self.dialing) < self.max_connections:
+                self.connected_at[remote_id] = now
+                self.retry.pop(remote_id, None)
+                return True, None
+            settled = self._settled(now)
+            victim = next((pid for pid in self.connected_at
+                           if self.score_fn(pid) is None and (pid in settled or self.avoid_fn(pid))), None)
+            if victim is None:
+                return False, None
+            del self.connected_at[victim]
+            self.connected_at[remote_id] = now
+            return True, victim
+
+    def disconnected(self, remote_id: int):
+        with self.lock:
+            self.connected_at.pop(remote_id, None)
+
+    # dialing remote_id did not end in a connection
+    def dial_failed(self, remote_id: int, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.dialing.discard(remote_id)
+            backoff = self.retry.get(remote_id, (Backoff(DIAL_BACKOFF_BASE, DIAL_BACKOFF_MAX), 0))[0]
+            self.retry[remote_id] = (backoff, now + backoff.next())
+
+    # called every few seconds: returns (neighbors to disconnect, earlier peers to dial), the dials take their slots now
+    def plan(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            evict = []
+            if self.rotation_interval > 0 and now - self.last_rotation >= self.rotation_interval:
+                self.last_rotation = now
+                settled = self._settled(now)
+                scores = {pid: self.score_fn(pid) for pid in settled}
+                evict = [pid for pid, score in scores.items() if score is None]
+                if not evict and settled and len(self.connected_at) + len(self.dialing) >= self.max_connections:
+                    evict.append(min(settled, key=scores.get))
+                for pid in evict:
+                    del self.connected_at[pid]
+
+            free = self.max_connections - len(self.connected_at) - len(self.dialing)
+            pool = [pid for pid in self.candidates
+                    if pid not in self.connected_at and pid not in self.dialing and pid not in evict
+                    and self.retry.get(pid, (None, 0))[1] <= now]
+            random.shuffle(pool)
+            pool.sort(key=self.avoid_fn)
+            dial = pool[:max(0, free)]
+            self.dialing.update(dial)
+            return evict, dial
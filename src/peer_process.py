@@ -1,59 +1,185 @@
-import sys
+import argparse
+import dataclasses
 import socket
+import struct
 import threading
 import time
 import random
-from messages import encode_handshake, decode_handshake
-from config import parse_config, parse_peer_info
-from message_handler import send_message, recv_message, BITFIELD, HAVE, INTERESTED, NOT_INTERESTED, CHOKE, UNCHOKE, REQUEST, PIECE
-from bitfield import Bitfield
-from peer_state import PeerState
-from transfer_manager import TransferManager
-from choke_manager import ChokeManager
+from messages import encode_handshake, decode_handshake, decode_handshake_features, content_id, \
+    FEATURE_BLOCKS, FEATURE_MULTI_HAVE, FEATURE_MULTI_CONTENT
+from config import parse_config, parse_peer_info, parse_files, CONFIG_DIR
+from message_handler import FrameReader, CONTENT
+from content_share import ContentShare
+import logger
 from logger import log
-from file_manager import FileManager
+from peer_writer import PeerWriter
+from bandwidth import BandwidthLimiter
+from manifest import load_manifest
+from metrics import PeerMetrics, serve_metrics, SnapshotWriter
+from profiling import Profiler
+from backoff import Backoff
+from neighbor_manager import NeighborManager
 import os
 
+# seconds a connection attempt to an earlier peer, and then its handshake reply, may take
+CONNECT_TIMEOUT = 5.0
+HANDSHAKE_TIMEOUT = 5.0
+# first and longest wait between connection attempts to a peer that cannot be reached (jittered, see Backoff)
+RECONNECT_BASE = 0.1
+RECONNECT_MAX = 10.0
+# seconds between neighbor manager rounds (filling free slots, rotation) when MaxConnections is set
+NEIGHBOR_TICK = 1.0
+# with MaxConnections, seconds every peer we know of has to stay complete before we shut down, so a neighbor
+# that connects meanwhile can still tell us it is missing pieces
+NEIGHBOR_QUIET = 2.0
+# seconds between seeing the swarm complete and shutting down, so our last HAVEs and BITFIELDs get out
+COMPLETION_GRACE = 1.0
+
 # peer
 class PeerProcess:
-    def __init__(self, peer_id: int):
+    # protocol extensions this peer offers in its handshake
+    FEATURES = FEATURE_BLOCKS | FEATURE_MULTI_HAVE | FEATURE_MULTI_CONTENT
+
+    def __init__(self, peer_id: int, config_dir: str = CONFIG_DIR):
         self.peer_id = peer_id
-        self.config = parse_config()
-        self.peers = parse_peer_info()
+        # Common.cfg, PeerInfo.cfg, Files.cfg and the manifest are read from config_dir
+        self.config = parse_config(os.path.join(config_dir, "Common.cfg"))
+        self.peers = parse_peer_info(os.path.join(config_dir, "PeerInfo.cfg"))
         # map of peers
         self.peer_map = {p.peer_ID: p for p in self.peers}
-        # calculates total pieces based off the file size
-        total_pieces = (self.config.file_size + self.config.piece_size - 1) // self.config.piece_size
 
         # ensure peer folder exists
         os.makedirs(f"peer_{self.peer_id}", exist_ok=True)
 
-        # bitfield and file manager
-        self.bitfield = Bitfield(total_pieces)
-        self.file_mgr = FileManager(f"peer_{self.peer_id}/{self.config.file_name}", self.config.piece_size)
-
         # if peer starts with full file, mark all pieces present
         my_info = self.peer_map.get(self.peer_id)
-        if my_info and my_info.has_file:
-            for i in range(total_pieces):
-                self.bitfield.set_piece(i)
-            # ensure file exists (user should place it), but leave as-is if missing
+        has_file = bool(my_info and my_info.has_file)
+
+        # pieces are checked against the seeder's hash manifest when Common.cfg names one
+        digests = None
+        if self.config.piece_hash_file:
+            digests = _load_digests(config_dir, self.config.piece_hash_file, self.config.piece_size, self.config.file_size)
 
-        # per-peer state, excluding self
-        self.peers_state = {p.peer_ID: PeerState(p.peer_ID, total_pieces) for p in self.peers if p.peer_ID != peer_id}
+        # counters, gauges and latency histograms for every shared file (served by --metrics-port)
+        self.metrics = PeerMetrics()
         self.conn_map = {}
+        # remote_id -> PeerWriter, every message to a peer goes through its writer's queue
+        self.writers = {}
         self.conn_lock = threading.Lock()
 
-        # prevent duplicate download threads
-        self.download_threads = {}
+        limiter = None
+        if self.config.max_upload_rate or self.config.max_download_rate \
+                or self.config.max_peer_upload_rate or self.config.max_peer_download_rate:
+            limiter = BandwidthLimiter(self.config)
+        # FileName from Common.cfg, its messages are the plain protocol ones
+        self.main_share = ContentShare(self, self.config, has_file, digests, limiter)
+        # the engines, the benchmark and the metrics reach FileName's state through these
+        self.bitfield = self.main_share.bitfield
+        self.file_mgr = self.main_share.file_mgr
+        self.journal = self.main_share.journal
+        self.peers_state = self.main_share.peers_state
+        self.choke_manager = self.main_share.choke_manager
+        self.verifier = self.main_share.verifier
+        self.picker = self.main_share.picker
+        self.transfer_mgr = self.main_share.transfer_mgr
 
-        # Pass a callback so choke manager can check whether local copy is complete
-        self.choke_manager = ChokeManager(self.peer_id, self.config, self.peers_state, self.conn_map, lambda: self.bitfield.is_complete())
-        self.transfer_mgr = TransferManager(self.peer_id, self.config, self.bitfield, self.file_mgr, self.peers_state, self.conn_map, self)
+        # files from Files.cfg, shared over the same connections: content id -> ContentShare
+        self.contents = {}
+        for f in parse_files(os.path.join(config_dir, "Files.cfg")):
+            cid = content_id(f.file_name, f.file_size)
+            if cid in self.contents:
+                raise ValueError(f"Files.cfg lists {f.file_name} twice (or two files share a content id)")
+            # with PieceHashFile set, every file from Files.cfg is verified too, against <FileName>.sha256
+            manifest = f.file_name + ".sha256" if self.config.piece_hash_file else ""
+            file_digests = None
+            if manifest:
+                file_digests = _load_digests(config_dir, manifest, self.config.piece_size, f.file_size)
+            file_config = dataclasses.replace(self.config, file_name=f.file_name, file_size=f.file_size,
+                                              piece_hash_file=manifest)
+            # a complete copy is there without a journal (a leecher keeps its journal even once it is done)
+            file_path = f"peer_{self.peer_id}/{f.file_name}"
+            file_has = os.path.exists(file_path) and os.path.getsize(file_path) == f.file_size \
+                and not os.path.exists(file_path + ".journal")
+            share = ContentShare(self, file_config, file_has, file_digests, limiter, cid)
+            # the upload loops send for every file, so queued requests wake the same loop
+            share.transfer_mgr.upload_wakeups = self.transfer_mgr.upload_wakeups
+            # one download loop per neighbor requests for every file, so a piece of any file wakes it
+            share.transfer_mgr.wakeups = self.transfer_mgr.wakeups
+            # its choke rounds run on FileName's timers
+            self.choke_manager.link(share.choke_manager)
+            self.contents[cid] = share
+        # every file this peer shares, FileName first
+        self.shares = [self.main_share] + list(self.contents.values())
+        # remote_id -> position in shares of the file whose uploads go next (files take turns)
+        self.upload_turn = {}
+        # remote_id -> its download thread, one per neighbor whatever the number of files
+        self.download_threads = {}
+        # listening socket, closed on shutdown
+        self.server = None
 
         self.running = True
+        # set once shutdown() has finished closing everything
+        self.shut_down = threading.Event()
+        # Profiler when profiling options are given, shutdown() writes its results one last time
+        self.profiler = None
+        # earlier peer id -> event that wakes its connector (the connection dropped, or shutdown)
+        self.reconnect_wakeups = {}
+        # earlier peer id -> (connect seconds, handshake seconds) of the latest connection to it
+        self.connect_latency = {}
+        # monotonic time start() was called
+        self.started_at = None
+        # with MaxConnections, picks the peers we stay connected to; otherwise every earlier peer is kept connected
+        self.neighbors = None
+        if self.config.max_connections > 0:
+            my_index = [p.peer_ID for p in self.peers].index(self.peer_id)
+            self.neighbors = NeighborManager([p.peer_ID for p in self.peers[:my_index]], self.config.max_connections,
+                                             self.config.neighbor_rotation_interval, self._neighbor_score,
+                                             self._nothing_to_exchange)
+        # wheel timer that shuts us down once the swarm is complete (see _check_completion)
+        self.completion_timer = None
+        self.completion_lock = threading.Lock()
+
+        self.metrics.pieces.set_function(lambda: {(s.config.file_name,): s.bitfield.count for s in self.shares})
+        self.metrics.file_pieces.set_function(lambda: {(s.config.file_name,): s.bitfield.num_pieces for s in self.shares})
+        self.metrics.peers_connected.set_function(lambda: {(): len(self.conn_map)})
+        self.metrics.send_queue.set_function(lambda: {(pid,): len(w.control) for pid, w in list(self.writers.items())})
+        self.metrics.connect_seconds.set_function(lambda: {(pid,): c for pid, (c, _) in list(self.connect_latency.items())})
+        self.metrics.handshake_seconds.set_function(
+            lambda: {(pid,): h for pid, (_, h) in list(self.connect_latency.items())})
+        self.metrics.first_piece_seconds.set_function(
+            lambda: {(s.config.file_name,): s.first_piece_at - self.started_at for s in self.shares
+                     if s.first_piece_at is not None})
+
+    # monotonic time the first piece of FileName was completed
+    @property
+    def first_piece_at(self):
+        return self.main_share.first_piece_at
 
     def start(self):
+        self._log_start()
+        self.started_at = time.monotonic()
+
+        # listen before connecting out, so the port is open by the time start() returns
+        my_info = self.peer_map[self.peer_id]
+        server = self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind(('', my_info.listening_port))
+            server.listen(5)
+        except Exception as e:
+            print("Server error:", e)
+            self.shutdown()
+            return
+        threading.Thread(target=self._listen_for_incoming, args=(server,), daemon=True).start()
+        # connects to every earlier peer at once, without waiting for them
+        self._connect_to_earlier_peers()
+        self.choke_manager.start()
+        # a swarm complete from the start (a lone seeder) has no event to notice it
+        self._check_completion()
+        if self.config.have_batch_interval > 0:
+            threading.Thread(target=self._have_flusher, daemon=True).start()
+
+    def _log_start(self):
         log(self.peer_id, ("starts." 
                            f"\n\nSet Variables:"
                            f"\n--------------------------------"
@@ -64,223 +190,392 @@ class PeerProcess:
                            f"\nFile size: {self.config.file_size} bytes, "
                            f"\nPiece size: {self.config.piece_size} bytes."
                            f"\nInitial bitfield: {self.bitfield.to_bytes().hex()}"
-                           f"\n--------------------------------\n"))
-        
-        # start listening for incoming connections
-        threading.Thread(target=self._listen_for_incoming, daemon=True).start()
-        time.sleep(0.5)
-        # try to connect to earlier peers with retries
-        self._connect_to_earlier_peers()
-        self.choke_manager.start()
-        threading.Thread(target=self._completion_watcher, daemon=True).start()
+                           + "".join(f"\nAlso sharing: {c.config.file_name} ({c.config.file_size} bytes), "
+                                     f"initial bitfield: {c.bitfield.to_bytes().hex()}" for c in self.contents.values())
+                           + f"\n--------------------------------\n"))
 
-    def _listen_for_incoming(self):
-        my_info = self.peer_map[self.peer_id]
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            server.bind(('', my_info.listening_port))
-            server.listen(5)
-            while self.running:
-                try:
-                    conn, addr = server.accept()
-                    threading.Thread(target=self._handle_connection_incoming, args=(conn,), daemon=True).start()
-                except Exception:
-                    if self.running:
-                        continue
-        except Exception as e:
-            print("Server error:", e)
-            self.shutdown()
+    def _listen_for_incoming(self, server: socket.socket):
+        while self.running:
+            try:
+                conn, addr = server.accept()
+                threading.Thread(target=self._handle_connection_incoming, args=(conn,), daemon=True).start()
+            except Exception:
+                if self.running:
+                    continue
 
+    # one connector thread per earlier peer, so a slow or missing peer does not hold up the others
+    # (with MaxConnections the neighbor manager picks the peers to connect to instead)
     def _connect_to_earlier_peers(self):
+        if self.neighbors is not None:
+            self._manage_neighbors()
+            threading.Thread(target=self._neighbor_loop, daemon=True).start()
+            return
         ids = [p.peer_ID for p in self.peers]
         my_index = ids.index(self.peer_id)
         for p in self.peers[:my_index]:
-            connected = False
-            for attempt in range(5):
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(5.0)
-                    sock.connect((p.host_name, p.listening_port))
-                    sock.settimeout(None)
-                    # send handshake and wait reply
-                    sock.sendall(encode_handshake(self.peer_id))
-                    log(self.peer_id, f"sent a handshake to Peer {p.peer_ID}.")
-                    resp = sock.recv(32)
-                    remote_id = decode_handshake(resp)
-                    log(self.peer_id, f"received a handshake from Peer {remote_id}.")
-
-                    if remote_id != p.peer_ID:
-                        sock.close()
-                        break
-                    with self.conn_lock:
-                        self.conn_map[remote_id] = sock
-                    log(self.peer_id, f"makes a connection to Peer {remote_id}.")
-                    # send bitfield only if we have any pieces
-                    # send remote_id to log
-                    self._send_our_bitfield_if_any(sock, remote_id)
-                    # start message listener for this connection
-                    threading.Thread(target=self._message_listener, args=(remote_id, sock), daemon=True).start()
-                    connected = True
-                    break
-                except Exception as e:
-                    time.sleep(1.0)
-                    continue
-            if not connected:
-                print(f"Could not connect to peer {p.peer_ID} after retries.")
+            self.reconnect_wakeups[p.peer_ID] = threading.Event()
+            threading.Thread(target=self._keep_connected, args=(p,), daemon=True).start()
+
+    # keeps a connection to earlier peer p until shutdown: retries with backoff while it cannot be reached,
+    # and connects again whenever the connection drops
+    def _keep_connected(self, p):
+        backoff = Backoff(RECONNECT_BASE, RECONNECT_MAX)
+        wake = self.reconnect_wakeups[p.peer_ID]
+        while self.running:
+            # cleared before looking, so a drop right after still wakes us
+            wake.clear()
+            if p.peer_ID in self.conn_map:
+                wake.wait()
+            elif self._connect_to_peer(p):
+                backoff.reset()
+            else:
+                wake.wait(backoff.next())
+
+    # one attempt to connect and handshake with earlier peer p, returns True once the connection is up
+    def _connect_to_peer(self, p) -> bool:
+        sock = None
+        try:
+            started = time.monotonic()
+            sock = socket.create_connection((p.host_name, p.listening_port), CONNECT_TIMEOUT)
+            connected = time.monotonic()
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            # send handshake and wait reply
+            sock.sendall(encode_handshake(self.peer_id, self.FEATURES))
+            log(self.peer_id, f"sent a handshake to Peer {p.peer_ID}.")
+            resp = sock.recv(32)
+            remote_id = decode_handshake(resp)
+            log(self.peer_id, f"received a handshake from Peer {remote_id}.")
+            if remote_id != p.peer_ID:
+                raise ValueError(f"expected peer {p.peer_ID}, got {remote_id}")
+            if not self._admit(remote_id):
+                raise ValueError(f"no room for peer {remote_id}")
+            sock.settimeout(None)
+        except Exception:
+            self.metrics.connect_attempts.labels(p.peer_ID, "failed").inc()
+            if sock is not None:
+                sock.close()
+            return False
+        self._on_connected(remote_id, connected - started, time.monotonic() - connected)
+
+        self._set_features(remote_id, resp)
+        self._add_connection(remote_id, sock)
+        log(self.peer_id, f"makes a connection to Peer {remote_id}.")
+        # send bitfield only if we have any pieces
+        self._send_our_bitfield_if_any(sock, remote_id)
+        # start message listener for this connection
+        threading.Thread(target=self._message_listener, args=(remote_id, sock), daemon=True).start()
+        return True
+
+    # records how long connecting to earlier peer remote_id took
+    def _on_connected(self, remote_id: int, connect_seconds: float, handshake_seconds: float):
+        self.connect_latency[remote_id] = (connect_seconds, handshake_seconds)
+        self.metrics.connect_attempts.labels(remote_id, "ok").inc()
+
+    # the connection to remote_id dropped: its connector (if it is an earlier peer) connects again,
+    # or the neighbor manager gets its slot back
+    def _connection_closed(self, remote_id: int):
+        wake = self.reconnect_wakeups.get(remote_id)
+        if wake is not None:
+            wake.set()
+        if self.neighbors is not None:
+            self.neighbors.disconnected(remote_id)
+            # the last incomplete neighbor may have been this one
+            self._check_completion()
+
+    # whether remote_id, done with its handshake, may connect; at MaxConnections the neighbor manager may
+    # disconnect a neighbor to make room
+    def _admit(self, remote_id: int) -> bool:
+        if self.neighbors is None:
+            return True
+        if remote_id not in self.peer_map or remote_id == self.peer_id:
+            return False
+        admitted, victim = self.neighbors.admit(remote_id)
+        if victim is not None:
+            log(self.peer_id, f"drops the connection to Peer {victim} to make room for Peer {remote_id}.")
+            self._close_connection(victim)
+        return admitted
+
+    # one neighbor manager round: drops the neighbors it gives up and dials the earlier peers it picks
+    def _manage_neighbors(self):
+        evict, dial = self.neighbors.plan()
+        for pid in evict:
+            log(self.peer_id, f"drops the connection to Peer {pid}.")
+            self._close_connection(pid)
+        for pid in dial:
+            self._dial(self.peer_map[pid])
+
+    def _neighbor_loop(self):
+        while self.running:
+            time.sleep(NEIGHBOR_TICK)
+            try:
+                self._manage_neighbors()
+            except Exception:
+                continue
+
+    # one connection attempt to earlier peer p for the neighbor manager, on its own thread
+    def _dial(self, p):
+        def attempt():
+            if not self._connect_to_peer(p):
+                self.neighbors.dial_failed(p.peer_ID)
+        threading.Thread(target=attempt, daemon=True).start()
+
+    # closes the connection to remote_id, its listener then cleans up as if it had dropped
+    def _close_connection(self, remote_id: int):
+        with self.conn_lock:
+            writer = self.writers.get(remote_id)
+            sock = self.conn_map.get(remote_id)
+        if writer is not None:
+            writer.close()
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+
+    # how useful the connection to remote_id is for the neighbor manager, None if neither side needs the other:
+    # what moves both ways, plus the pieces no other neighbor has counted as one piece per rotation interval
+    def _neighbor_score(self, remote_id: int):
+        useful, score = False, 0.0
+        for share in self.shares:
+            ps = share.peers_state.get(remote_id)
+            if ps is None:
+                continue
+            useful = useful or ps.is_interested or ps.our_interest
+            score += ps.download_rate + ps.upload_rate
+            rare = sum(1 for i in share.bitfield.iter_missing_from(ps.remote_bitfield)
+                       if share.picker.holders(i) <= 1)
+            score += rare * share.config.piece_size / max(1, self.config.neighbor_rotation_interval)
+        return score if useful else None
+
+    # true if we and remote_id are known to hold every file already, so dialing it can wait
+    def _nothing_to_exchange(self, remote_id: int) -> bool:
+        for share in self.shares:
+            ps = share.peers_state.get(remote_id)
+            if not share.bitfield.is_complete() or ps is None or not ps.remote_complete:
+                return False
+        return True
 
     def _handle_connection_incoming(self, conn: socket.socket):
+        remote_id = None
         try:
             data = conn.recv(32)
             remote_id = decode_handshake(data)
             log(self.peer_id, f"received a handshake from Peer {remote_id}.")
-            # send handshake back
-            conn.sendall(encode_handshake(self.peer_id))
+            if not self._admit(remote_id):
+                conn.close()
+                return
+            self._set_features(remote_id, data)
+            # send handshake back, with our features only if remote_id offered some: a peer without extensions
+            # expects all 10 zero bytes
+            conn.sendall(encode_handshake(self.peer_id, self.FEATURES if decode_handshake_features(data) else 0))
             log(self.peer_id, f"sent a handshake to Peer {remote_id}.")
-            with self.conn_lock:
-                self.conn_map[remote_id] = conn
+            self._add_connection(remote_id, conn)
             log(self.peer_id, f"is connected from Peer {remote_id}.")
             # send our bitfield only if we have pieces
             self._send_our_bitfield_if_any(conn, remote_id)
             threading.Thread(target=self._message_listener, args=(remote_id, conn), daemon=True).start()
-        except Exception as e:
+        except Exception:
             try:
                 conn.close()
             except Exception:
                 pass
+            if remote_id is not None:
+                self._handshake_failed(remote_id)
+
+    # remembers which of our features remote_id's handshake also offers
+    def _set_features(self, remote_id: int, handshake: bytes):
+        features = decode_handshake_features(handshake) & self.FEATURES
+        for share in self.shares:
+            ps = share._peer_state(remote_id)
+            ps.features = features
+            share._track_peer(remote_id, ps)
+
+    # the handshake with remote_id failed after _set_features: it is no neighbor after all
+    def _handshake_failed(self, remote_id: int):
+        if remote_id in self.conn_map:
+            return
+        for share in self.shares:
+            ps = share.peers_state.get(remote_id)
+            if ps is not None:
+                share.picker.remove_peer(remote_id, ps.remote_bitfield)
+        # gives back the slot the neighbor manager may have reserved for it
+        self._connection_closed(remote_id)
+
+    # next upload queued by remote_id for any of our files, as (share, entry); None if there is none
+    def _next_upload(self, remote_id: int):
+        turn = self.upload_turn.get(remote_id, 0)
+        for k in range(len(self.shares)):
+            share = self.shares[(turn + k) % len(self.shares)]
+            entry = share.transfer_mgr.next_upload(remote_id)
+            if entry is not None:
+                self.upload_turn[remote_id] = (turn + k + 1) % len(self.shares)
+                return share, entry
+        return None
+
+    # makes sock the connection to remote_id and starts its writer; a connection it replaces is shut down,
+    # and its listener then closes its socket
+    def _add_connection(self, remote_id: int, sock: socket.socket):
+        # uploads are (share, entry) pairs, so one writer serves every file
+        writer = PeerWriter(sock, lambda: self._next_upload(remote_id),
+                            lambda conn, item: item[0].transfer_mgr.send_upload(conn, remote_id, item[1]),
+                            lambda item: item[0].transfer_mgr.upload_delay(remote_id, item[1]))
+        with self.conn_lock:
+            old = self.writers.get(remote_id)
+            self.conn_map[remote_id] = sock
+            self.writers[remote_id] = writer
+        if old is not None:
+            old.close()
+        writer.start()
+
+    # queues a message to a connected peer without waiting on its socket, returns False if it could not be queued
+    def _send_to(self, remote_id: int, msg_type: int, payload: bytes = b"") -> bool:
+        with self.conn_lock:
+            writer = self.writers.get(remote_id)
+        if writer is None:
+            return False
+        return writer.send(msg_type, payload)
+
     # sends bitfield if we have any of the file pieces
     def _send_our_bitfield_if_any(self, sock: socket.socket, remote_id: int):
-        payload = self.bitfield.to_bytes()
-        # if any bit isnt 0
-        if any(b != 0 for b in payload):
-            try:
-                send_message(sock, BITFIELD, payload)
-                log(self.peer_id, f"sent the 'bitfield' message to {remote_id}.")
-            except Exception:
-                pass
+        for share in self.shares:
+            share._send_our_bitfield_if_any(remote_id)
 
     # listens 
     def _message_listener(self, remote_id: int, sock: socket.socket):
-        ps = self.peers_state[remote_id]
+        # payloads are views into the reader's buffer, handled before the next read
+        reader = FrameReader(sock)
         while self.running:
             try:
-                msg_type, payload = recv_message(sock)
+                msg_type, payload = reader.read_message()
+                self._handle_message(remote_id, sock, msg_type, payload)
             except Exception:
                 break # if connection suddenly lost
 
-            if msg_type == BITFIELD:
-                ps.remote_bitfield.from_bytes(payload)
-                log(self.peer_id, f"received the 'bitfield' message from {remote_id}.")
-                self._evaluate_interest(remote_id)
-
-            elif msg_type == HAVE:
-                index = int.from_bytes(payload[:4], "big")
-                ps.remote_bitfield.set_piece(index)
-                log(self.peer_id, f"received the 'have' message from {remote_id} for the piece {index}.")
-                self._evaluate_interest(remote_id)
-
-            elif msg_type == INTERESTED:
-                ps.is_interested = True
-                log(self.peer_id, f"received the 'interested' message from {remote_id}.")
-
-            elif msg_type == NOT_INTERESTED:
-                ps.is_interested = False
-                log(self.peer_id, f"received the 'not interested' message from {remote_id}.")
-
-            elif msg_type == CHOKE:
-                ps.is_choked = True
-                log(self.peer_id, f"is choked by {remote_id}.")
-
-            elif msg_type == UNCHOKE:
-                ps.is_choked = False
-                log(self.peer_id, f"is unchoked by {remote_id}.")
-                if remote_id not in self.download_threads or not self.download_threads[remote_id].is_alive():
-                    t = threading.Thread(target=self.transfer_mgr.download_loop, args=(remote_id,), daemon=True)
-                    self.download_threads[remote_id] = t
-                    t.start()
-
-            elif msg_type == REQUEST:
-                index = int.from_bytes(payload[:4], "big")
-                if self.bitfield.has_piece(index):
-                    self.transfer_mgr.handle_request_and_send_piece(sock, index, remote_id)
-
-            elif msg_type == PIECE:
-                piece_index = int.from_bytes(payload[:4], "big")
-                piece_data = payload[4:]
-                self.file_mgr.write_piece(piece_index, piece_data)
-                self.bitfield.set_piece(piece_index)
-                ps.update_download(len(piece_data))
-                num_pieces = sum(1 for i in range(self.bitfield.num_pieces) if self.bitfield.has_piece(i))
-                log(self.peer_id, f"has downloaded the piece {piece_index} from {remote_id}. Now the number of pieces it has is {num_pieces}.")
-                with self.conn_lock:
-                    for pid, s in list(self.conn_map.items()):
-                        try:
-                            send_message(s, HAVE, piece_index.to_bytes(4, "big"))
-                            log(self.peer_id, f"sent the 'have' message to peer {remote_id}")
-                        except Exception:
-                            pass
-                self._evaluate_interest(remote_id)
-
-            else:
-                pass
-
         with self.conn_lock:
-            if remote_id in self.conn_map and self.conn_map[remote_id] is sock:
-                try:
-                    sock.close()
-                except:
-                    pass
+            replaced = self.conn_map.get(remote_id) is not sock
+            if not replaced:
+                self.writers.pop(remote_id).close()
                 del self.conn_map[remote_id]
+        # a replaced connection's writer only shut its socket down, so it is closed here too
+        try:
+            sock.close()
+        except:
+            pass
+        # a newer connection to the same peer keeps its state
+        if not replaced:
+            self._on_disconnect(remote_id)
+            self._connection_closed(remote_id)
 
-    def _evaluate_interest(self, remote_id: int):
-        # check if any peers have pieces that we desire
-        ps = self.peers_state[remote_id]
-        sock = None
-        with self.conn_lock:
-            sock = self.conn_map.get(remote_id)
-        if not sock:
-            return
-        missing = self.bitfield.missing_pieces_from(ps.remote_bitfield)
-        if missing:
-            try:
-                send_message(sock, INTERESTED)
-            except Exception:
-                pass
-            ps.our_interest = True
-            log(self.peer_id, f"sent the 'interested' message to {remote_id}.")
+    # drops what the connection to remote_id was holding, for every file
+    def _on_disconnect(self, remote_id: int):
+        for share in self.shares:
+            share._on_disconnect(remote_id)
+
+    # handles one message from remote_id, conn is whatever the engine reads/writes that peer with
+    def _handle_message(self, remote_id: int, conn, msg_type: int, payload: bytes):
+        if msg_type == CONTENT:
+            # a message about one of the Files.cfg files, handled by that file's share
+            cid, inner_type = struct.unpack_from("!IB", payload)
+            share = self.contents.get(cid)
+            if share is not None:
+                share._handle_message(remote_id, conn, inner_type, payload[5:])
         else:
-            try:
-                send_message(sock, NOT_INTERESTED)
-            except Exception:
-                pass
-            ps.our_interest = False
-            log(self.peer_id, f"sent the 'not interested' message to {remote_id}.")
+            self.main_share._handle_message(remote_id, conn, msg_type, payload)
+
+    def _flush_all_haves(self):
+        for share in self.shares:
+            share._flush_haves()
 
-    # checks to see if all peers have all chunks of the file. shutsdown if true
-    def _completion_watcher(self):
+    def _have_flusher(self):
         while self.running:
-            time.sleep(2)
-            try:
-                if not self.bitfield.is_complete():
-                    continue
-                all_complete = True
-                for pid, ps in self.peers_state.items():
-                    if not ps.remote_bitfield.is_complete():
-                        all_complete = False
-                        break
-                if all_complete:
-                    log(self.peer_id, "has downloaded the complete file.")
-                    time.sleep(1.0)
-                    self.shutdown()
+            time.sleep(self.config.have_batch_interval / 1000)
+            self._flush_all_haves()
+
+    # runs fn where connection state may be touched; threads share it under locks, so call it directly
+    def _call_on_network_thread(self, fn, *args):
+        fn(*args)
+
+    # starts the download loop from remote_id unless one is already running
+    def _start_download(self, remote_id: int):
+        t = self.download_threads.get(remote_id)
+        if t is None or not t.is_alive():
+            t = threading.Thread(target=self._download_loop, args=(remote_id,), daemon=True)
+            self.download_threads[remote_id] = t
+            t.start()
+
+    def _download_loop(self, remote_id: int):
+        """
+        Keeps a window of requests outstanding to remote_id, for every file it unchoked us for and we want pieces of.
+        New requests go out as pieces arrive (the shares' wake(remote_id) sets the same event). One thread per
+        neighbor, so files do not add threads.
+        """
+        wake = threading.Event()
+        self.transfer_mgr.wakeups[remote_id] = wake
+        while self.running:
+            with self.conn_lock:
+                if remote_id not in self.conn_map:
                     break
-            except Exception:
-                continue
+            # clear before requesting so a piece landing in between still wakes us
+            wake.clear()
+            if not self._fill_windows(remote_id):
+                break
+            # if we are choked, not interested or the windows are full, wait for something to change
+            wake.wait(0.5)
+
+    # tops up the request window of every file remote_id unchoked us for, returns False if the connection is gone
+    def _fill_windows(self, remote_id: int) -> bool:
+        for share in self.shares:
+            ps = share.peers_state.get(remote_id)
+            if ps is not None and not ps.is_choked and ps.our_interest:
+                if not share.transfer_mgr.fill_window(remote_id, share._send_to):
+                    return False
+        return True
+
+    # a request from remote_id was queued, its writer sends it once the control messages ahead of it are out
+    def _start_upload(self, remote_id: int, conn):
+        with self.conn_lock:
+            writer = self.writers.get(remote_id)
+        if writer is not None:
+            writer.wake()
+
+    # called whenever completion may have changed (our pieces, a neighbor's pieces, a neighbor leaving):
+    # once the swarm is complete, a wheel timer shuts us down after COMPLETION_GRACE. With MaxConnections
+    # the timer waits NEIGHBOR_QUIET instead, and is dropped if a peer we did not know of connects incomplete
+    def _check_completion(self):
+        done = self._swarm_complete()
+        with self.completion_lock:
+            if done and self.completion_timer is None and self.running:
+                delay = COMPLETION_GRACE
+                if self.neighbors is not None:
+                    delay = NEIGHBOR_QUIET
+                self.completion_timer = self.choke_manager.wheel.call_later(delay, self._on_swarm_complete)
+            elif not done and self.completion_timer is not None:
+                self.completion_timer.cancel()
+                self.completion_timer = None
+
+    def _on_swarm_complete(self):
+        with self.completion_lock:
+            self.completion_timer = None
+        # with MaxConnections, a neighbor that connected since may still be missing pieces
+        if not self._swarm_complete():
+            return
+        log(self.peer_id, "has downloaded the complete file.")
+        self.shutdown()
+
+    # true once we and every other peer hold every shared file
+    def _swarm_complete(self) -> bool:
+        return all(share._content_complete() for share in self.shares)
 
     # shuts down
     def shutdown(self):
         self.running = False
         self.choke_manager.stop()
+        for wake in self.reconnect_wakeups.values():
+            wake.set()
         with self.conn_lock:
+            for w in list(self.writers.values()):
+                w.close()
+            self.writers.clear()
             for s in list(self.conn_map.values()):
                 try:
                     s.shutdown(socket.SHUT_RDWR)
@@ -291,20 +586,90 @@ class PeerProcess:
                 except Exception:
                     pass
             self.conn_map.clear()
+        # frees the port, so a peer started again in this process can listen on it
+        # (shutdown wakes the listener thread, whose pending accept would otherwise keep the socket open)
+        if self.server is not None:
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            self.server.close()
+        for share in self.shares:
+            share._close_files()
+        if self.profiler is not None:
+            self.profiler.stop()
         log(self.peer_id, "has shut down.")
+        # write out queued log lines and let go of our log file
+        logger.close(self.peer_id)
+        self.shut_down.set()
+
+# digests of the manifest config_dir/name, checked against the file it should describe
+def _load_digests(config_dir: str, name: str, piece_size: int, file_size: int):
+    manifest_piece_size, manifest_file_size, digests = load_manifest(os.path.join(config_dir, name))
+    if manifest_piece_size != piece_size or manifest_file_size != file_size \
+            or len(digests) != (file_size + piece_size - 1) // piece_size:
+        raise ValueError(f"{name} does not match the file it is for (PieceSize {piece_size}, FileSize {file_size})")
+    return digests
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python peer_process.py [peerID]")
-        sys.exit(1)
-    pid = int(sys.argv[1])
-    pp = PeerProcess(pid)
-    pp.start()
+    parser = argparse.ArgumentParser(description="Run a peer of the P2P file sharing swarm.")
+    parser.add_argument("peer_id", type=int, help="peer ID from PeerInfo.cfg")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run on the asyncio engine instead of one thread per connection")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics on http://127.0.0.1:PORT/metrics (Prometheus text) and /metrics.json")
+    parser.add_argument("--metrics-json", metavar="PATH", help="write a JSON snapshot of the metrics to PATH periodically")
+    parser.add_argument("--metrics-interval", type=float, default=10, help="seconds between JSON snapshots")
+    parser.add_argument("--profile", choices=["cprofile", "sample"],
+                        help="cProfile every thread (profile_peer_<id>.prof) or sample their stacks (profile_peer_<id>.folded)")
+    parser.add_argument("--sample-interval", type=float, default=0.005, help="seconds between stack samples")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="trace allocations (tracemalloc_peer_<id>.snap and a .txt summary)")
+    parser.add_argument("--lock-timing", action="store_true",
+                        help="time waits on conn_lock, the choke managers' and the HAVE locks (locks_peer_<id>.json)")
+    parser.add_argument("--profile-dir", default=".", help="folder for the profiling results")
+    parser.add_argument("--profile-interval", type=float, default=30,
+                        help="seconds between profiling dumps (they are also written on shutdown)")
+    args = parser.parse_args()
+
+    if args.use_async:
+        from async_peer_process import AsyncPeerProcess, run_async_peer
+        pp = AsyncPeerProcess(args.peer_id)
+    else:
+        pp = PeerProcess(args.peer_id)
+    if args.profile or args.tracemalloc or args.lock_timing:
+        pp.profiler = Profiler(pp.peer_id, args.profile_dir, args.profile, args.profile_interval, args.sample_interval,
+                               args.tracemalloc, args.lock_timing)
+        pp.profiler.instrument(pp)
+        pp.profiler.start()
+    stop_metrics = _start_metrics(pp, args)
     try:
-        while pp.running:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        pp.shutdown()
+        if args.use_async:
+            run_async_peer(pp)
+            return
+        pp.start()
+        try:
+            # wait for shutdown() to finish, not just to start, so its last log lines are written
+            while not pp.shut_down.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pp.shutdown()
+    finally:
+        for stop in stop_metrics:
+            stop()
+        if pp.profiler is not None:
+            pp.profiler.stop()
+
+# starts the metrics endpoint and snapshots asked for on the command line, returns their stop functions
+def _start_metrics(pp: PeerProcess, args) -> list:
+    stops = []
+    if args.metrics_port is not None:
+        server = serve_metrics(pp.metrics.registry, args.metrics_port)
+        print(f"Metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+        stops.append(server.shutdown)
+    if args.metrics_json:
+        stops.append(SnapshotWriter(pp.metrics.registry, args.metrics_json, args.metrics_interval).start().stop)
+    return stops
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,12 @@
-import time
 from bitfield import Bitfield
+from rate_meter import RateMeter
 
 class PeerState:
-    def __init__(self, peer_id: int, total_pieces: int):
+    # one per connected peer and file, so no __dict__ each
+    __slots__ = ("peer_id", "is_choked", "is_interested", "our_interest", "download_meter", "upload_meter",
+                 "remote_bitfield", "remote_complete", "features", "bytes_received_total", "bytes_sent_total")
+
+    def __init__(self, peer_id: int, total_pieces: int, rate_window: float = 5.0):
         self.peer_id = peer_id
         self.is_choked = True
 
@@ -12,17 +16,29 @@ class PeerState:
         # Send Interested
         self.our_interest = False
         
-        self.download_rate = 0.0
-        self._last_bytes = 0
-        self._last_time = time.time()
+        # bytes/sec from and to this peer over the last rate_window seconds (the unchoking interval)
+        self.download_meter = RateMeter(rate_window)
+        self.upload_meter = RateMeter(rate_window)
         self.remote_bitfield = Bitfield(total_pieces)
+        # set once the remote held every piece; unlike remote_bitfield it outlives the connection (pieces are kept)
+        self.remote_complete = False
+        # feature bits both handshakes advertised (messages.FEATURE_*)
+        self.features = 0
         self.bytes_received_total = 0
+        self.bytes_sent_total = 0
+
+    @property
+    def download_rate(self) -> float:
+        return self.download_meter.rate()
+
+    @property
+    def upload_rate(self) -> float:
+        return self.upload_meter.rate()
+
+    def update_download(self, bytes_received: int):
+        self.bytes_received_total += bytes_received
+        self.download_meter.add(bytes_received)
 
-    def update_download(self, bytes_received_since_last_call: int):
-        now = time.time()
-        diff = now - self._last_time
-        self.bytes_received_total += bytes_received_since_last_call
-        if diff > 0:
-            self.download_rate = (self.bytes_received_total - self._last_bytes) / diff
-        self._last_time = now
-        self._last_bytes = self.bytes_received_total
\ No newline at end of file
+    def update_upload(self, bytes_sent: int):
+        self.bytes_sent_total += bytes_sent
+        self.upload_meter.add(bytes_sent)
@@ -0,0 +1,128 @@
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from message_handler import CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, CONTENT
+
+# control messages one connection may have waiting; a peer that falls this far behind (after merging) is
+# disconnected instead of letting its queue grow without bound, senders never wait on it
+MAX_QUEUED_CONTROL = 1024
+
+# messages that only say what state we are in towards the peer: a newer one makes a queued one of the same kind
+# (for the same file) pointless, so it replaces it
+STATE_KINDS = {CHOKE: "choke", UNCHOKE: "choke", INTERESTED: "interest", NOT_INTERESTED: "interest"}
+
+# what queued message a new one of msg_type supersedes, None if it supersedes nothing
+def _state_kind(msg_type: int, payload: bytes):
+    if msg_type == CONTENT and len(payload) == 5:
+        kind = STATE_KINDS.get(payload[4])
+        return (bytes(payload[:4]), kind) if kind is not None else None
+    kind = STATE_KINDS.get(msg_type)
+    return (b"", kind) if kind is not None else None
+
+class PeerWriter:
+    """
+    Owns every write to one connection, other threads only queue messages and never wait on its socket.
+    A dedicated thread sends all queued control messages first, then one upload (piece or block) taken from
+    next_upload() and written by send_upload(sock, entry), so CHOKE/HAVE/REQUEST never wait behind more than one
+    piece of data and a slow peer only stalls its own writer.
+    pace(entry), if given, returns how many seconds an upload has to wait (bandwidth caps); control messages
+    keep going out while it waits.
+    """
+    def __init__(self, sock: socket.socket, next_upload, send_upload, pace=None):
+        self.sock = sock
+        self.next_upload = next_upload
+        self.send_upload = send_upload
+        self.pace = pace
+        # upload taken from the queue but waiting for its time (monotonic ready_at)
+        self.held = None
+        self.ready_at = 0.0
+        # encoded frames waiting to be sent, in order
+        self.control = deque()
+        # (content id, kind) -> the CHOKE/UNCHOKE or INTERESTED/NOT_INTERESTED frame of that kind in control
+        self.queued_states = {}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    # queues one message without waiting, returns False if the connection is closed or too far behind (it is
+    # closed then). A choke or interest message replaces the one of its kind still queued
+    def send(self, msg_type: int, payload: bytes = b"") -> bool:
+        frame = struct.pack("!IB", 1 + len(payload), msg_type) + bytes(payload)
+        kind = _state_kind(msg_type, payload)
+        with self.cond:
+            if self.closed:
+                return False
+            old = self.queued_states.pop(kind, None) if kind is not None else None
+            if old is not None:
+                # equal frames are the same message, so this removes the one queued for kind
+                self.control.remove(old)
+            if len(self.control) < MAX_QUEUED_CONTROL:
+                self.control.append(frame)
+                if kind is not None:
+                    self.queued_states[kind] = frame
+                self.cond.notify()
+                return True
+        self.close()
+        return False
+
+    # an upload was queued for this connection
+    def wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    # stops the writer and shuts the socket down, so the connection's listener sees it end too
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            while True:
+                frames, entry = self._next_batch()
+                if frames is None:
+                    return
+                if frames:
+                    # everything queued goes out in one call
+                    self.sock.sendall(b"".join(frames))
+                if entry is not None:
+                    self.send_upload(self.sock, entry)
+        except Exception:
+            self.close()
+
+    # waits for work: every queued control frame, or else one upload; (None, None) once closed
+    def _next_batch(self):
+        with self.cond:
+            while not self.closed:
+                if self.control:
+                    frames = list(self.control)
+                    self.control.clear()
+                    self.queued_states.clear()
+                    return frames, None
+                if self.held is None:
+                    entry = self.next_upload()
+                    if entry is None:
+                        self.cond.wait()
+                        continue
+                    delay = self.pace(entry) if self.pace is not None else 0
+                    if delay <= 0:
+                        return [], entry
+                    self.held, self.ready_at = entry, time.monotonic() + delay
+                wait = self.ready_at - time.monotonic()
+                if wait <= 0:
+                    entry, self.held = self.held, None
+                    return [], entry
+                self.cond.wait(wait)
+            return None, None
@@ -0,0 +1,269 @@
+import heapq
+from array import array
+import random
+import threading
+
+class PiecePicker:
+    """
+    Chooses which pieces to request across all neighbors.
+    Keeps how many connected peers hold each piece and which pieces are already requested,
+    so two neighbors are never asked for the same piece and rare pieces go first.
+    The counts are updated as connects, BITFIELD, HAVE and disconnects come in, so how rare a piece is, and whether
+    any connected neighbor still misses it, are O(1) questions (holders, missing_count) instead of a scan of every
+    bitfield.
+    In endgame (endgame_threshold or fewer pieces left) a piece may be requested from several neighbors at once.
+    With a block size, pieces can also be handed out block by block (pick_blocks), so one piece can come from
+    several neighbors; a piece is reserved either whole (pick) or in blocks, never both.
+    """
+    def __init__(self, bitfield, endgame_threshold: int = 0, piece_size: int = 0, file_size: int = 0, block_size: int = 0):
+        # our own bitfield
+        self.bitfield = bitfield
+        # piece index -> number of connected peers that have it
+        self.availability = array("I", bytes(4 * bitfield.num_pieces))
+        # piece index -> peers it is requested from (more than one only in endgame)
+        self.reserved = {}
+        self.endgame_threshold = endgame_threshold
+        # connected peers, whose pieces are counted in availability
+        self.counted = set()
+        # how many of them hold every piece
+        self.seeds = 0
+        self.piece_size = piece_size
+        self.file_size = file_size
+        self.block_size = block_size
+        # piece index -> _PartialPiece for pieces being fetched in blocks
+        self.partial = {}
+        # pieces that arrived whole and are being stored (and verified), until complete() or reject()
+        self.landed = set()
+        self.lock = threading.Lock()
+
+    # a peer finished its handshake: it counts as a neighbor missing every piece until its BITFIELD or HAVEs
+    def add_neighbor(self, remote_id):
+        with self.lock:
+            self.counted.add(remote_id)
+
+    # counts every piece in a peer's bitfield (after BITFIELD)
+    # with data (the BITFIELD payload), the pieces counted for it before are dropped and remote_bitfield is replaced
+    # by data first: remote bitfields are only changed under this lock, which pick() reads them under
+    def add_peer(self, remote_id, remote_bitfield, data=None):
+        with self.lock:
+            if data is not None:
+                self._uncount(remote_id, remote_bitfield)
+                remote_bitfield.from_bytes(data)
+            self.counted.add(remote_id)
+            if remote_bitfield.count == remote_bitfield.num_pieces:
+                self.seeds += 1
+            for i in remote_bitfield.iter_pieces():
+                self.availability[i] += 1
+
+    # stops counting a peer's pieces (on disconnect, or before its BITFIELD replaces them)
+    # with clear, remote_bitfield is emptied too, so a HAVE landing on it later is not counted against the old bits
+    def remove_peer(self, remote_id, remote_bitfield, clear=False):
+        with self.lock:
+            self._uncount(remote_id, remote_bitfield)
+            if clear:
+                remote_bitfield.from_bytes(b"")
+
+    def _uncount(self, remote_id, remote_bitfield):
+        if remote_id not in self.counted:
+            return
+        self.counted.discard(remote_id)
+        if remote_bitfield.count == remote_bitfield.num_pieces:
+            self.seeds -= 1
+        for i in remote_bitfield.iter_pieces():
+            self.availability[i] -= 1
+
+    # counts one new piece of a peer (after HAVE); given remote_bitfield, the piece is set in it here, and nothing is
+    # counted (False) if it was already there
+    def add_have(self, remote_id, index, remote_bitfield=None) -> bool:
+        with self.lock:
+            if remote_bitfield is not None:
+                if remote_bitfield.has_piece(index):
+                    return False
+                remote_bitfield.set_piece(index)
+            self.counted.add(remote_id)
+            self.availability[index] += 1
+            if remote_bitfield is not None and remote_bitfield.count == remote_bitfield.num_pieces:
+                self.seeds += 1
+            return True
+
+    # counted neighbors holding piece index
+    def holders(self, index) -> int:
+        return self.availability[index]
+
+    # counted neighbors still missing piece index
+    def missing_count(self, index) -> int:
+        return len(self.counted) - self.availability[index]
+
+    def in_endgame(self) -> bool:
+        return self.bitfield.num_pieces - self.bitfield.count <= self.endgame_threshold
+
+    # reserves up to count pieces remote has and we still need, rarest first with random tie-breaking
+    # in endgame, pieces requested from other neighbors are allowed too (least duplicated first)
+    def pick(self, remote_id, remote_bitfield, count):
+        if count <= 0:
+            return []
+        with self.lock:
+            if self.in_endgame():
+                # few pieces are missing in endgame, so there are few to look at
+                missing = self.bitfield.iter_missing_from(remote_bitfield)
+                candidates = [i for i in missing if remote_id not in self.reserved.get(i, ()) and i not in self.partial
+                              and i not in self.landed]
+                picked = heapq.nsmallest(count, candidates, key=lambda i: (len(self.reserved.get(i, ())),
+                                                                           self.availability[i], random.random()))
+            else:
+                picked = self._rarest(remote_bitfield, count)
+            for i in picked:
+                self.reserved.setdefault(i, set()).add(remote_id)
+            return picked
+
+    # up to count unreserved pieces remote has and we need, rarest first with random tie-breaking (lock held).
+    # No piece is rarer than one only remote has, so the scan of the missing pieces stops once count of those
+    # are found; it starts at a random word so that early stop does not favor the first pieces of the file
+    def _rarest(self, remote_bitfield, count):
+        candidates = []
+        rarest = 0
+        start = random.randrange(max(1, -(-self.bitfield.num_pieces // 64)))
+        for i in self.bitfield.iter_missing_from(remote_bitfield, start):
+            if i in self.reserved or i in self.partial or i in self.landed:
+                continue
+            candidates.append(i)
+            if self.availability[i] <= 1:
+                rarest += 1
+                if rarest >= count:
+                    break
+        return heapq.nsmallest(count, candidates, key=lambda i: (self.availability[i], random.random()))
+
+    # frees reservations remote_id holds on indices (choke, disconnect, timeout)
+    def unreserve(self, remote_id, indices):
+        with self.lock:
+            for i in indices:
+                holders = self.reserved.get(i)
+                if holders is not None:
+                    holders.discard(remote_id)
+                    if not holders:
+                        del self.reserved[i]
+
+    # a whole piece arrived from remote_id; returns the other peers it was also requested from, or None if it is
+    # not wanted from remote_id (we have it, another copy landed first, or the request was dropped). Like a piece
+    # assembled from blocks, it stays reserved by remote_id alone until complete() or reject()
+    def piece_received(self, remote_id, index):
+        with self.lock:
+            holders = self.reserved.get(index)
+            if self.bitfield.has_piece(index) or index in self.landed or not holders or remote_id not in holders:
+                return None
+            self.landed.add(index)
+            self.reserved[index] = {remote_id}
+            holders.discard(remote_id)
+            return holders
+
+    # piece landed, nobody needs to hold it anymore; returns the peers it was requested from
+    def complete(self, index):
+        with self.lock:
+            self.partial.pop(index, None)
+            self.landed.discard(index)
+            return self.reserved.pop(index, set())
+
+    # piece failed verification: drops every reservation and received block so it is fetched again from scratch
+    def reject(self, index):
+        with self.lock:
+            self.partial.pop(index, None)
+            self.landed.discard(index)
+            self.reserved.pop(index, None)
+
+    # byte length of block number block of the piece at index (the last block of the last piece may be short)
+    def _block_length(self, index, block):
+        piece_length = min(self.piece_size, self.file_size - index * self.piece_size)
+        return min(self.block_size, piece_length - block * self.block_size)
+
+    def _new_partial(self, index):
+        piece_length = min(self.piece_size, self.file_size - index * self.piece_size)
+        part = self.partial[index] = _PartialPiece(-(-piece_length // self.block_size))
+        return part
+
+    # reserves up to count blocks remote has and we still need, as (piece index, offset, length)
+    # pieces already in progress are finished first, then new pieces are started rarest first
+    # in endgame, blocks requested from other neighbors are allowed too
+    def pick_blocks(self, remote_id, remote_bitfield, count):
+        if count <= 0:
+            return []
+        picked = []
+        with self.lock:
+            endgame = self.in_endgame()
+            for index, part in self.partial.items():
+                if not remote_bitfield.has_piece(index):
+                    continue
+                self._reserve_blocks(remote_id, index, part, endgame, count, picked)
+                if len(picked) >= count:
+                    return picked
+
+            # every piece has at least one block, so count pieces is always enough
+            for index in self._rarest(remote_bitfield, count - len(picked)):
+                self._reserve_blocks(remote_id, index, self._new_partial(index), endgame, count, picked)
+                if len(picked) >= count:
+                    break
+            return picked
+
+    def _reserve_blocks(self, remote_id, index, part, endgame, count, picked):
+        for block in range(part.num_blocks):
+            if block in part.received:
+                continue
+            holders = part.reserved.get(block)
+            if holders and (not endgame or remote_id in holders):
+                continue
+            part.reserved.setdefault(block, set()).add(remote_id)
+            picked.append((index, block * self.block_size, self._block_length(index, block)))
+            if len(picked) >= count:
+                return
+
+    # true if length bytes at offset are a block of piece index still being fetched (anything else is stale or bogus)
+    def wants_block(self, index, offset, length):
+        part = self.partial.get(index)
+        if part is None or offset % self.block_size:
+            return False
+        block = offset // self.block_size
+        return block < part.num_blocks and block not in part.received and length == self._block_length(index, block)
+
+    # the block at offset landed from remote_id; returns (whether the piece now has every block,
+    # the other peers the block was also requested from). A complete piece stays reserved by remote_id
+    # until complete() or reject(), so it is not picked again while it is being verified.
+    def block_received(self, remote_id, index, offset):
+        with self.lock:
+            part = self.partial.get(index)
+            block = offset // self.block_size
+            if part is None or block in part.received:
+                return False, set()
+            part.received.add(block)
+            others = part.reserved.pop(block, set())
+            others.discard(remote_id)
+            if len(part.received) < part.num_blocks:
+                return False, others
+            del self.partial[index]
+            self.reserved[index] = {remote_id}
+            return True, others
+
+    # frees block reservations remote_id holds, given as (piece index, offset) pairs
+    def unreserve_blocks(self, remote_id, blocks):
+        with self.lock:
+            for index, offset in blocks:
+                part = self.partial.get(index)
+                if part is None:
+                    continue
+                holders = part.reserved.get(offset // self.block_size)
+                if holders is not None:
+                    holders.discard(remote_id)
+                    if not holders:
+                        del part.reserved[offset // self.block_size]
+                # untouched again: the piece goes back to the pool whole
+                if not part.reserved and not part.received:
+                    del self.partial[index]
+
+# a piece being fetched block by block
+class _PartialPiece:
+    __slots__ = ("num_blocks", "received", "reserved")
+
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        # block numbers already written to disk
+        self.received = set()
+        # block number -> peers it is requested from
+        self.reserved = {}
@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from manifest import hash_piece
+
+class PieceVerifier:
+    """
+    Checks received pieces against the manifest on a pool of hashing threads, off the network threads.
+    A piece that matches is stored with store_fn(index, data) and passed to on_verified(remote_id, index),
+    one that does not is dropped and passed to on_corrupt(remote_id, index).
+    Pieces assembled on disk from blocks are read back with read_fn(index) and stored with
+    store_fn(index, data, on_disk=True), which only has to record them.
+    """
+    def __init__(self, digests, store_fn, on_verified, on_corrupt, workers: int = None, read_fn=None):
+        self.digests = digests
+        self.store_fn = store_fn
+        self.read_fn = read_fn
+        self.on_verified = on_verified
+        self.on_corrupt = on_corrupt
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="piece-hash")
+
+    # true if data is the piece at index
+    def matches(self, index: int, data) -> bool:
+        return 0 <= index < len(self.digests) and hash_piece(data) == self.digests[index]
+
+    # data must be owned by the caller (not a view into a reused receive buffer), None if the piece is already on disk
+    def submit(self, remote_id: int, index: int, data: bytes = None):
+        self.pool.submit(self._verify, remote_id, index, data)
+
+    def _verify(self, remote_id, index, data):
+        on_disk = data is None
+        if on_disk:
+            data = self.read_fn(index)
+        if not self.matches(index, data):
+            self.on_corrupt(remote_id, index)
+            return
+        if on_disk:
+            self.store_fn(index, data, on_disk=True)
+        else:
+            self.store_fn(index, data)
+        self.on_verified(remote_id, index)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,206 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# frames kept per tracemalloc allocation
+TRACEMALLOC_FRAMES = 10
+# lines in the tracemalloc text summary
+TRACEMALLOC_TOP = 30
+
+class TimedLock:
+    """
+    Drop-in for threading.Lock that times how long acquiring it had to wait.
+    Uncontended acquisitions are only counted; waits go to the wait histogram series.
+    """
+    def __init__(self, lock, wait_series):
+        self.lock = lock
+        self.wait_series = wait_series
+        # approximate (not updated under a lock), good enough for a contention ratio
+        self.acquisitions = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        self.acquisitions += 1
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        got = self.lock.acquire(True, timeout)
+        self.wait_series.observe(time.perf_counter() - started)
+        return got
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+# a profiler's stats taken without disabling it (pstats would, from whatever thread reads it)
+class _Snapshot:
+    def __init__(self, profiler):
+        profiler.snapshot_stats()
+        self.stats = profiler.stats
+
+    def create_stats(self):
+        pass
+
+class Profiler:
+    """
+    Profiling for one peer process, turned on from the command line. Results are written to out_dir every interval
+    seconds and once more by stop() (PeerProcess.shutdown() calls it):
+      mode "cprofile": a cProfile per thread, merged into profile_peer_<id>.prof (pstats, snakeviz, ...)
+      mode "sample":   stacks of every thread sampled every sample_interval seconds, written as
+                       profile_peer_<id>.folded (flamegraph.pl, speedscope)
+      trace_memory:    tracemalloc snapshot in tracemalloc_peer_<id>.snap (tracemalloc.Snapshot.load) plus a
+                       top-allocations summary in tracemalloc_peer_<id>.txt
+      time_locks:      time spent waiting for the peer's shared locks, in locks_peer_<id>.json (and in its metrics)
+    """
+    def __init__(self, peer_id: int, out_dir: str = ".", mode: str = None, interval: float = 30.0,
+                 sample_interval: float = 0.005, trace_memory: bool = False, time_locks: bool = False):
+        self.peer_id = peer_id
+        self.out_dir = out_dir
+        self.mode = mode
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.time_locks = time_locks
+        # one cProfile.Profile per profiled thread
+        self.profilers = []
+        # "thread;outer;...;inner" -> samples
+        self.samples = {}
+        # lock name -> TimedLock
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _path(self, kind: str, ext: str) -> str:
+        return os.path.join(self.out_dir, f"{kind}_peer_{self.peer_id}.{ext}")
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.mode == "cprofile":
+            # threads started from now on get their profiler on their first call; this thread gets one now
+            threading.setprofile(self._start_thread_profiler)
+            self._start_thread_profiler()
+        elif self.mode == "sample":
+            threading.Thread(target=self._sampler, name="profile-sampler", daemon=True).start()
+        if self.trace_memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        threading.Thread(target=self._dumper, name="profile-dumper", daemon=True).start()
+        return self
+
+    # replaces the peer's shared locks by timed ones, call before the peer starts its threads
+    def instrument(self, pp):
+        if not self.time_locks:
+            return
+        wait = pp.metrics.registry.histogram("p2p_lock_wait_seconds", "Time spent waiting to acquire a contended lock.",
+                                             ("lock",))
+        def timed(name, lock):
+            self.locks[name] = TimedLock(lock, wait.labels(name))
+            return self.locks[name]
+
+        # the shares take the host's conn_lock whenever they use it
+        pp.conn_lock = timed("conn_lock", pp.conn_lock)
+        for share in pp.shares:
+            suffix = "" if share.content_id is None else f"[{share.config.file_name}]"
+            share.choke_manager.lock = timed("choke_manager" + suffix, share.choke_manager.lock)
+            share.have_lock = timed("have_lock" + suffix, share.have_lock)
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.mode == "cprofile":
+            threading.setprofile(None)
+        self.dump()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    # installed with threading.setprofile: the first profiling event of a new thread lands here, and enable()
+    # replaces this hook with the thread's own profiler
+    def _start_thread_profiler(self, *args):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            sys.setprofile(None) # the interpreter allows one profiler at a time (3.12+): the first one sees all threads
+            return
+        with self.lock:
+            self.profilers.append(profiler)
+
+    def _sampler(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.sample_interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _dumper(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.dump()
+            except Exception:
+                continue
+
+    # writes everything collected so far
+    def dump(self):
+        if self.mode == "cprofile":
+            with self.lock:
+                profilers = list(self.profilers)
+            # pstats refuses empty stats (a thread that has not returned from any call yet)
+            snapshots = [s for s in map(_Snapshot, profilers) if s.stats]
+            if snapshots:
+                stats = pstats.Stats(snapshots[0])
+                for snapshot in snapshots[1:]:
+                    stats.add(snapshot)
+                self._replace(self._path("profile", "prof"), stats.dump_stats)
+        elif self.mode == "sample":
+            lines = "".join(f"{stack} {count}\n" for stack, count in sorted(dict(self.samples).items()))
+            self._replace(self._path("profile", "folded"), lambda path: self._write_text(path, lines))
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            self._replace(self._path("tracemalloc", "snap"), snapshot.dump)
+            top = "".join(f"{stat}\n" for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP])
+            current, peak = tracemalloc.get_traced_memory()
+            text = f"traced memory: {current} bytes, peak {peak} bytes\n{top}"
+            self._replace(self._path("tracemalloc", "txt"), lambda path: self._write_text(path, text))
+        if self.locks:
+            report = {}
+            for name, lock in self.locks.items():
+                cumulative, total, waits = lock.wait_series.read()
+                report[name] = {"acquisitions": lock.acquisitions, "contended": waits, "wait_seconds": total}
+            text = json.dumps(report, indent=2) + "\n"
+            self._replace(self._path("locks", "json"), lambda path: self._write_text(path, text))
+
+    @staticmethod
+    def _write_text(path: str, text: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    # write_fn(path) writes a temporary file that then replaces path, so readers never see half a dump
+    @staticmethod
+    def _replace(path: str, write_fn):
+        tmp = path + ".tmp"
+        write_fn(tmp)
+        os.replace(tmp, path)
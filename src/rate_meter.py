@@ -0,0 +1,44 @@
+import math
+from array import array
+import threading
+import time
+
+class RateMeter:
+    """
+    Bytes per second over the last `window` seconds, counted in `bucket`-second buckets.
+    One burst or pause only moves the rate by its share of the window, and old traffic falls out of it entirely.
+    Safe to update and read from different threads.
+    """
+    # every peer has two per file, so they are kept small
+    __slots__ = ("bucket", "buckets", "start", "newest", "lock")
+
+    def __init__(self, window: float, bucket: float = 1.0):
+        self.bucket = bucket
+        self.buckets = array("Q", bytes(8 * max(1, math.ceil(window / bucket))))
+        self.start = time.monotonic()
+        # number of the newest bucket, counted from start
+        self.newest = 0
+        self.lock = threading.Lock()
+
+    # zeroes the buckets that went by since the last update, so they can be reused for newer time
+    def _advance(self, now: float):
+        current = int((now - self.start) / self.bucket)
+        if current > self.newest:
+            for n in range(max(self.newest + 1, current - len(self.buckets) + 1), current + 1):
+                self.buckets[n % len(self.buckets)] = 0
+            self.newest = current
+
+    def add(self, nbytes: int, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self._advance(now)
+            self.buckets[self.newest % len(self.buckets)] += nbytes
+
+    def rate(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self._advance(now)
+            # the full older buckets plus the part of the current one that has passed (less for a young meter)
+            elapsed = now - self.start
+            span = min(elapsed, (len(self.buckets) - 1) * self.bucket + (elapsed - self.newest * self.bucket))
+            return sum(self.buckets) / max(span, self.bucket / 10)
@@ -0,0 +1,127 @@
+import math
+import threading
+import time
+
+class _Timer:
+    __slots__ = ("deadline", "tick", "fn", "interval", "cancelled")
+
+    def __init__(self, deadline: float, tick: int, fn, interval):
+        self.deadline = deadline
+        self.tick = tick
+        self.fn = fn
+        # seconds between runs of a periodic timer, None for a one-shot
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel:
+    """
+    Timers on a hashed wheel of num_slots buckets, each tick seconds wide.
+    - Timers fire on the first tick boundary at or after their deadline.
+    - advance() runs whatever is due and returns how long until the next tick that has work.
+      run() does that on a thread, and other engines drive advance() themselves: wakeup() is called whenever
+      a timer is added, so the driver can come back early.
+    - Periodic timers are due at first + n * interval however long their callbacks take, so they do not drift.
+      Deadlines missed while the wheel was not advanced are skipped, not run back to back.
+    - Callbacks run outside the wheel's lock and may schedule timers. An exception goes to on_error(exc) and
+      the other timers keep running.
+    """
+    def __init__(self, tick: float = 0.05, num_slots: int = 256, on_error=None):
+        self.tick = tick
+        self.num_slots = num_slots
+        self.slots = [[] for _ in range(num_slots)]
+        # last tick advanced to
+        self.cursor = math.floor(time.monotonic() / tick)
+        self.on_error = on_error
+        # called (from any thread) when a timer is added, for drivers waiting on something else than self.cond
+        self.wakeup = None
+        self.cond = threading.Condition()
+        self.changed = False
+
+    def _add(self, timer: _Timer):
+        with self.cond:
+            # a timer already due goes in the next tick's slot
+            timer.tick = max(timer.tick, self.cursor + 1)
+            self.slots[timer.tick % self.num_slots].append(timer)
+            self.changed = True
+            self.cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def _tick_of(self, deadline: float) -> int:
+        return math.ceil(deadline / self.tick)
+
+    # runs fn once at monotonic time `when`; returns the timer, cancel() drops it
+    def call_at(self, when: float, fn) -> _Timer:
+        timer = _Timer(when, self._tick_of(when), fn, None)
+        self._add(timer)
+        return timer
+
+    def call_later(self, delay: float, fn) -> _Timer:
+        return self.call_at(time.monotonic() + delay, fn)
+
+    # runs fn every interval seconds, the first time interval seconds from now
+    def every(self, interval: float, fn) -> _Timer:
+        deadline = time.monotonic() + interval
+        timer = _Timer(deadline, self._tick_of(deadline), fn, interval)
+        self._add(timer)
+        return timer
+
+    # runs the timers due by now, returns seconds until the next tick with a timer (one revolution at most)
+    def advance(self, now: float = None) -> float:
+        now = time.monotonic() if now is None else now
+        target = math.floor(now / self.tick)
+        due = []
+        with self.cond:
+            if target > self.cursor:
+                # a gap longer than one revolution still looks at every slot once
+                for t in range(self.cursor + 1, min(target, self.cursor + self.num_slots) + 1):
+                    slot = self.slots[t % self.num_slots]
+                    keep = []
+                    for timer in slot:
+                        if timer.cancelled:
+                            continue
+                        (due if timer.tick <= target else keep).append(timer)
+                    self.slots[t % self.num_slots] = keep
+                self.cursor = target
+        due.sort(key=lambda timer: timer.deadline)
+        for timer in due:
+            try:
+                timer.fn()
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+            if timer.interval is not None and not timer.cancelled:
+                timer.deadline += timer.interval
+                if timer.deadline < now:
+                    timer.deadline += timer.interval * math.ceil((now - timer.deadline) / timer.interval)
+                timer.tick = self._tick_of(timer.deadline)
+                self._add(timer)
+        return self._next_delay(time.monotonic())
+
+    def _next_delay(self, now: float) -> float:
+        with self.cond:
+            for k in range(1, self.num_slots + 1):
+                t = self.cursor + k
+                if any(timer.tick == t and not timer.cancelled for timer in self.slots[t % self.num_slots]):
+                    return max(0.0, t * self.tick - now)
+        return self.num_slots * self.tick
+
+    # drives the wheel on the calling thread until stopped is set (call wake() after setting it)
+    def run(self, stopped: threading.Event):
+        while not stopped.is_set():
+            with self.cond:
+                self.changed = False
+            delay = self.advance()
+            with self.cond:
+                if not self.changed and not stopped.is_set():
+                    self.cond.wait(delay)
+
+    def wake(self):
+        with self.cond:
+            self.changed = True
+            self.cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
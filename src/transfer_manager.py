@@ -1,61 +1,331 @@
-import random
+import errno
+import math
+import os
+import struct
 import threading
 import time
-from message_handler import send_message, recv_message, REQUEST, PIECE, HAVE
+from collections import deque
+from messages import FEATURE_BLOCKS
+from message_handler import piece_header, block_header, REQUEST, CANCEL, REQUEST_BLOCK
 from logger import log
+from metrics import PeerMetrics
+
+# seconds of transfer at the observed rate that the request window should cover
+REQUEST_QUEUE_TIME = 1.0
+# uploads stream from the file descriptor to the socket when the platform has sendfile
+_HAS_SENDFILE = hasattr(os, "sendfile")
+# requests with no PIECE after this many seconds are dropped so the piece can be asked for again
+REQUEST_TIMEOUT = 10.0
+# requests one neighbor may have waiting to be sent, more are dropped (it asks again after REQUEST_TIMEOUT)
+MAX_QUEUED_UPLOADS = 256
 
 class TransferManager:
-    def __init__(self, peer_id, config, bitfield, file_mgr, peers_state, conn_map, parent_peer):
+    def __init__(self, peer_id, config, bitfield, file_mgr, peers_state, conn_map, parent_peer, picker, limiter=None,
+                 metrics=None):
         self.peer_id = peer_id
         self.config = config
         self.bitfield = bitfield
         self.file_mgr = file_mgr
+        # shared across all download loops so each piece is requested from one neighbor at a time
+        self.picker = picker
         self.peers_state = peers_state
         self.conn_map = conn_map
         self.parent = parent_peer
+        # BandwidthLimiter, None when nothing is capped
+        self.limiter = limiter
+        self.metrics = metrics if metrics is not None else PeerMetrics()
+        # set for files from Files.cfg: the PIECE/BLOCK messages we send go inside CONTENT messages with this id
+        self.content_id = None
+        # remote_id -> {piece index, or (piece index, offset) for a block: time the request was sent}
+        self.in_flight = {}
+        # held while in_flight and the picker's reservations change together: the download loops, the listeners
+        # (CHOKE, PIECE, BLOCK) and the hash pool all do
+        self.lock = threading.Lock()
+        # remote_id -> event its download loop (PeerProcess._download_loop) waits on, set when a piece lands
+        # or the remote's state changes
+        self.wakeups = {}
+        # remote_id -> (piece index, offset, length or None for the whole piece) it requested and is not sent yet
+        # (CANCEL removes them)
+        self.upload_queues = {}
+        # remote_id -> event the asyncio upload loop waits on, set when a request is queued
+        self.upload_wakeups = {}
+
+    # true if pieces are fetched from remote_id in blocks (it supports them and pieces are bigger than a block)
+    def uses_blocks(self, remote_id) -> bool:
+        ps = self.peers_state[remote_id]
+        return bool(ps.features & FEATURE_BLOCKS) and self.config.block_size < self.config.piece_size
 
-    def download_loop(self, remote_id):
-        """
-        Loop which continuously requests pieces from remote while unchoked and interested.
-        This runs in a single thread per remote to avoid duplication.
-        """
-        while self.parent.running:
-            ps = self.peers_state.get(remote_id)
-            conn = None
-            with self.parent.conn_lock:
-                conn = self.conn_map.get(remote_id)
-            if conn is None:
+    # how many requests to keep outstanding to remote_id, sized to its observed download rate
+    def request_window(self, remote_id, blocks: bool = False) -> int:
+        ps = self.peers_state[remote_id]
+        unit = self.config.block_size if blocks else self.config.piece_size
+        wanted = math.ceil(ps.download_rate * REQUEST_QUEUE_TIME / unit)
+        return max(self.config.min_request_window, min(self.config.max_request_window, wanted))
+
+    # sends requests to remote_id until its window is full, returns False if the connection is gone.
+    # The requests are picked and recorded under the lock and sent after it, so a peer slow to take its messages
+    # holds up nobody else's transfers
+    def fill_window(self, remote_id, send_fn) -> bool:
+        with self.lock:
+            requests, unit, allowed = self._pick_requests(remote_id)
+        sent = 0
+        for key, msg_type, payload in requests:
+            if not send_fn(remote_id, msg_type, payload):
                 break
+            sent += 1
+            if isinstance(key, tuple):
+                log(self.peer_id, f"requested block {key[1]} of piece {key[0]} from {remote_id}.")
+            else:
+                log(self.peer_id, f"requested piece {key} from {remote_id}.")
+        if sent < len(requests):
+            with self.lock:
+                # a CHOKE or disconnect may have released them meanwhile
+                pending = self.in_flight.get(remote_id, {})
+                unsent = [k for k, _, _ in requests[sent:] if pending.pop(k, None) is not None]
+                self._unreserve(remote_id, unsent)
+        # tokens were taken for the whole allowance, give back those of requests not picked or not sent
+        if allowed > sent:
+            self.limiter.download_refund(remote_id, (allowed - sent) * unit)
+        return sent == len(requests)
 
-            # if we are choked or not interested, wait
-            if ps.is_choked or not ps.our_interest:
-                time.sleep(0.5)
-                continue
+    # reserves the requests that fill remote_id's window and records them as sent, returns
+    # ([(in_flight key, message type, payload)], bytes per request, download tokens taken in requests) (lock held)
+    def _pick_requests(self, remote_id):
+        ps = self.peers_state[remote_id]
+        pending = self.in_flight.setdefault(remote_id, {})
+        now = time.time()
+        for key, sent_at in list(pending.items()):
+            if self.bitfield.has_piece(key[0] if isinstance(key, tuple) else key):
+                pending.pop(key, None)
+            elif now - sent_at > REQUEST_TIMEOUT:
+                pending.pop(key, None)
+                self._unreserve(remote_id, [key])
 
-            # choose a piece randomly among missing ones that remote has
-            missing = self.bitfield.missing_pieces_from(ps.remote_bitfield)
-            if not missing:
-                # nothing to request from this peer anymore
-                time.sleep(0.5)
-                continue
+        blocks = self.uses_blocks(remote_id)
+        unit = self.config.block_size if blocks else self.config.piece_size
+        free = self.request_window(remote_id, blocks) - len(pending)
+        allowed = 0
+        if free > 0 and self.limiter is not None:
+            # over the download cap: the loop tries again when a piece lands or on its next timeout
+            sharers = sum(1 for p in list(self.peers_state.values()) if not p.is_choked and p.our_interest)
+            free = allowed = self.limiter.download_allowance(remote_id, unit, free, sharers)
+        if free <= 0:
+            return [], unit, allowed
 
-            idx = random.choice(missing)
-            try:
-                send_message(conn, REQUEST, idx.to_bytes(4, "big"))
-                log(self.peer_id, f"requested piece {idx} from {remote_id}.")
-            except Exception:
-                break
-            time.sleep(0.2)
+        # rarest pieces (or blocks of pieces in progress) remote has that no neighbor is being asked for yet
+        if blocks:
+            requests = [((idx, offset), REQUEST_BLOCK, struct.pack("!III", idx, offset, length))
+                        for idx, offset, length in self.picker.pick_blocks(remote_id, ps.remote_bitfield, free)]
+        else:
+            requests = [(idx, REQUEST, idx.to_bytes(4, "big"))
+                        for idx in self.picker.pick(remote_id, ps.remote_bitfield, free)]
+        for key, _, _ in requests:
+            pending[key] = now
+        return requests, unit, allowed
 
+    # frees in_flight keys of remote_id in the picker (lock held)
+    def _unreserve(self, remote_id, keys):
+        pieces = [k for k in keys if not isinstance(k, tuple)]
+        blocks = [k for k in keys if isinstance(k, tuple)]
+        if pieces:
+            self.picker.unreserve(remote_id, pieces)
+        if blocks:
+            self.picker.unreserve_blocks(remote_id, blocks)
 
-    def handle_request_and_send_piece(self, conn, piece_index, remote_id):
-        if not self.bitfield.has_piece(piece_index):
+    # drops every outstanding request to remote_id for piece_index (whole or in blocks), returns True if there was one
+    # (lock held)
+    def _forget_piece(self, remote_id, piece_index) -> bool:
+        pending = self.in_flight.get(remote_id, {})
+        # a snapshot: the download loop adds requests to pending from its own thread meanwhile
+        keys = [k for k in list(pending) if (k[0] if isinstance(k, tuple) else k) == piece_index]
+        for k in keys:
+            pending.pop(k, None)
+        return bool(keys)
+
+    # wakes the download loop for remote_id so it can top up its window
+    def wake(self, remote_id):
+        wake = self.wakeups.get(remote_id)
+        if wake is not None:
+            wake.set()
+
+    # a whole piece arrived from remote_id; returns False if it is not wanted (a late endgame duplicate,
+    # a piece we have or a request we dropped), otherwise the piece is stored and the other neighbors asked for it
+    # are told to stop
+    def accept_piece(self, remote_id, piece_index) -> bool:
+        with self.lock:
+            others = self.picker.piece_received(remote_id, piece_index)
+            if others is None:
+                self.in_flight.get(remote_id, {}).pop(piece_index, None)
+                return False
+            others = self._forget_others(remote_id, piece_index, others)
+        self._send_cancels(others, piece_index)
+        return True
+
+    def on_piece_received(self, remote_id, piece_index):
+        with self.lock:
+            sent_at = self.in_flight.get(remote_id, {}).get(piece_index)
+            if sent_at is not None:
+                self.metrics.piece_latency.observe(time.time() - sent_at)
+            self._forget_piece(remote_id, piece_index)
+            others = self._forget_others(remote_id, piece_index, self.picker.complete(piece_index))
+        self._send_cancels(others, piece_index)
+        self.wake(remote_id)
+
+    # endgame: stops waiting for piece_index from the other neighbors it was asked from, returns them (lock held)
+    def _forget_others(self, remote_id, piece_index, others) -> list:
+        others = [other for other in others if other != remote_id]
+        for other in others:
+            self._forget_piece(other, piece_index)
+        return others
+
+    # tells others they no longer need to send piece_index (or its block at offset), called without the lock
+    def _send_cancels(self, others, piece_index, offset=None, length=None):
+        for other in others:
+            if offset is None:
+                if self.parent._send_to(other, CANCEL, piece_index.to_bytes(4, "big")):
+                    log(self.peer_id, f"sent the 'cancel' message to {other} for the piece {piece_index}.")
+            elif self.parent._send_to(other, CANCEL, struct.pack("!III", piece_index, offset, length)):
+                log(self.peer_id, f"sent the 'cancel' message to {other} for block {offset} of piece {piece_index}.")
+            self.wake(other)
+
+    # a block (written to disk already) landed from remote_id; returns True once its piece has every block
+    def on_block_received(self, remote_id, piece_index, offset, length) -> bool:
+        with self.lock:
+            sent_at = self.in_flight.get(remote_id, {}).pop((piece_index, offset), None)
+            if sent_at is not None:
+                self.metrics.block_latency.observe(time.time() - sent_at)
+            complete, others = self.picker.block_received(remote_id, piece_index, offset)
+            # endgame: the other neighbors asked for this block no longer need to send it
+            for other in others:
+                self.in_flight.get(other, {}).pop((piece_index, offset), None)
+        self._send_cancels(others, piece_index, offset, length)
+        self.wake(remote_id)
+        return complete
+
+    # a block from remote_id was not used, stop waiting for it and free its reservation
+    def drop_block(self, remote_id, piece_index, offset):
+        with self.lock:
+            self.in_flight.get(remote_id, {}).pop((piece_index, offset), None)
+            self.picker.unreserve_blocks(remote_id, [(piece_index, offset)])
+
+    # piece failed verification: free it (and any blocks of it) for every neighbor,
+    # but let the loop retry on its own schedule
+    def on_piece_rejected(self, remote_id, piece_index):
+        with self.lock:
+            self._forget_piece(remote_id, piece_index)
+            self.picker.reject(piece_index)
+
+    # forgets outstanding requests to remote_id (on choke or disconnect) so other neighbors can take them
+    def release(self, remote_id):
+        with self.lock:
+            pending = self.in_flight.pop(remote_id, {})
+            self._unreserve(remote_id, list(pending))
+        self.wake(remote_id)
+
+    # remote asked for piece_index (length None) or a block of it, the upload loop for remote sends it in order
+    def queue_request(self, remote_id, piece_index, offset=0, length=None):
+        queue = self.upload_queues.setdefault(remote_id, deque())
+        if len(queue) >= MAX_QUEUED_UPLOADS:
             return
+        queue.append((piece_index, offset, length))
+        wake = self.upload_wakeups.get(remote_id)
+        if wake is not None:
+            wake.set()
+
+    # remote withdrew its request (every request for the piece if offset is None), drop it if it has not been sent yet
+    def cancel_request(self, remote_id, piece_index, offset=None, length=None):
+        queue = self.upload_queues.get(remote_id)
+        if not queue:
+            return
+        for entry in list(queue):
+            if entry[0] == piece_index and (offset is None or entry[1:] == (offset, length)):
+                try:
+                    queue.remove(entry)
+                except ValueError:
+                    pass # sent in the meantime
+
+    # oldest request of remote that is still wanted, None if there is none
+    def next_upload(self, remote_id):
         try:
-            data = self.file_mgr.get_piece(piece_index)
-            if data is None:
-                return
-            send_message(conn, PIECE, piece_index.to_bytes(4, "big") + data)
+            return self.upload_queues.get(remote_id, deque()).popleft()
+        except IndexError:
+            return None
+
+    # drops everything remote requested (on disconnect)
+    def clear_uploads(self, remote_id):
+        self.upload_queues.pop(remote_id, None)
+        wake = self.upload_wakeups.get(remote_id)
+        if wake is not None:
+            wake.set()
+
+    # seconds the upload queue entry for remote_id has to wait under the upload caps (its tokens are taken now)
+    def upload_delay(self, remote_id, entry) -> float:
+        if self.limiter is None:
+            return 0.0
+        return self.limiter.upload_delay(remote_id, self._upload_range(*entry)[1])
+
+    # sends one upload queue entry on conn, called by the connection's writer (the only thread writing to it)
+    def send_upload(self, conn, remote_id, entry):
+        piece_index, offset, length = entry
+        self.handle_request_and_send_piece(conn, piece_index, remote_id, offset, length)
+
+    # sends the whole piece as a PIECE message (length None), or one block of it as a BLOCK message
+    # socket errors propagate: a message cut off halfway leaves the connection unusable
+    def handle_request_and_send_piece(self, conn, piece_index, remote_id, offset=0, length=None):
+        if not self.bitfield.has_piece(piece_index):
+            return
+        start, size, header = self._upload_range(piece_index, offset, length)
+        if self.file_mgr.fd is None or size == 0:
+            return
+        if _HAS_SENDFILE:
+            conn.sendall(header)
+            sent = self._sendfile(conn, start, size)
+            if sent < size:
+                # sendfile refused this file/socket or the file is short, finish the message with a plain read
+                rest = self.file_mgr.get_piece(piece_index)[offset + sent:offset + size]
+                conn.sendall(rest.ljust(size - sent, b"\x00"))
+        else:
+            conn.sendall(self.build_piece_frame(piece_index, offset, length))
+        self.on_uploaded(remote_id, piece_index, offset, length)
+
+    # file offset, byte count and message header for the whole piece (length None) or a block of it
+    def _upload_range(self, piece_index, offset, length):
+        start, piece_length = self.file_mgr.piece_range(piece_index)
+        if length is None:
+            return start, piece_length, piece_header(piece_index, piece_length, self.content_id)
+        size = max(0, min(length, piece_length - offset))
+        return start + offset, size, block_header(piece_index, offset, size, self.content_id)
+
+    # counts a sent piece (or block) toward remote_id's upload rate and logs it
+    def on_uploaded(self, remote_id, piece_index, offset, length):
+        size = self._upload_range(piece_index, offset, length)[1]
+        self.peers_state[remote_id].update_upload(size)
+        self.metrics.bytes_sent.labels(remote_id).inc(size)
+        (self.metrics.pieces_sent if length is None else self.metrics.blocks_sent).labels(remote_id).inc()
+        if length is None:
             log(self.peer_id, f"sent piece {piece_index} to {remote_id}.")
-        except Exception:
-            pass
+        else:
+            log(self.peer_id, f"sent block {offset} of piece {piece_index} to {remote_id}.")
+
+    # streams length bytes at offset from our file straight to the socket, returns how many were sent
+    def _sendfile(self, conn, offset, length):
+        sent = 0
+        while sent < length:
+            try:
+                n = os.sendfile(conn.fileno(), self.file_mgr.fd, offset + sent, length - sent)
+            except OSError as e:
+                if sent == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    return 0
+                raise
+            if n == 0:
+                break
+            sent += n
+        return sent
+
+    # whole PIECE (or BLOCK) message in one buffer, the data is read directly into it after the header
+    def build_piece_frame(self, piece_index, offset=0, length=None) -> bytearray:
+        start, size, header = self._upload_range(piece_index, offset, length)
+        frame = bytearray(len(header) + size)
+        frame[:len(header)] = header
+        self.file_mgr.read_into(piece_index, memoryview(frame)[len(header):], offset)
+        return frame
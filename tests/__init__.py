@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules in src import each other by bare name (they run as scripts from there), so src has to be on the path
+# for the tests' `from src.<module> import ...` to load them
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
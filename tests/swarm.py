@@ -0,0 +1,42 @@
+import os
+
+from src.benchmark import free_port
+
+# configuration and seed files for tests that run peers (see tests/test_peer_process.py)
+
+FIRST_PEER_ID = 1001
+FILE_NAME = "shared.dat"
+
+# writes base_dir/configuration (Common.cfg, PeerInfo.cfg and, with files, Files.cfg) for peers peers starting at
+# FIRST_PEER_ID, the first seeders of them holding FILE_NAME and every file in files ({name: size}) in
+# base_dir/work/peer_<id>/; returns (config_dir, work_dir)
+def make_swarm(base_dir: str, peers: int, seeders: int, file_size: int, piece_size: int, common=None, files=None):
+    config_dir = os.path.join(base_dir, "configuration")
+    work_dir = os.path.join(base_dir, "work")
+    os.makedirs(config_dir)
+    os.makedirs(work_dir)
+    settings = {
+        "NumberOfPreferredNeighbors": 1,
+        "UnchokingInterval": 1,
+        "OptimisticUnchokingInterval": 2,
+        "FileName": FILE_NAME,
+        "FileSize": file_size,
+        "PieceSize": piece_size,
+    }
+    settings.update(common or {})
+    with open(os.path.join(config_dir, "Common.cfg"), "w", encoding="utf-8") as f:
+        f.write("".join(f"{key} {value}\n" for key, value in settings.items()))
+    with open(os.path.join(config_dir, "PeerInfo.cfg"), "w", encoding="utf-8") as f:
+        f.write("".join(f"{FIRST_PEER_ID + i} 127.0.0.1 {free_port()} {int(i < seeders)}\n" for i in range(peers)))
+    shared = {FILE_NAME: file_size}
+    if files:
+        shared.update(files)
+        with open(os.path.join(config_dir, "Files.cfg"), "w", encoding="utf-8") as f:
+            f.write("".join(f"{name} {size}\n" for name, size in files.items()))
+    for name, size in shared.items():
+        data = os.urandom(size)
+        for i in range(seeders):
+            os.makedirs(os.path.join(work_dir, f"peer_{FIRST_PEER_ID + i}"), exist_ok=True)
+            with open(os.path.join(work_dir, f"peer_{FIRST_PEER_ID + i}", name), "wb") as f:
+                f.write(data)
+    return config_dir, work_dir
@@ -0,0 +1,22 @@
+import unittest
+
+from src.backoff import Backoff
+
+
+class TestBackoff(unittest.TestCase):
+    def test_doubles_up_to_cap_with_jitter(self):
+        backoff = Backoff(1.0, 4.0)
+        steps = [1.0, 2.0, 4.0, 4.0, 4.0]
+        for step in steps:
+            assert step / 2 <= backoff.next() <= step
+
+    def test_reset_starts_over(self):
+        backoff = Backoff(0.5, 10.0)
+        for _ in range(5):
+            backoff.next()
+        backoff.reset()
+        assert backoff.next() <= 0.5
+
+
+if __name__ == "__main__":
+    unittest.main()
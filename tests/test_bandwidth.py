@@ -0,0 +1,55 @@
+import unittest
+from types import SimpleNamespace
+
+from src.bandwidth import TokenBucket, BandwidthLimiter
+
+
+def limits(up=0, down=0, peer_up=0, peer_down=0):
+    return SimpleNamespace(max_upload_rate=up, max_download_rate=down,
+                           max_peer_upload_rate=peer_up, max_peer_download_rate=peer_down)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        assert bucket.reserve(10 ** 9) == 0
+        assert bucket.available(100, 7) == 7
+
+    def test_debt_is_paid_back_at_rate(self):
+        bucket = TokenBucket(1000)
+        assert bucket.reserve(1000) == 0 # one second of burst
+        assert abs(bucket.reserve(500) - 0.5) < 0.05
+
+    def test_available_allows_one_oversized_send(self):
+        bucket = TokenBucket(100)
+        assert bucket.available(1000, 5) == 1
+        bucket.consume(1000)
+        assert bucket.available(1000, 5) == 0
+
+    def test_refund_stops_at_a_full_bucket(self):
+        bucket = TokenBucket(1000)
+        bucket.consume(300)
+        bucket.refund(500)
+        assert bucket.tokens == 1000
+
+
+class TestBandwidthLimiter(unittest.TestCase):
+    def test_per_peer_caps_are_separate(self):
+        limiter = BandwidthLimiter(limits(peer_down=1000))
+        assert limiter.download_allowance(1, 250, 10) == 4
+        assert limiter.download_allowance(1, 250, 10) == 0
+        assert limiter.download_allowance(2, 250, 10) == 4
+
+    def test_global_download_shared_between_neighbors(self):
+        limiter = BandwidthLimiter(limits(down=1000))
+        assert limiter.download_allowance(1, 100, 10, sharers=2) == 5
+        assert limiter.download_allowance(2, 100, 10, sharers=2) == 5
+
+    def test_upload_delay_uses_stricter_cap(self):
+        limiter = BandwidthLimiter(limits(up=10_000, peer_up=1000))
+        assert limiter.upload_delay(1, 1000) == 0
+        assert limiter.upload_delay(1, 1000) > 0.9
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import argparse
+import shutil
+import tempfile
+import unittest
+
+from src.benchmark import run_swarm
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_small_swarm_completes(self):
+        args = argparse.Namespace(peers=3, seeders=1, file_size=50000, piece_size=4096, preferred=2,
+                                  unchoking_interval=1, optimistic_interval=2, set=[("BlockSize", 1024)],
+                                  use_async=False, timeout=30)
+        base_dir = tempfile.mkdtemp()
+        try:
+            report = run_swarm(args, base_dir)
+        finally:
+            shutil.rmtree(base_dir, ignore_errors=True)
+        self.assertTrue(report["complete"])
+        self.assertEqual(len(report["peers_detail"]), 3)
+        self.assertEqual(report["peers_detail"][0]["completion_s"], 0.0) # the seeder
+        self.assertGreater(report["throughput_bytes_per_s"], 0)
+        self.assertEqual(report["params"]["common"], {"BlockSize": 1024})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from src.bitfield import Bitfield
+
+
+class TestBitfield(unittest.TestCase):
+    def test_wire_order(self):
+        bf = Bitfield(10)
+        bf.set_piece(0)
+        bf.set_piece(9)
+        assert bf.to_bytes() == b"\x80\x40"
+
+    def test_count_is_incremental(self):
+        bf = Bitfield(10)
+        bf.set_piece(3)
+        bf.set_piece(3) # setting twice counts once
+        bf.set_piece(7)
+        assert bf.count == 2
+        assert not bf.is_complete()
+
+    def test_set_all_and_spare_bits(self):
+        bf = Bitfield(10)
+        bf.set_all()
+        assert bf.is_complete() and bf.count == 10
+        assert bf.to_bytes() == b"\xff\xc0" # spare bits stay 0
+        assert bf.first_missing() is None
+
+    def test_from_bytes_recounts_and_masks(self):
+        bf = Bitfield(10)
+        bf.from_bytes(b"\xff\xff")
+        assert bf.count == 10 and bf.is_complete()
+        bf.from_bytes(b"\x01")
+        assert bf.count == 1 and list(bf.iter_pieces()) == [7]
+
+    def test_missing_pieces_from(self):
+        ours = Bitfield(70)
+        theirs = Bitfield(70)
+        for i in (1, 5, 64, 69):
+            theirs.set_piece(i)
+        ours.set_piece(5)
+        assert ours.missing_pieces_from(theirs) == [1, 64, 69]
+        assert theirs.missing_pieces_from(ours) == []
+        assert ours.missing_any_from(theirs) and not theirs.missing_any_from(ours)
+        # from the second 64-piece word, wrapping around to the first
+        assert list(ours.iter_missing_from(theirs, 1)) == [64, 69, 1]
+
+    def test_first_missing(self):
+        bf = Bitfield(20)
+        for i in range(13):
+            bf.set_piece(i)
+        assert bf.first_missing() == 13
+
+    def test_matches_per_bit_scan(self):
+        bf = Bitfield(1000)
+        for i in range(0, 1000, 7):
+            bf.set_piece(i)
+        assert list(bf.iter_pieces()) == [i for i in range(1000) if bf.has_piece(i)]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import types
+import unittest
+
+from src.choke_manager import ChokeManager
+
+
+class TestChokeManagerEvents(unittest.TestCase):
+    def setUp(self):
+        config = types.SimpleNamespace(num_pref_neighbors=2, unchoking_interval=5, opt_unchoking_interval=10)
+        self.sent = []
+        self.cm = ChokeManager(1, config, {}, {}, lambda: False, lambda pid, msg: self.sent.append((pid, msg)))
+        self.cm.wheel.call_later = lambda delay, fn: self.scheduled.append(fn)
+        self.scheduled = []
+
+    def test_preferred_neighbor_leaving_schedules_one_selection(self):
+        self.cm.preferred_neighbors = {2, 3}
+        self.cm.forget(2)
+        self.cm.on_interest(3, False)
+        self.assertEqual(self.scheduled, [self.cm._select_preferred_neighbors])
+        self.assertEqual(self.sent, []) # nothing is sent by the event itself
+
+    def test_interest_fills_free_slot_only(self):
+        self.cm.preferred_neighbors = {2}
+        self.cm.on_interest(3, True)
+        self.assertEqual(len(self.scheduled), 1)
+        self.cm.preferred_pending = False
+        self.cm.preferred_neighbors = {2, 3}
+        self.cm.on_interest(4, True)
+        self.assertEqual(len(self.scheduled), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,29 @@
 import unittest
 import os
-from src.config import parse_config
+import tempfile
+from src.config import parse_config, MAX_BLOCK_SIZE
 
 
 class TestConfig(unittest.TestCase):
     def test_config_peerinfo(self):
+        cwd = os.getcwd()
         os.chdir("./tests")
-        conf = parse_config()
+        try:
+            conf = parse_config()
+        finally:
+            os.chdir(cwd)
         self.assertEqual(conf.file_name, "TheFile.dat")
 
+    def test_block_size_out_of_range(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "Common.cfg")
+            for block_size in (0, MAX_BLOCK_SIZE + 1):
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write("NumberOfPreferredNeighbors 1\nUnchokingInterval 1\nOptimisticUnchokingInterval 2\n"
+                            f"FileName a.dat\nFileSize 100\nPieceSize 10\nBlockSize {block_size}\n")
+                with self.assertRaises(ValueError):
+                    parse_config(path)
+
 
 if __name__ == "__main__":
     unittest.main()
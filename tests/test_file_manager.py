@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from src.file_manager import FileManager
+
+
+class TestFileManager(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "peer_1", "file.dat")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_preallocates_and_roundtrips(self):
+        fm = FileManager(self.path, 4, 10)
+        assert os.path.getsize(self.path) == 10
+        fm.write_piece(2, b"zz") # last piece is short
+        fm.write_piece(0, b"abcd")
+        assert fm.get_piece(0) == b"abcd"
+        assert fm.get_piece(2) == b"zz"
+        fm.close()
+        with open(self.path, "rb") as f:
+            assert f.read() == b"abcd" + bytes(4) + b"zz"
+
+    def test_read_into(self):
+        fm = FileManager(self.path, 4, 10)
+        fm.write_piece(2, b"zz")
+        buf = bytearray(6)
+        assert fm.read_into(2, memoryview(buf)[2:]) == 2
+        assert buf == b"\x00\x00zz\x00\x00"
+        fm.close()
+
+    def test_existing_file_kept(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "wb") as f:
+            f.write(b"0123456789")
+        fm = FileManager(self.path, 4, 10, create=False)
+        assert fm.get_piece(1) == b"4567"
+        fm.close()
+
+    def test_missing_file_not_created(self):
+        fm = FileManager(self.path, 4, 10, create=False)
+        assert fm.get_piece(0) == b""
+        assert not os.path.exists(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
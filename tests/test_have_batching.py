@@ -0,0 +1,106 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from tests.swarm import make_swarm, FIRST_PEER_ID
+from src.message_handler import FrameReader, BITFIELD, HAVE, HAVE_MULTI
+from src.messages import encode_handshake, FEATURE_BLOCKS
+from src.peer_process import PeerProcess
+
+
+class TestHaveBatching(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_cwd = os.getcwd()
+        self.peers = []
+        self.socks = []
+
+    def tearDown(self):
+        for pp in self.peers:
+            pp.shutdown()
+        for sock in self.socks:
+            sock.close()
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    # a leecher of 3 pieces connected to the seeder over a socketpair, and a reader for what it sends the seeder
+    def leecher(self, interval: int, features: int = PeerProcess.FEATURES):
+        config_dir, work_dir = make_swarm(self.base_dir, peers=2, seeders=1, file_size=10000, piece_size=4096,
+                                          common={"HaveBatchInterval": interval})
+        os.chdir(work_dir)
+        pp = PeerProcess(FIRST_PEER_ID + 1, config_dir)
+        self.peers.append(pp)
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(0.5)
+        self.socks += [ours, theirs]
+        pp._set_features(FIRST_PEER_ID, encode_handshake(FIRST_PEER_ID, features))
+        pp._add_connection(FIRST_PEER_ID, ours)
+        return pp, FrameReader(theirs)
+
+    # piece indices announced by the next HAVE or HAVE_MULTI, skipping other messages; None if none comes in time
+    def next_have(self, reader):
+        while True:
+            try:
+                msg_type, payload = reader.read_message()
+            except socket.timeout:
+                return None
+            if msg_type == HAVE:
+                return msg_type, [int.from_bytes(payload, "big")]
+            if msg_type == HAVE_MULTI:
+                return msg_type, list(struct.unpack(f"!{len(payload) // 4}I", payload))
+
+    def test_pieces_are_announced_together_on_the_interval(self):
+        pp, reader = self.leecher(interval=300)
+        pp.main_share._on_piece_done(FIRST_PEER_ID, 0)
+        pp.main_share._on_piece_done(FIRST_PEER_ID, 2)
+        self.assertIsNone(self.next_have(reader))
+        threading.Thread(target=pp._have_flusher, daemon=True).start()
+        reader.sock.settimeout(5)
+        self.assertEqual(self.next_have(reader), (HAVE_MULTI, [0, 2]))
+
+    def test_zero_interval_sends_each_have_at_once(self):
+        pp, reader = self.leecher(interval=0)
+        pp.main_share._on_piece_done(FIRST_PEER_ID, 0)
+        self.assertEqual(self.next_have(reader), (HAVE, [0]))
+        pp.main_share._on_piece_done(FIRST_PEER_ID, 2)
+        self.assertEqual(self.next_have(reader), (HAVE, [2]))
+
+    def test_peer_without_the_feature_gets_separate_haves(self):
+        pp, reader = self.leecher(interval=300, features=FEATURE_BLOCKS)
+        pp.main_share._on_piece_done(FIRST_PEER_ID, 0)
+        pp.main_share._on_piece_done(FIRST_PEER_ID, 2)
+        pp._flush_all_haves()
+        self.assertEqual(self.next_have(reader), (HAVE, [0]))
+        self.assertEqual(self.next_have(reader), (HAVE, [2]))
+
+    def test_spared_haves_follow_on_completion_without_a_bitfield(self):
+        pp, reader = self.leecher(interval=0)
+        pp._handle_message(FIRST_PEER_ID, None, BITFIELD, b"\xa0")
+        for index in (0, 1, 2):
+            pp.main_share._on_piece_done(FIRST_PEER_ID, index)
+        messages = []
+        while True:
+            try:
+                msg_type, payload = reader.read_message()
+            except socket.timeout:
+                break
+            if msg_type in (BITFIELD, HAVE, HAVE_MULTI):
+                messages.append((msg_type, bytes(payload)))
+        # BITFIELD only ever comes first, the pieces it had are announced once we are complete
+        self.assertEqual(messages, [(HAVE, struct.pack("!I", 1)), (HAVE_MULTI, struct.pack("!2I", 0, 2))])
+
+    def test_received_have_multi_marks_every_piece(self):
+        pp, _ = self.leecher(interval=0)
+        # 7 is past the last piece and ignored
+        pp._handle_message(FIRST_PEER_ID, None, HAVE_MULTI, struct.pack("!3I", 0, 2, 7))
+        remote = pp.peers_state[FIRST_PEER_ID].remote_bitfield
+        self.assertEqual([remote.has_piece(i) for i in range(3)], [True, False, True])
+        self.assertEqual(list(pp.picker.availability), [1, 0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
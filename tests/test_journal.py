@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from src.journal import PieceJournal, recover_pieces
+from src.file_manager import FileManager
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "file.dat.journal")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_records_survive_restart(self):
+        j = PieceJournal(self.path, 10, 4, 40)
+        j.rewrite({})
+        for i in (3, 7, 1):
+            j.record(i, b"data")
+        j.close()
+        assert sorted(PieceJournal(self.path, 10, 4, 40).load()) == [1, 3, 7]
+
+    def test_torn_last_record_ignored(self):
+        j = PieceJournal(self.path, 10, 4, 40)
+        j.rewrite({})
+        j.record(5, b"data")
+        j.close()
+        with open(self.path, "ab") as f:
+            f.write(b"\x00\x00") # crash halfway through the next append
+        j = PieceJournal(self.path, 10, 4, 40)
+        assert list(j.load()) == [5]
+        j.record(6, b"data")
+        j.close()
+        assert sorted(PieceJournal(self.path, 10, 4, 40).load()) == [5, 6]
+
+    def test_journal_for_other_file_is_discarded(self):
+        j = PieceJournal(self.path, 10, 4, 40)
+        j.rewrite({})
+        j.record(2, b"data")
+        j.close()
+        assert PieceJournal(self.path, 20, 2, 40).load() == {}
+
+    def test_verify_drops_pieces_that_do_not_match(self):
+        fm = FileManager(os.path.join(self.tmp.name, "file.dat"), 4, 12)
+        j = PieceJournal(self.path, 3, 4, 12, store_hashes=True)
+        j.rewrite({})
+        for i, data in enumerate([b"aaaa", b"bbbb"]):
+            fm.write_piece(i, data)
+            j.record(i, data)
+        fm.write_piece(1, b"XXXX") # data on disk no longer matches what was journaled
+        j.close()
+        j = PieceJournal(self.path, 3, 4, 12, store_hashes=True)
+        assert recover_pieces(j, fm, verify=True) == [0]
+        j.close()
+        assert list(PieceJournal(self.path, 3, 4, 12, store_hashes=True).load()) == [0]
+        fm.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
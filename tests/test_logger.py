@@ -0,0 +1,61 @@
+import os
+import re
+import tempfile
+import unittest
+
+from src import logger
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        # logs go to ../log_peer_<id>.log relative to the working directory
+        os.makedirs(os.path.join(self.tmp.name, "run"))
+        os.chdir(os.path.join(self.tmp.name, "run"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_lines_written_in_order_after_flush(self):
+        for i in range(1000):
+            logger.log(4242, f"requested piece {i} from 1001.")
+        logger.log(4243, "starts.")
+        logger.flush()
+        with open(os.path.join(self.tmp.name, "log_peer_4242.log")) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 1000
+        assert re.fullmatch(r"\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\]: Peer 4242 requested piece 0 from 1001\.", lines[0])
+        assert lines[-1].endswith("Peer 4242 requested piece 999 from 1001.")
+        assert os.path.exists(os.path.join(self.tmp.name, "log_peer_4243.log"))
+
+    def test_close_writes_and_drops_the_file(self):
+        path = os.path.join(self.tmp.name, "log_peer_4244.log")
+        logger.log(4244, "has shut down.")
+        logger.close(4244)
+        with open(path) as f:
+            assert f.read().endswith("Peer 4244 has shut down.\n")
+        # a handle still cached would keep writing to the removed file
+        os.remove(path)
+        logger.log(4244, "starts.")
+        logger.flush()
+        with open(path) as f:
+            assert f.read().endswith("Peer 4244 starts.\n")
+        logger.close()
+
+    def test_file_is_picked_when_logging(self):
+        logger.log(4245, "starts.")
+        # lines still queued when the working directory changes stay in the file they were logged for
+        os.makedirs(os.path.join(self.tmp.name, "other", "run"))
+        os.chdir(os.path.join(self.tmp.name, "other", "run"))
+        logger.log(4245, "has shut down.")
+        logger.close(4245)
+        with open(os.path.join(self.tmp.name, "log_peer_4245.log")) as f:
+            assert f.read().endswith("Peer 4245 starts.\n")
+        with open(os.path.join(self.tmp.name, "other", "log_peer_4245.log")) as f:
+            assert f.read().endswith("Peer 4245 has shut down.\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
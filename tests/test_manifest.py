@@ -0,0 +1,53 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from src.manifest import build_manifest, write_manifest, load_manifest, hash_piece
+from src.piece_verifier import PieceVerifier
+from src.file_manager import FileManager
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "file.dat")
+        self.data = os.urandom(10_000)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parallel_matches_sequential(self):
+        expected = [hash_piece(self.data[i:i + 64]) for i in range(0, len(self.data), 64)]
+        assert build_manifest(self.path, 64, workers=1) == expected
+        assert build_manifest(self.path, 64, workers=7) == expected
+
+    def test_roundtrip(self):
+        digests = build_manifest(self.path, 1000)
+        out = os.path.join(self.tmp.name, "file.dat.sha256")
+        write_manifest(out, digests, 1000, len(self.data))
+        assert load_manifest(out) == (1000, len(self.data), digests)
+
+    def test_verifier_writes_only_matching_pieces(self):
+        digests = build_manifest(self.path, 1000)
+        fm = FileManager(os.path.join(self.tmp.name, "out", "file.dat"), 1000, len(self.data))
+        verified, corrupt = [], []
+        done = threading.Semaphore(0)
+        verifier = PieceVerifier(digests, fm.write_piece,
+                                 lambda r, i: (verified.append(i), done.release()),
+                                 lambda r, i: (corrupt.append(i), done.release()))
+        verifier.submit(1, 2, self.data[2000:3000])
+        verifier.submit(1, 3, bytes(1000))
+        for _ in range(2):
+            assert done.acquire(timeout=5)
+        assert verified == [2] and corrupt == [3]
+        assert fm.get_piece(2) == self.data[2000:3000]
+        assert fm.get_piece(3) == bytes(1000)
+        verifier.shutdown()
+        fm.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import socket
+import unittest
+
+from src.messages import encode_message
+import struct
+from src.message_handler import FrameReader, HAVE, PIECE, INTERESTED, CONTENT, piece_header
+
+
+class TestFrameReader(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_several_frames_in_one_recv(self):
+        self.a.sendall(encode_message(INTERESTED) + encode_message(HAVE, (7).to_bytes(4, "big")))
+        reader = FrameReader(self.b)
+        msg_type, payload = reader.read_message()
+        assert msg_type == INTERESTED and bytes(payload) == b""
+        msg_type, payload = reader.read_message()
+        assert msg_type == HAVE and int.from_bytes(payload, "big") == 7
+
+    def test_frame_larger_than_buffer(self):
+        data = bytes(range(256)) * 40
+        self.a.sendall(encode_message(HAVE) + encode_message(PIECE, data))
+        reader = FrameReader(self.b, buffer_size=64)
+        assert reader.read_message()[0] == HAVE
+        msg_type, payload = reader.read_message()
+        assert msg_type == PIECE and bytes(payload) == data
+
+    def test_partial_frame_moved_to_front(self):
+        reader = FrameReader(self.b, buffer_size=16)
+        frames = [encode_message(PIECE, bytes([i]) * 9) for i in range(5)]
+        for frame in frames:
+            # drip-feed so frames straddle the end of the buffer
+            self.a.sendall(frame[:3])
+            self.a.sendall(frame[3:])
+        for i in range(5):
+            msg_type, payload = reader.read_message()
+            assert msg_type == PIECE and bytes(payload) == bytes([i]) * 9
+
+    def test_piece_inside_content_message(self):
+        data = b"0123456789"
+        self.a.sendall(piece_header(3, len(data), content_id=0xABCD) + data)
+        msg_type, payload = FrameReader(self.b).read_message()
+        assert msg_type == CONTENT
+        assert struct.unpack_from("!IBI", payload) == (0xABCD, PIECE, 3)
+        assert bytes(payload[9:]) == data
+
+    def test_closed_socket(self):
+        self.a.sendall(encode_message(HAVE)[:2])
+        self.a.close()
+        reader = FrameReader(self.b)
+        with self.assertRaises(ConnectionError):
+            reader.read_message()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,7 +4,7 @@ import struct
 from src.messages import (
     HANDSHAKE_FIRST, encode_handshake, decode_handshake, encode_message, 
     decode_message, CHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD,
-    make_handshake, verify_handshake
+    make_handshake, verify_handshake, decode_handshake_features, FEATURE_BLOCKS, content_id
 )
 
 class TestMessages(unittest.TestCase):
@@ -14,6 +14,17 @@ class TestMessages(unittest.TestCase):
         assert bytes_obj[:28] == HANDSHAKE_FIRST # Ensure that the first 28 bytes are the Header + Zeroes
         assert decode_handshake(bytes_obj) == 1001 # Ensure that the peer_ID stays the same
     
+    def test_handshake_features(self): # Feature bits ride in the last zero bytes, the peer ID is unaffected
+        bytes_obj = encode_handshake(1002, FEATURE_BLOCKS)
+        assert decode_handshake(bytes_obj) == 1002
+        assert decode_handshake_features(bytes_obj) == FEATURE_BLOCKS
+        assert decode_handshake_features(encode_handshake(1002)) == 0
+
+    def test_content_id(self): # Same file name and size give the same id on every peer
+        assert content_id("a.bin", 3000) == content_id("a.bin", 3000)
+        assert content_id("a.bin", 3000) != content_id("a.bin", 3001)
+        assert 0 <= content_id("b.bin", 55) < 2 ** 32
+
     def test_message_roundtrip_no_payload(self): # Checks if the round trip choke message stays the same
         buffer = bytearray(encode_message(CHOKE)) 
         msg_type, payload = decode_message(buffer)
@@ -0,0 +1,57 @@
+import json
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from src.metrics import MetricsRegistry, SnapshotWriter, serve_metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.sent = self.registry.counter("bytes_sent_total", "Bytes sent.", ("peer",))
+        self.latency = self.registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+        self.depth = self.registry.gauge("queue_depth", "Queue depth.", ("peer",))
+
+    def test_prometheus_text(self):
+        self.sent.labels(1002).inc(10)
+        self.sent.labels(1002).inc(5)
+        self.latency.observe(0.05)
+        self.latency.observe(0.5)
+        self.latency.observe(3)
+        self.depth.set_function(lambda: {(1003,): 7})
+        text = self.registry.render_prometheus()
+        assert "# TYPE bytes_sent_total counter" in text
+        assert 'bytes_sent_total{peer="1002"} 15' in text
+        assert 'latency_seconds_bucket{le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{le="1.0"} 2' in text
+        assert 'latency_seconds_bucket{le="+Inf"} 3' in text
+        assert "latency_seconds_count 3" in text
+        assert 'queue_depth{peer="1003"} 7' in text
+
+    def test_snapshot_and_http(self):
+        self.sent.labels(1002).inc(3)
+        snapshot = self.registry.snapshot()
+        assert snapshot["bytes_sent_total"]["samples"] == [{"labels": {"peer": "1002"}, "value": 3}]
+
+        server = serve_metrics(self.registry, 0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(url + "/metrics") as r:
+                assert 'bytes_sent_total{peer="1002"} 3' in r.read().decode()
+            with urllib.request.urlopen(url + "/metrics.json") as r:
+                assert json.load(r) == snapshot
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.json")
+            SnapshotWriter(self.registry, path, 60).start().stop()
+            with open(path) as f:
+                assert json.load(f)["metrics"] == snapshot
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from src.neighbor_manager import NeighborManager
+
+
+class TestNeighborManager(unittest.TestCase):
+    def setUp(self):
+        # pid -> score, a missing pid is useless to both sides
+        self.scores = {}
+        self.nm = NeighborManager([1, 2, 3, 4], 2, 10, self.scores.get)
+        self.nm.last_rotation = 0.0
+
+    def test_fills_free_slots_with_earlier_peers(self):
+        evict, dial = self.nm.plan(now=1.0)
+        self.assertEqual(evict, [])
+        self.assertEqual(len(dial), 2)
+        # dialed peers hold their slots
+        self.assertEqual(self.nm.plan(now=2.0), ([], []))
+
+    def test_newcomer_replaces_only_a_useless_settled_neighbor(self):
+        self.assertEqual(self.nm.admit(5, now=0.0), (True, None))
+        self.assertEqual(self.nm.admit(6, now=0.0), (True, None))
+        self.scores.update({5: 100.0, 6: 1.0})
+        # too young to be dropped, and useful
+        self.assertEqual(self.nm.admit(7, now=5.0), (False, None))
+        self.assertEqual(self.nm.admit(7, now=20.0), (False, None))
+        del self.scores[6]
+        self.assertEqual(self.nm.admit(7, now=20.0), (True, 6))
+        self.assertEqual(set(self.nm.connected_at), {5, 7})
+
+    def test_done_neighbor_makes_room_before_it_settles(self):
+        done = {6}
+        nm = NeighborManager([1, 2, 3, 4], 2, 10, self.scores.get, done.__contains__)
+        nm.admit(5, now=0.0)
+        nm.admit(6, now=0.0)
+        self.scores[5] = 100.0
+        # 6 is young but neither side needs the other any more
+        self.assertEqual(nm.admit(7, now=1.0), (True, 6))
+
+    def test_rotation_drops_least_useful_neighbor(self):
+        self.nm.admit(5, now=0.0)
+        self.nm.admit(6, now=0.0)
+        self.scores.update({5: 100.0, 6: 1.0})
+        evict, dial = self.nm.plan(now=11.0)
+        self.assertEqual(evict, [6])
+        self.assertEqual(len(dial), 1)
+
+    def test_failed_dial_backs_off(self):
+        nm = NeighborManager([1], 2, 0, self.scores.get)
+        self.assertEqual(nm.plan(now=0.0), ([], [1]))
+        nm.dial_failed(1, now=0.0)
+        self.assertEqual(nm.plan(now=0.1), ([], []))
+        self.assertEqual(nm.plan(now=2.0), ([], [1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
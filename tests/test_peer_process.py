@@ -0,0 +1,239 @@
+import asyncio
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from tests.swarm import make_swarm, FIRST_PEER_ID, FILE_NAME
+from src.message_handler import BITFIELD, HAVE, PIECE, CONTENT
+from src.messages import encode_handshake, decode_handshake, decode_handshake_features, content_id
+from src.async_peer_process import AsyncPeerProcess
+from src.peer_process import PeerProcess
+from src.peer_writer import PeerWriter, MAX_QUEUED_CONTROL
+
+
+class TestPeerProcess(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.old_cwd = os.getcwd()
+        self.config_dir, work_dir = make_swarm(self.base_dir, peers=3, seeders=1, file_size=10000, piece_size=4096)
+        os.chdir(work_dir)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def test_restart_in_same_process(self):
+        # the second peer only gets the port if the first one closed its listening socket
+        for _ in range(2):
+            pp = PeerProcess(FIRST_PEER_ID, self.config_dir)
+            pp.start()
+            self.assertTrue(pp.running)
+            pp.shutdown()
+
+    def test_reconnecting_peer_is_not_subtracted_twice(self):
+        pp = PeerProcess(FIRST_PEER_ID + 1, self.config_dir)
+        remote = FIRST_PEER_ID
+        pp.main_share._peer_state(remote)
+        pp._handle_message(remote, None, BITFIELD, b"\x80")
+        self.assertEqual(list(pp.picker.availability), [1, 0, 0])
+        pp._on_disconnect(remote)
+        # the next connection announces a piece before (or without) a BITFIELD
+        pp.main_share._on_have(remote, [1])
+        self.assertEqual(list(pp.picker.availability), [0, 1, 0])
+        pp._on_disconnect(remote)
+        self.assertEqual(list(pp.picker.availability), [0, 0, 0])
+        pp.shutdown()
+
+    def test_missing_count_over_a_connection(self):
+        pp = PeerProcess(FIRST_PEER_ID + 2, self.config_dir)
+        for remote in (FIRST_PEER_ID, FIRST_PEER_ID + 1):
+            pp._set_features(remote, encode_handshake(remote, PeerProcess.FEATURES))
+        self.assertEqual([pp.picker.missing_count(i) for i in range(3)], [2, 2, 2])
+        pp._handle_message(FIRST_PEER_ID, None, BITFIELD, b"\xe0")
+        pp.main_share._on_have(FIRST_PEER_ID + 1, [2])
+        self.assertEqual([pp.picker.missing_count(i) for i in range(3)], [1, 1, 0])
+        pp._on_disconnect(FIRST_PEER_ID)
+        self.assertEqual([pp.picker.missing_count(i) for i in range(3)], [1, 1, 0])
+        pp._on_disconnect(FIRST_PEER_ID + 1)
+        self.assertEqual([pp.picker.missing_count(i) for i in range(3)], [0, 0, 0])
+        pp.shutdown()
+
+    def test_endgame_duplicate_piece_is_dropped(self):
+        pp = PeerProcess(FIRST_PEER_ID + 2, self.config_dir)
+        first, second = FIRST_PEER_ID, FIRST_PEER_ID + 1
+        pp.config.min_request_window = 3
+        for remote in (first, second):
+            pp.main_share._peer_state(remote)
+            pp._handle_message(remote, None, BITFIELD, b"\xe0")
+            # 3 pieces are within the endgame threshold, so both neighbors are asked for every one
+            pp.transfer_mgr.fill_window(remote, lambda *_: True)
+        self.assertEqual(pp.picker.reserved[0], {first, second})
+        pp._handle_message(first, None, PIECE, b"\x00\x00\x00\x00" + b"AAAA")
+        pp._handle_message(second, None, PIECE, b"\x00\x00\x00\x00" + b"BBBB")
+        self.assertEqual(pp.file_mgr.get_piece(0)[:4], b"AAAA")
+        self.assertEqual(pp.bitfield.count, 1)
+        self.assertEqual(pp.metrics.pieces_received.labels(first).value, 1)
+        self.assertEqual(pp.metrics.pieces_received.labels(second).value, 0)
+        self.assertNotIn(0, pp.transfer_mgr.in_flight[second])
+        pp.shutdown()
+
+    def test_last_neighbor_completing_starts_shutdown(self):
+        pp = PeerProcess(FIRST_PEER_ID, self.config_dir)
+        # only the wheel runs, nothing polls for completion
+        pp.choke_manager.start()
+        for remote in (FIRST_PEER_ID + 1, FIRST_PEER_ID + 2):
+            pp._set_features(remote, encode_handshake(remote, PeerProcess.FEATURES))
+        pp._handle_message(FIRST_PEER_ID + 1, None, BITFIELD, b"\xe0")
+        pp._handle_message(FIRST_PEER_ID + 2, None, BITFIELD, b"\xc0")
+        self.assertIsNone(pp.completion_timer)
+        # the last piece of the last incomplete neighbor schedules the shutdown right away
+        pp._handle_message(FIRST_PEER_ID + 2, None, HAVE, (2).to_bytes(4, "big"))
+        self.assertIsNotNone(pp.completion_timer)
+        self.assertTrue(pp.shut_down.wait(5))
+        self.assertFalse(pp.running)
+
+    def test_asyncio_peer_in_a_threaded_swarm(self):
+        config_dir, work_dir = make_swarm(os.path.join(self.base_dir, "mixed"), peers=3, seeders=1, file_size=10000,
+                                          piece_size=4096, common={"BlockSize": 1024})
+        os.chdir(work_dir)
+        peers = [PeerProcess(FIRST_PEER_ID, config_dir), AsyncPeerProcess(FIRST_PEER_ID + 1, config_dir),
+                 PeerProcess(FIRST_PEER_ID + 2, config_dir)]
+
+        def run(pp):
+            if isinstance(pp, AsyncPeerProcess):
+                asyncio.run(pp.run())
+            else:
+                pp.start()
+                pp.shut_down.wait()
+
+        threads = [threading.Thread(target=run, args=(pp,), daemon=True) for pp in peers]
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join(30)
+                self.assertFalse(t.is_alive())
+        finally:
+            for pp in peers:
+                if pp.running:
+                    pp.shutdown()
+        with open(f"peer_{FIRST_PEER_ID}/{FILE_NAME}", "rb") as f:
+            expected = f.read()
+        for i in (1, 2):
+            with open(f"peer_{FIRST_PEER_ID + i}/{FILE_NAME}", "rb") as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_swarm_with_max_connections_shuts_down_promptly(self):
+        config_dir, work_dir = make_swarm(os.path.join(self.base_dir, "limited"), peers=4, seeders=1, file_size=10000,
+                                          piece_size=4096, common={"MaxConnections": 2})
+        os.chdir(work_dir)
+        peers = [PeerProcess(FIRST_PEER_ID + i, config_dir) for i in range(4)]
+        started = time.monotonic()
+        for pp in peers:
+            threading.Thread(target=pp.start, daemon=True).start()
+        try:
+            for pp in peers:
+                # a few seconds of quiet, not two rotation intervals (a minute by default)
+                self.assertTrue(pp.shut_down.wait(max(0.0, started + 15 - time.monotonic())))
+        finally:
+            for pp in peers:
+                if pp.running:
+                    pp.shutdown()
+        for pp in peers:
+            self.assertTrue(pp.bitfield.is_complete())
+
+    def test_choke_round_does_not_wait_on_a_stalled_peer(self):
+        pp = PeerProcess(FIRST_PEER_ID, self.config_dir)
+        remote = FIRST_PEER_ID + 1
+        ours, theirs = socket.socketpair()
+        pp.main_share._peer_state(remote).is_interested = True
+        # a writer that never drains, with a full queue
+        writer = PeerWriter(ours, lambda: None, None)
+        pp.conn_map[remote], pp.writers[remote] = ours, writer
+        for _ in range(MAX_QUEUED_CONTROL):
+            writer.send(HAVE, b"\x00\x00\x00\x00")
+        selection = threading.Thread(target=pp.choke_manager._select_preferred_neighbors, daemon=True)
+        selection.start()
+        selection.join(2)
+        self.assertFalse(selection.is_alive())
+        # the UNCHOKE did not fit, the stalled connection is dropped instead
+        self.assertTrue(writer.closed)
+        pp.shutdown()
+        theirs.close()
+
+    def test_handshake_reply_keeps_zero_bytes_for_plain_peers(self):
+        pp = PeerProcess(FIRST_PEER_ID, self.config_dir)
+        for features, reply_features in ((0, 0), (PeerProcess.FEATURES, PeerProcess.FEATURES)):
+            ours, theirs = socket.socketpair()
+            theirs.settimeout(5)
+            theirs.sendall(encode_handshake(FIRST_PEER_ID + 1, features))
+            pp._handle_connection_incoming(ours)
+            reply = theirs.recv(32)
+            self.assertEqual(decode_handshake(reply), FIRST_PEER_ID)
+            self.assertEqual(decode_handshake_features(reply), reply_features)
+            theirs.close()
+        pp.shutdown()
+
+    def test_replaced_connection_is_closed(self):
+        pp = PeerProcess(FIRST_PEER_ID + 1, self.config_dir)
+        remote = FIRST_PEER_ID
+        first, first_remote = socket.socketpair()
+        second, second_remote = socket.socketpair()
+        pp._add_connection(remote, first)
+        listener = threading.Thread(target=pp._message_listener, args=(remote, first))
+        listener.start()
+        pp._add_connection(remote, second)
+        listener.join(5)
+        self.assertEqual(first.fileno(), -1)
+        self.assertIs(pp.conn_map[remote], second)
+        pp.shutdown()
+        first_remote.close()
+        second_remote.close()
+
+    def test_content_message_goes_to_its_file(self):
+        config_dir, work_dir = make_swarm(os.path.join(self.base_dir, "files"), peers=2, seeders=1, file_size=10000,
+                                          piece_size=4096, files={"extra.dat": 5000})
+        os.chdir(work_dir)
+        pp = PeerProcess(FIRST_PEER_ID + 1, config_dir)
+        remote = FIRST_PEER_ID
+        pp._set_features(remote, encode_handshake(remote, PeerProcess.FEATURES))
+        share = pp.contents[content_id("extra.dat", 5000)]
+        pp._handle_message(remote, None, CONTENT, struct.pack("!IB", share.content_id, BITFIELD) + b"\x40")
+        self.assertTrue(share.peers_state[remote].remote_bitfield.has_piece(1))
+        self.assertEqual(list(share.picker.availability), [0, 1])
+        # FileName did not hear about it, and a content id we do not share is ignored
+        self.assertEqual(pp.peers_state[remote].remote_bitfield.count, 0)
+        pp._handle_message(remote, None, CONTENT, struct.pack("!IB", share.content_id + 1, BITFIELD) + b"\xc0")
+        self.assertEqual(list(share.picker.availability), [0, 1])
+        pp.shutdown()
+
+    def test_files_cfg_swarm_completes(self):
+        config_dir, work_dir = make_swarm(os.path.join(self.base_dir, "files"), peers=3, seeders=1, file_size=10000,
+                                          piece_size=4096, files={"extra.dat": 5000})
+        os.chdir(work_dir)
+        peers = [PeerProcess(FIRST_PEER_ID + i, config_dir) for i in range(3)]
+        for pp in peers:
+            threading.Thread(target=pp.start, daemon=True).start()
+        try:
+            for pp in peers:
+                # every peer shuts down on its own once the swarm holds both files
+                self.assertTrue(pp.shut_down.wait(30))
+        finally:
+            for pp in peers:
+                if pp.running:
+                    pp.shutdown()
+        for name in (FILE_NAME, "extra.dat"):
+            with open(f"peer_{FIRST_PEER_ID}/{name}", "rb") as f:
+                expected = f.read()
+            for i in (1, 2):
+                with open(f"peer_{FIRST_PEER_ID + i}/{name}", "rb") as f:
+                    self.assertEqual(f.read(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
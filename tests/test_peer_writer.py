@@ -0,0 +1,90 @@
+import socket
+import struct
+import threading
+import unittest
+from collections import deque
+
+from src import peer_writer
+from src.peer_writer import PeerWriter
+
+
+def read_frame(sock):
+    header = b""
+    while len(header) < 5:
+        header += sock.recv(5 - len(header))
+    length, msg_type = struct.unpack("!IB", header)
+    body = b""
+    while len(body) < length - 1:
+        body += sock.recv(length - 1 - len(body))
+    return msg_type, body
+
+
+class TestPeerWriter(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.settimeout(5)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_control_messages_go_before_queued_uploads(self):
+        uploads = deque([b"piece-a", b"piece-b"])
+        gate = threading.Event()
+
+        def next_upload():
+            return uploads.popleft() if gate.is_set() and uploads else None
+
+        def send_upload(sock, entry):
+            sock.sendall(struct.pack("!IB", 1 + len(entry), 7) + entry)
+
+        writer = PeerWriter(self.ours, next_upload, send_upload)
+        writer.send(1) # queued before the writer runs
+        writer.start()
+        writer.send(4, b"\x00\x00\x00\x02")
+        gate.set()
+        writer.wake()
+        frames = [read_frame(self.theirs) for _ in range(4)]
+        assert frames == [(1, b""), (4, b"\x00\x00\x00\x02"), (7, b"piece-a"), (7, b"piece-b")]
+        writer.close()
+        assert not writer.send(1)
+
+    def test_overflow_closes_connection(self):
+        writer = PeerWriter(self.ours, lambda: None, None) # not started, so nothing drains
+        for i in range(peer_writer.MAX_QUEUED_CONTROL):
+            assert writer.send(4, i.to_bytes(4, "big"))
+        # no queued INTERESTED to replace, so it does not fit
+        assert not writer.send(2)
+        assert writer.closed
+
+    def test_send_never_waits_on_a_peer_that_does_not_read(self):
+        writer = PeerWriter(self.ours, lambda: None, None).start()
+        done = threading.Event()
+
+        def flood():
+            for i in range(5000):
+                if not writer.send(4, i.to_bytes(4, "big") * 256):
+                    break
+            done.set()
+
+        threading.Thread(target=flood, daemon=True).start()
+        # the far end never reads: the flood ends with the connection closed, not with a sender stuck
+        assert done.wait(5)
+        assert writer.closed
+
+    def test_newer_choke_and_interest_replace_queued_ones(self):
+        writer = PeerWriter(self.ours, lambda: None, None)
+        writer.send(1) # UNCHOKE
+        writer.send(2) # INTERESTED
+        writer.send(4, b"\x00\x00\x00\x07")
+        writer.send(0) # CHOKE, the UNCHOKE is never sent
+        writer.send(3) # NOT_INTERESTED
+        writer.send(12, b"\x00\x00\x00\x09\x02") # INTERESTED for another file stays
+        assert len(writer.control) == 4
+        writer.start()
+        frames = [read_frame(self.theirs) for _ in range(4)]
+        assert frames == [(4, b"\x00\x00\x00\x07"), (0, b""), (3, b""), (12, b"\x00\x00\x00\x09\x02")]
+        writer.close()
+
+if __name__ == "__main__":
+    unittest.main()
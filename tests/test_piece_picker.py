@@ -0,0 +1,171 @@
+import unittest
+
+from src.bitfield import Bitfield
+from src.piece_picker import PiecePicker
+
+
+def bitfield_with(num_pieces, pieces):
+    bf = Bitfield(num_pieces)
+    for i in pieces:
+        bf.set_piece(i)
+    return bf
+
+
+class TestPiecePicker(unittest.TestCase):
+    def test_rarest_first(self):
+        picker = PiecePicker(Bitfield(4))
+        picker.add_peer(1, bitfield_with(4, [0, 1, 2, 3]))
+        picker.add_peer(2, bitfield_with(4, [0, 1, 3]))
+        picker.add_peer(3, bitfield_with(4, [0, 3]))
+        # piece 2 is only at peer 1, then piece 1 at two peers
+        assert picker.pick(1, bitfield_with(4, [0, 1, 2, 3]), 2) == [2, 1]
+
+    def test_pieces_only_one_neighbor_has_come_first(self):
+        picker = PiecePicker(Bitfield(200))
+        everything = bitfield_with(200, range(200))
+        picker.add_peer(1, everything)
+        picker.add_peer(2, bitfield_with(200, range(0, 200, 2)))
+        picked = picker.pick(1, everything, 10)
+        assert len(picked) == 10 and all(i % 2 for i in picked)
+
+    def test_skips_pieces_we_have(self):
+        picker = PiecePicker(bitfield_with(3, [1]))
+        remote = bitfield_with(3, [0, 1, 2])
+        picker.add_peer(1, remote)
+        assert sorted(picker.pick(1, remote, 3)) == [0, 2]
+
+    def test_reserved_pieces_not_picked_twice(self):
+        picker = PiecePicker(Bitfield(3))
+        remote = bitfield_with(3, [0, 1, 2])
+        picker.add_peer(1, remote)
+        picker.add_peer(2, remote)
+        first = picker.pick(1, remote, 2)
+        second = picker.pick(2, remote, 3)
+        assert len(second) == 1 and second[0] not in first
+
+    def test_unreserve_only_frees_own_reservations(self):
+        picker = PiecePicker(Bitfield(2))
+        remote = bitfield_with(2, [0, 1])
+        picker.add_peer(1, remote)
+        picker.add_peer(2, remote)
+        a = picker.pick(1, remote, 1)
+        picker.unreserve(2, a)
+        assert picker.pick(2, remote, 2) != a
+        picker.unreserve(1, a)
+        assert picker.pick(3, remote, 2) == a
+
+    def test_have_and_disconnect_update_availability(self):
+        picker = PiecePicker(Bitfield(3))
+        remote = bitfield_with(3, [0])
+        picker.add_peer(1, remote)
+        remote.set_piece(2)
+        picker.add_have(1, 2)
+        assert list(picker.availability) == [1, 0, 1]
+        picker.remove_peer(1, remote)
+        picker.remove_peer(1, remote)  # second removal is a no-op
+        assert list(picker.availability) == [0, 0, 0]
+
+    def test_remote_bitfield_is_changed_by_the_picker(self):
+        picker = PiecePicker(Bitfield(3))
+        remote = Bitfield(3)
+        picker.add_peer(1, remote, b"\x80")
+        assert picker.add_have(1, 2, remote)
+        assert not picker.add_have(1, 2, remote) # a repeated HAVE counts once
+        assert [remote.has_piece(i) for i in range(3)] == [True, False, True]
+        # a new BITFIELD replaces the old pieces
+        picker.add_peer(1, remote, b"\x40")
+        assert list(picker.availability) == [0, 1, 0]
+        picker.remove_peer(1, remote, clear=True)
+        assert remote.count == 0 and list(picker.availability) == [0, 0, 0]
+
+    def test_seeds_and_holders(self):
+        picker = PiecePicker(Bitfield(2))
+        seed = bitfield_with(2, [0, 1])
+        leecher = bitfield_with(2, [0])
+        picker.add_peer(1, seed)
+        picker.add_peer(2, leecher)
+        assert picker.seeds == 1
+        assert picker.holders(0) == 2 and picker.holders(1) == 1
+        picker.add_have(2, 1, leecher)
+        assert picker.seeds == 2 and picker.holders(1) == 2
+        picker.remove_peer(1, seed)
+        assert picker.seeds == 1 and picker.holders(1) == 1
+
+    def test_missing_count_follows_neighbors(self):
+        picker = PiecePicker(Bitfield(2))
+        picker.add_neighbor(1) # connected, no BITFIELD yet
+        picker.add_neighbor(2)
+        assert picker.missing_count(0) == 2
+        remote = bitfield_with(2, [0])
+        picker.add_peer(1, remote)
+        assert picker.missing_count(0) == 1 and picker.missing_count(1) == 2
+        # a new BITFIELD replaces the old one
+        picker.remove_peer(1, remote)
+        remote = bitfield_with(2, [1])
+        picker.add_peer(1, remote)
+        assert picker.missing_count(0) == 2 and picker.missing_count(1) == 1
+        picker.remove_peer(2, Bitfield(2)) # disconnect
+        assert picker.missing_count(0) == 1 and picker.missing_count(1) == 0
+
+    def test_endgame_requests_piece_from_several_peers(self):
+        ours = bitfield_with(4, [0, 1])
+        picker = PiecePicker(ours, endgame_threshold=2)
+        remote = bitfield_with(4, [0, 1, 2, 3])
+        picker.add_peer(1, remote)
+        picker.add_peer(2, remote)
+        assert picker.in_endgame()
+        assert sorted(picker.pick(1, remote, 2)) == [2, 3]
+        assert sorted(picker.pick(2, remote, 2)) == [2, 3] # duplicates allowed in endgame
+        assert picker.pick(1, remote, 2) == [] # never twice from the same peer
+        assert picker.complete(2) == {1, 2}
+
+    def test_only_first_endgame_copy_is_taken(self):
+        picker = PiecePicker(bitfield_with(2, [0]), endgame_threshold=1)
+        remote = bitfield_with(2, [0, 1])
+        picker.add_peer(1, remote)
+        picker.add_peer(2, remote)
+        picker.pick(1, remote, 1)
+        picker.pick(2, remote, 1)
+        assert picker.piece_received(1, 1) == {2}
+        assert picker.piece_received(2, 1) is None # late duplicate
+        assert picker.piece_received(1, 1) is None # already being stored
+        assert picker.pick(2, remote, 1) == []
+        assert picker.complete(1) == {1}
+
+    def test_no_duplicates_before_endgame(self):
+        picker = PiecePicker(Bitfield(4), endgame_threshold=2)
+        remote = bitfield_with(4, [0, 1, 2, 3])
+        picker.add_peer(1, remote)
+        assert not picker.in_endgame()
+        picker.pick(1, remote, 4)
+        assert picker.pick(2, remote, 4) == []
+
+    def test_blocks_of_one_piece_from_several_peers(self):
+        # 2 pieces of 10 bytes in blocks of 4: 4 + 4 + 2
+        picker = PiecePicker(Bitfield(2), piece_size=10, file_size=20, block_size=4)
+        remote = bitfield_with(2, [0])
+        picker.add_peer(1, remote)
+        picker.add_peer(2, remote)
+        assert picker.pick_blocks(1, remote, 2) == [(0, 0, 4), (0, 4, 4)]
+        assert picker.pick_blocks(2, remote, 2) == [(0, 8, 2)] # rest of the piece in progress
+        assert picker.pick(3, remote, 1) == [] # not handed out whole while in blocks
+        assert picker.block_received(1, 0, 0) == (False, set())
+        assert picker.block_received(2, 0, 8) == (False, set())
+        picker.unreserve_blocks(1, [(0, 4)])
+        assert picker.pick_blocks(2, remote, 4) == [(0, 4, 4)]
+        assert picker.block_received(2, 0, 4) == (True, set())
+        assert not picker.wants_block(0, 4, 4)
+        assert picker.complete(0) == {2}
+
+    def test_rejected_piece_is_fetched_again(self):
+        picker = PiecePicker(Bitfield(1), piece_size=8, file_size=8, block_size=4)
+        remote = bitfield_with(1, [0])
+        picker.add_peer(1, remote)
+        for _, offset, _ in picker.pick_blocks(1, remote, 2):
+            picker.block_received(1, 0, offset)
+        picker.reject(0)
+        assert picker.pick_blocks(1, remote, 2) == [(0, 0, 4), (0, 4, 4)]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import pstats
+import tempfile
+import threading
+import time
+import unittest
+
+from src.metrics import MetricsRegistry
+from src.profiling import Profiler, TimedLock
+
+
+class TestProfiling(unittest.TestCase):
+    def test_timed_lock_records_contended_waits(self):
+        wait = MetricsRegistry().histogram("wait", "Wait.").labels()
+        lock = TimedLock(threading.Lock(), wait)
+        with lock:
+            pass
+        lock.acquire()
+        threading.Timer(0.05, lock.release).start()
+        with lock:
+            pass
+        _, total, count = wait.read()
+        assert lock.acquisitions == 3 and count == 1 and total >= 0.04
+
+    def test_cprofile_dump_covers_threads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(7, tmp, "cprofile", interval=60).start()
+            def work():
+                time.sleep(0.01)
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+            profiler.stop()
+            profiler.profilers[0].disable() # this thread's, started by start()
+            stats = pstats.Stats(os.path.join(tmp, "profile_peer_7.prof"))
+            assert any(func[2] == "work" for func in stats.stats)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from src.rate_meter import RateMeter
+
+
+class TestRateMeter(unittest.TestCase):
+    def test_rate_over_window(self):
+        meter = RateMeter(4)
+        t = meter.start
+        for second in range(4):
+            meter.add(1000, t + second + 0.5)
+        assert meter.rate(t + 4.0) == 1000
+
+    def test_burst_only_moves_rate_by_its_share(self):
+        meter = RateMeter(5)
+        t = meter.start
+        for second in range(5):
+            meter.add(100, t + second)
+        meter.add(1000, t + 5.0) # one burst
+        assert meter.rate(t + 5.5) < 400
+
+    def test_old_traffic_falls_out(self):
+        meter = RateMeter(3)
+        t = meter.start
+        meter.add(5000, t + 0.5)
+        assert meter.rate(t + 1.0) > 0
+        assert meter.rate(t + 10.0) == 0
+
+    def test_young_meter_uses_its_age(self):
+        meter = RateMeter(10)
+        meter.add(500, meter.start + 0.5)
+        assert meter.rate(meter.start + 1.0) == 500
+
+
+if __name__ == "__main__":
+    unittest.main()
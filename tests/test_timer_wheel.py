@@ -0,0 +1,51 @@
+import unittest
+
+from src.timer_wheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.1, num_slots=8)
+        self.start = self.wheel.cursor * 0.1
+        self.fired = []
+
+    def test_one_shot_fires_once_in_deadline_order(self):
+        self.wheel.call_at(self.start + 0.35, lambda: self.fired.append("b"))
+        self.wheel.call_at(self.start + 0.25, lambda: self.fired.append("a"))
+        self.wheel.advance(self.start + 0.2)
+        self.assertEqual(self.fired, [])
+        # mid-tick, clear of float rounding at the boundary
+        self.wheel.advance(self.start + 0.45)
+        self.assertEqual(self.fired, ["a", "b"])
+        self.wheel.advance(self.start + 5.0)
+        self.assertEqual(self.fired, ["a", "b"])
+
+    def test_cancelled_timer_does_not_fire(self):
+        timer = self.wheel.call_at(self.start + 0.2, lambda: self.fired.append(1))
+        timer.cancel()
+        self.wheel.advance(self.start + 1.0)
+        self.assertEqual(self.fired, [])
+
+    def test_periodic_timer_keeps_its_schedule(self):
+        timer = self.wheel.every(0.5, lambda: self.fired.append(1))
+        first = timer.deadline
+        # advanced late: still due at first + n * interval
+        self.wheel.advance(first + 0.2)
+        self.assertAlmostEqual(timer.deadline, first + 0.5)
+        # missed deadlines are skipped, not run back to back
+        self.wheel.advance(first + 2.2)
+        self.assertEqual(len(self.fired), 2)
+        self.assertAlmostEqual(timer.deadline, first + 2.5)
+
+    def test_errors_are_reported_and_other_timers_run(self):
+        errors = []
+        self.wheel.on_error = errors.append
+        self.wheel.call_at(self.start + 0.1, lambda: 1 / 0)
+        self.wheel.call_at(self.start + 0.1, lambda: self.fired.append(1))
+        self.wheel.advance(self.start + 0.3)
+        self.assertEqual(self.fired, [1])
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from src import logger
+from src.bandwidth import BandwidthLimiter
+from src.bitfield import Bitfield
+from src.peer_state import PeerState
+from src.piece_picker import PiecePicker
+from src.transfer_manager import TransferManager
+
+
+def manager(num_pieces, window, remote_has=None, limiter=None):
+    config = SimpleNamespace(piece_size=100, block_size=100, min_request_window=window, max_request_window=window)
+    bitfield = Bitfield(num_pieces)
+    remote = PeerState(2, num_pieces)
+    for i in range(num_pieces) if remote_has is None else remote_has:
+        remote.remote_bitfield.set_piece(i)
+    picker = PiecePicker(bitfield)
+    picker.add_peer(2, remote.remote_bitfield)
+    return TransferManager(1, config, bitfield, None, {2: remote}, {}, None, picker, limiter)
+
+
+class TestTransferManager(unittest.TestCase):
+    def setUp(self):
+        # peer 1 logs to ../log_peer_1.log, which has to land in a temporary folder
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "run"))
+        os.chdir(os.path.join(self.tmp.name, "run"))
+
+    def tearDown(self):
+        logger.close(1)
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_forget_piece_while_requests_are_added(self):
+        tm = TransferManager(1, None, None, None, {}, {}, None, None)
+        pending = tm.in_flight.setdefault(2, {})
+        stop = threading.Event()
+        errors = []
+
+        # what fill_window does on the download loop's thread
+        def add_requests():
+            n = 0
+            while not stop.is_set():
+                pending[(n % 100, n % 1000)] = 0.0
+                if len(pending) > 500:
+                    pending.clear()
+                n += 1
+
+        # switch threads as often as possible, so the adder runs in the middle of _forget_piece
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        adder = threading.Thread(target=add_requests)
+        adder.start()
+        try:
+            deadline = time.monotonic() + 0.5
+            i = 0
+            while time.monotonic() < deadline:
+                try:
+                    tm._forget_piece(2, i % 100)
+                except RuntimeError as e:
+                    errors.append(e)
+                    break
+                i += 1
+        finally:
+            stop.set()
+            adder.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+    def test_release_during_fill_window_frees_everything(self):
+        tm = manager(10, 4)
+        releases = []
+
+        # a CHOKE handled on the listener thread while the download loop is sending its requests
+        def send(remote_id, msg_type, payload):
+            if not releases:
+                releases.append(threading.Thread(target=tm.release, args=(remote_id,)))
+                releases[0].start()
+                time.sleep(0.05)
+            return True
+
+        tm.fill_window(2, send)
+        releases[0].join()
+        self.assertEqual(tm.picker.reserved, {})
+        self.assertEqual(tm.in_flight.get(2, {}), {})
+        # and the pieces can be picked again
+        self.assertEqual(len(tm.picker.pick(3, tm.peers_state[2].remote_bitfield, 10)), 10)
+
+    def test_requests_are_sent_without_the_lock(self):
+        tm = manager(10, 4)
+        held = []
+        tm.fill_window(2, lambda *msg: held.append(tm.lock.locked()) or True)
+        self.assertEqual(held, [False] * 4)
+
+    def test_download_tokens_only_pay_for_sent_requests(self):
+        limiter = BandwidthLimiter(SimpleNamespace(max_upload_rate=0, max_download_rate=1000,
+                                                   max_peer_upload_rate=0, max_peer_download_rate=0))
+        tm = manager(10, 4, remote_has=[3], limiter=limiter)
+        tm.peers_state[2].is_choked = False
+        tm.peers_state[2].our_interest = True
+        sent = []
+        tm.fill_window(2, lambda *msg: sent.append(msg) or True)
+        # 4 requests were allowed but the neighbor has one piece we need
+        self.assertEqual(len(sent), 1)
+        self.assertAlmostEqual(limiter.download.tokens, 900, delta=1)
+
+
+if __name__ == "__main__":
+    unittest.main()